@@ -13,7 +13,68 @@ import signal
 from inspect import isfunction
 
 
-def cached(kv, h, ttl=300, lock=False, json=False, check_is_cached=False):
+CACHE_NAMESPACE_PREFIX = "cache_ns:"
+CACHE_TAG_PREFIX = "cache_tag:"
+
+
+async def cache_key(db, h, namespace=None, tags=None):
+    """
+        Resolves the actual key of a cached item, see `cached`.
+        :param db: an acquired key-value storage connection
+        :param h: an unique string identifying a cache item
+        :param namespace: a namespace the item belongs to
+        :param tags: a list of tags the item is marked with
+
+        The generations of the namespace and the tags become a part of the key, so once any of them is bumped
+            with `invalidate_cache`, all of the keys of that namespace (or marked with that tag) are effectively gone
+            and simply expire by their ttl.
+    """
+
+    if not namespace and not tags:
+        return h
+
+    version_keys = []
+
+    if namespace:
+        version_keys.append(CACHE_NAMESPACE_PREFIX + namespace)
+
+    if tags:
+        version_keys.extend(CACHE_TAG_PREFIX + tag for tag in tags)
+
+    # a pipeline instead of mget so the version keys are not required to be on the same node in sharded mode
+    pipe = db.pipeline()
+    for version_key in version_keys:
+        pipe.get(version_key)
+    versions = await pipe.execute()
+
+    return "{0}:{1}:{2}".format(
+        namespace or "",
+        ".".join(str(to_int(version)) for version in versions),
+        h)
+
+
+async def invalidate_cache(kv, namespace=None, tags=None):
+    """
+        Invalidates every item cached within the namespace <namespace>, as well as every item marked by any of the
+            <tags>, with no need to know the actual keys (see `cached`). Takes O(1) for each namespace or tag.
+        :param kv: a key-value storage
+        :param namespace: a namespace to invalidate
+        :param tags: a list of tags to invalidate
+    """
+
+    async with kv.acquire() as db:
+        pipe = db.pipeline()
+
+        if namespace:
+            pipe.incr(CACHE_NAMESPACE_PREFIX + namespace)
+
+        for tag in (tags or []):
+            pipe.incr(CACHE_TAG_PREFIX + tag)
+
+        await pipe.execute()
+
+
+def cached(kv, h, ttl=300, lock=False, json=False, check_is_cached=False, namespace=None, tags=None):
     """
         Coroutine-friendly decorator to cache a call result into a key/value storage.
         :param kv: a key-value storage
@@ -25,6 +86,10 @@ def cached(kv, h, ttl=300, lock=False, json=False, check_is_cached=False):
                      if it is, it will be packed properly
         :param check_is_cached: result will be returned as tuple (result, is_cached), where is_cached is bool, meaning
                                 whenever result was a fresh one or pulled from a cache
+        :param namespace: a namespace of the cache item. The whole namespace can be invalidated at once
+                          with `invalidate_cache(kv, namespace=...)`
+        :param tags: a list of tags of the cache item, may be a function (usually a lambda) as well.
+                     Every item marked with a tag can be invalidated at once with `invalidate_cache(kv, tags=[...])`
 
         Decorated method should have such arguments passed:
             cache_hash:
@@ -42,6 +107,22 @@ def cached(kv, h, ttl=300, lock=False, json=False, check_is_cached=False):
             return a
 
         result = await do_task("test")
+
+        Namespaces and tags cost one more round trip per call, to read their generations (see `cache_key`).
+        The item is stored under "<namespace>:<generations>:<h>" then, not under <h>, so adding a namespace
+        or tags to an existing cached call starts it over with an empty cache (the old items expire by their ttl):
+
+        @cached(kv=storage,
+                h=lambda: "gamespace_info:" + gamespace_name,
+                namespace="login",
+                tags=lambda: ["gamespace_name:" + gamespace_name])
+        async def get():
+            ...
+
+        await invalidate_cache(storage, tags=["gamespace_name:" + gamespace_name])
+
+        A tag should name a thing by the same identifier everywhere, "gamespace:<id>" and
+        "gamespace_name:<name>" are different tags.
     """
 
     def wrapper1(method):
@@ -53,6 +134,13 @@ def cached(kv, h, ttl=300, lock=False, json=False, check_is_cached=False):
                 else:
                     _hash = h
 
+                if isfunction(tags):
+                    _tags = tags()
+                else:
+                    _tags = tags
+
+                _hash = await cache_key(db, _hash, namespace=namespace, tags=_tags)
+
                 if lock:
                     lock_name = "l" + _hash
                     lock_obj = db.lock(lock_name)
@@ -199,6 +199,10 @@ class AccessTokenCache(object):
     def acquire(self):
         return self.kv.acquire()
 
+    async def release(self):
+        if self.kv is not None:
+            await self.kv.close()
+
     async def get(self, account):
         async with self.kv.acquire() as db:
             return await db.get(account)
@@ -209,7 +213,11 @@ class AccessTokenCache(object):
             host=options.token_cache_host,
             port=options.token_cache_port,
             db=options.token_cache_db,
-            max_connections=options.token_cache_max_connections)
+            max_connections=options.token_cache_max_connections,
+            nodes=options.token_cache_nodes if "token_cache_nodes" in options else None,
+            min_connections=options.token_cache_min_connections if "token_cache_min_connections" in options else 1,
+            idle_timeout=options.token_cache_idle_timeout if "token_cache_idle_timeout" in options else 0,
+            name="token_cache")
         await self.subscribe()
 
     async def on_invalidate(self, data):
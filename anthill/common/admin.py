@@ -748,6 +748,75 @@ class StreamAdminController(AdminController, jsonrpc.JsonRPC):
                 raise jsonrpc.JsonRPCError(599, "Websocket closed")
 
 
+class RateLimitAdminController(AdminController):
+    """
+    Shows the most admitted and rejected keys of each rate limited action (see ratelimit.RateLimitTelemetry).
+    To use, return it from get_admin of the service:
+
+    def get_admin(self):
+        return {
+            ...
+            "ratelimit": admin.RateLimitAdminController
+        }
+
+    The rate limit is looked up at application.ratelimit, override get_ratelimit otherwise.
+    The keys shown are account ids and addresses, so "<service name>_admin" scope is required to see them.
+    """
+
+    TOP = 20
+
+    def get_ratelimit(self):
+        return getattr(self.application, "ratelimit", None)
+
+    def access_scopes(self):
+        return [self.application.name + "_admin"]
+
+    async def get(self):
+        ratelimit = self.get_ratelimit()
+
+        if ratelimit is None or ratelimit.telemetry is None:
+            raise ActionError("Rate limit telemetry is not enabled")
+
+        telemetry = ratelimit.telemetry
+
+        return {
+            "current": telemetry.top(RateLimitAdminController.TOP),
+            "reported": telemetry.reported,
+            "reported_period": telemetry.reported_period
+        }
+
+    @staticmethod
+    def render_top(title, top, verdict, style):
+        result = []
+
+        for action, verdicts in sorted(top.items()):
+            data = verdicts[verdict]
+            result.append(content("{0}: {1} ({2} total)".format(title, action, data["total"]), [
+                {"id": "key", "title": "Key"},
+                {"id": "count", "title": "Count"},
+                {"id": "error", "title": "Error"}
+            ], [
+                {"key": key, "count": count, "error": error}
+                for key, count, error in data["top"]
+            ], style))
+
+        return result
+
+    def render(self, data):
+        result = []
+
+        result.extend(RateLimitAdminController.render_top("Rejected", data["current"], "rejected", "danger"))
+        result.extend(RateLimitAdminController.render_top("Admitted", data["current"], "admitted", "primary"))
+
+        if data["reported_period"]:
+            result.append(json_view({
+                "period": data["reported_period"],
+                "top": data["reported"]
+            }))
+
+        return result
+
+
 def link(url, title, icon=None, badge=None, **context):
     """
     A single link (usually used in a bundle with 'links' method.
@@ -0,0 +1,198 @@
+
+from tornado.ioloop import PeriodicCallback
+
+from collections import deque
+import logging
+import time
+
+
+class RejectedError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class CircuitBreaker(object):
+    """
+    Guards calls to a single service.
+
+    Closed: calls go through, outcomes of the last <window> of them are kept. Once at least <min_calls>
+        are known and <failure_rate> of them failed, the breaker opens.
+    Open: calls fail fast with RejectedError, for <reset_timeout> seconds. Then the breaker is half-open.
+    Half-open: up to <half_open_calls> calls at a time are let through as a trial, the rest is rejected.
+        A successful trial closes the breaker, a failed one opens it again.
+
+    Regardless of the state, at most <max_concurrent> calls may be in flight at a time (a bulkhead):
+        the calls above that are rejected too, instead of piling up waiting for a slow service.
+
+    Only the exceptions that <is_failure> returns True for are counted in as failures (all of them, by default).
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name, failure_rate=0.5, window=20, min_calls=10, reset_timeout=10,
+                 half_open_calls=1, max_concurrent=256, is_failure=None):
+
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.max_concurrent = max_concurrent
+        self.is_failure = is_failure
+
+        self.outcomes = deque(maxlen=window)
+        self.failures = 0
+        self.opened_at = None
+        self.in_flight = 0
+        self.trials = 0
+        self.rejected = 0
+        self._state = CircuitBreaker.CLOSED
+
+    @property
+    def state(self):
+        if self._state == CircuitBreaker.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+            self.__switch__(CircuitBreaker.HALF_OPEN)
+        return self._state
+
+    async def call(self, call):
+        """
+        Calls <call>(), a coroutine function, if the breaker allows it
+        :raises RejectedError if it does not
+        """
+
+        state = self.state
+
+        if state == CircuitBreaker.OPEN:
+            self.rejected += 1
+            raise RejectedError("Service '{0}' is unavailable (circuit is open)".format(self.name))
+
+        if self.in_flight >= self.max_concurrent:
+            self.rejected += 1
+            raise RejectedError("Too many concurrent requests to '{0}'".format(self.name))
+
+        trial = state == CircuitBreaker.HALF_OPEN
+
+        if trial:
+            if self.trials >= self.half_open_calls:
+                self.rejected += 1
+                raise RejectedError("Service '{0}' is unavailable (circuit is half-open)".format(self.name))
+            self.trials += 1
+
+        self.in_flight += 1
+        # stays None if the call is cancelled, that is not an outcome of the service
+        failed = None
+
+        try:
+            result = await call()
+        except Exception as e:
+            failed = self.is_failure is None or self.is_failure(e)
+            raise
+        else:
+            failed = False
+            return result
+        finally:
+            self.in_flight -= 1
+            self.__done__(trial, failed)
+
+    def gauges(self):
+        return {
+            "state": CircuitBreaker.STATES[self.state],
+            "in_flight": self.in_flight,
+            "failures": self.failures,
+            "calls": len(self.outcomes),
+            "rejected": self.rejected
+        }
+
+    def __done__(self, trial, failed):
+        if trial:
+            self.trials -= 1
+
+            if failed is None:
+                # let another call try
+                return
+
+            if failed:
+                self.__open__()
+            elif self._state == CircuitBreaker.HALF_OPEN:
+                self.outcomes.clear()
+                self.failures = 0
+                self.__switch__(CircuitBreaker.CLOSED)
+            return
+
+        if failed is None or self._state != CircuitBreaker.CLOSED:
+            # cancelled, or started before the breaker opened
+            return
+
+        if len(self.outcomes) == self.outcomes.maxlen and self.outcomes[0]:
+            self.failures -= 1
+
+        self.outcomes.append(failed)
+
+        if failed:
+            self.failures += 1
+
+            if len(self.outcomes) >= self.min_calls and \
+                    self.failures >= self.failure_rate * len(self.outcomes):
+                self.__open__()
+
+    def __open__(self):
+        self.opened_at = time.time()
+        self.__switch__(CircuitBreaker.OPEN)
+
+    def __switch__(self, state):
+        if state == self._state:
+            return
+
+        logging.warning("Circuit breaker for '{0}': {1} -> {2}".format(self.name, self._state, state))
+        self._state = state
+
+        from . import monitoring
+        monitoring.monitor_rate("circuit", state, service=self.name)
+
+
+class CircuitBreakers(object):
+    """
+    A CircuitBreaker per service, created upon first call with the same settings (see CircuitBreaker).
+    If <name> is set, the breakers state is reported to the monitoring every <report_period> seconds
+        as "<name>.circuit" action, tagged with service=<service>. State transitions are reported
+        as "circuit" rates, regardless.
+    """
+
+    def __init__(self, name=None, report_period=60, **settings):
+        self.settings = settings
+        self.breakers = {}
+        self.name = name
+
+        if name and report_period:
+            self.report_callback = PeriodicCallback(self.__report__, report_period * 1000)
+            self.report_callback.start()
+        else:
+            self.report_callback = None
+
+    def get(self, service):
+        breaker = self.breakers.get(service)
+        if breaker is None:
+            breaker = CircuitBreaker(service, **self.settings)
+            self.breakers[service] = breaker
+        return breaker
+
+    async def call(self, service, call):
+        return await self.get(service).call(call)
+
+    def __report__(self):
+        from . import monitoring
+
+        for service, breaker in self.breakers.items():
+            monitoring.monitor_action(self.name + ".circuit", breaker.gauges(), service=service)
+            breaker.rejected = 0
+
+    def stop(self):
+        if self.report_callback is not None:
+            self.report_callback.stop()
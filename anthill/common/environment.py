@@ -1,6 +1,6 @@
 from tornado.gen import Task
 
-from . import cached
+from . import cached, cache_key, invalidate_cache
 from . validate import validate
 from . import internal
 from . import singleton
@@ -30,6 +30,7 @@ class ApplicationInfoAdapter(object):
 
 
 class EnvironmentClient(object, metaclass=singleton.Singleton):
+    CACHE_NAMESPACE = "environment"
 
     def __init__(self, cache):
         self.internal = internal.Internal()
@@ -38,6 +39,7 @@ class EnvironmentClient(object, metaclass=singleton.Singleton):
     async def list_apps(self):
         @cached(kv=self.cache,
                 h="environment_apps",
+                namespace=EnvironmentClient.CACHE_NAMESPACE,
                 json=True)
         async def get():
 
@@ -66,11 +68,27 @@ class EnvironmentClient(object, metaclass=singleton.Singleton):
         """
 
         async with self.cache.acquire() as db:
-            await db.set("environment_app:" + app_name, ujson.dumps(app_info.dump()))
+            key = await cache_key(
+                db, "environment_app:" + app_name,
+                namespace=EnvironmentClient.CACHE_NAMESPACE,
+                tags=["app:" + app_name])
+            await db.set(key, ujson.dumps(app_info.dump()))
+
+    async def invalidate(self, app_name=None):
+        """
+        Drops cached information about the application <app_name>, or everything cached if <app_name> is None
+        """
+
+        if app_name is None:
+            await invalidate_cache(self.cache, namespace=EnvironmentClient.CACHE_NAMESPACE)
+        else:
+            await invalidate_cache(self.cache, tags=["app:" + app_name])
 
     async def get_app_info(self, app_name):
         @cached(kv=self.cache,
                 h=lambda: "environment_app:" + app_name,
+                namespace=EnvironmentClient.CACHE_NAMESPACE,
+                tags=lambda: ["app:" + app_name],
                 json=True)
         async def get():
             response = await self.internal.request(
@@ -6,7 +6,7 @@ import tornado.ioloop
 
 from tornado.web import HTTPError, RequestHandler
 from tornado.websocket import WebSocketClosedError, StreamClosedError
-from .validate import ValidationError
+from .validate import ValidationError, SchemaError
 from asyncio import iscoroutine
 
 from . import access
@@ -30,10 +30,26 @@ class JsonHandlerMixin(object):
 
 
 class AnthillRequestHandler(RequestHandler):
+    # arguments of the handler, see validate.Schema; get_schema_arguments can only be used if it's declared
+    schema = None
+
     def set_default_headers(self):
         self.set_header("API-Version", self.application.api_version)
         self.set_header("Access-Control-Allow-Origin", "*")
 
+    def get_schema_arguments(self):
+        """
+        :returns a dict of the request arguments, validated by the schema of the handler
+        :raises HTTPError 400 listing every invalid argument
+        """
+        if self.schema is None:
+            raise NotImplementedError("{0} declares no schema".format(self.__class__.__name__))
+
+        try:
+            return self.schema.validate_handler(self)
+        except SchemaError as e:
+            raise HTTPError(400, e.message)
+
 
 class JsonHandler(JsonHandlerMixin, AnthillRequestHandler):
     pass
@@ -0,0 +1,516 @@
+
+from tornado.httpclient import AsyncHTTPClient, HTTPResponse, HTTPError
+from tornado.simple_httpclient import HTTPTimeoutError, HTTPStreamClosedError
+from tornado.http1connection import HTTP1Connection, HTTP1ConnectionParameters
+from tornado.httputil import HTTPHeaders, HTTPMessageDelegate, RequestStartLine
+from tornado.iostream import StreamClosedError
+from tornado.ioloop import PeriodicCallback
+from tornado.tcpclient import TCPClient
+from tornado.gen import Future, TimeoutError, convert_yielded, with_timeout
+
+from collections import deque
+from io import BytesIO
+from urllib import parse
+import logging
+import ssl
+import time
+
+try:
+    import pycurl
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+    pycurl = None
+    CurlAsyncHTTPClient = None
+
+
+class ConnectionStatistics(object):
+    """
+    Connection reuse counters of an HTTP client for a single host, reported to the monitoring
+        and reset periodically (see HTTPClientStatistics).
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.opened = 0
+        self.reused = 0
+        self.retried = 0
+        self.waited = 0
+
+    def reset(self):
+        self.requests = 0
+        self.opened = 0
+        self.reused = 0
+        self.retried = 0
+        self.waited = 0
+
+    def dump(self):
+        return {
+            "requests": self.requests,
+            "opened": self.opened,
+            "reused": self.reused,
+            "retried": self.retried,
+            "waited": self.waited,
+            "reuse_ratio": float(self.reused) / self.requests if self.requests else 0.0
+        }
+
+
+class HTTPClientStatistics(object):
+    """
+    ConnectionStatistics of an HTTP client, per host. If <name> is set, every <report_period> seconds those
+        are reported to the monitoring as "http.connections" action, tagged with client=<name> and host=<host>.
+    """
+
+    def __init__(self, name=None, report_period=60, gauges=None):
+        self.name = name
+        self.gauges = gauges
+        self.hosts = {}
+
+        if name and report_period:
+            self.report_callback = PeriodicCallback(self.__report__, report_period * 1000)
+            self.report_callback.start()
+        else:
+            self.report_callback = None
+
+    def get(self, host):
+        statistics = self.hosts.get(host)
+        if statistics is None:
+            statistics = ConnectionStatistics()
+            self.hosts[host] = statistics
+        return statistics
+
+    def __report__(self):
+        from . import monitoring
+
+        for host, statistics in self.hosts.items():
+            values = statistics.dump()
+            if self.gauges is not None:
+                values.update(self.gauges(host))
+            monitoring.monitor_action("http.connections", values, client=self.name, host=host)
+            statistics.reset()
+
+    def stop(self):
+        if self.report_callback is not None:
+            self.report_callback.stop()
+
+
+class HostPool(object):
+    """
+    Keep-alive connections to a single host: at most <max_connections> of them at a time (busy and idle together),
+        requests above that wait in a queue for a connection to be released.
+    Idle connections are reused most recent first, and closed once idle for <idle_timeout> seconds, or
+        as soon as the other side closes them.
+    """
+
+    def __init__(self, max_connections, idle_timeout):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.connections = 0
+        self.idle = deque()
+        self.waiters = deque()
+
+    def acquire(self):
+        """
+        Returns a Future, resolved either with an idle stream to reuse, or with None if a new connection
+            should be opened instead (a place for it is reserved already, give it back with release(None)
+            if the connection fails).
+        """
+
+        future = Future()
+        stream = self.__take_idle__()
+
+        if stream is not None:
+            future.set_result(stream)
+        elif self.connections < self.max_connections:
+            self.connections += 1
+            future.set_result(None)
+        else:
+            self.waiters.append(future)
+
+        return future
+
+    def abandon(self, future):
+        """
+        Gives up a Future, returned by acquire (for example, when the request timed out while waiting for it)
+        """
+        if not future.done():
+            self.waiters.remove(future)
+        else:
+            self.release(future.result())
+
+    def release(self, stream):
+        """
+        Returns a stream to the pool, or just frees its place if the stream is None or closed.
+        """
+
+        if stream is not None and stream.closed():
+            stream = None
+
+        if self.waiters:
+            self.waiters.popleft().set_result(stream)
+            return
+
+        if stream is None:
+            self.connections -= 1
+            return
+
+        self.idle.append((stream, time.time()))
+        stream.set_close_callback(lambda: self.__closed__(stream))
+
+    def discard(self, stream):
+        stream.close()
+        self.release(None)
+
+    def reap(self):
+        deadline = time.time() - self.idle_timeout
+
+        # the least recently used ones are on the left
+        while self.idle and self.idle[0][1] < deadline:
+            stream, released_at = self.idle.popleft()
+            stream.set_close_callback(None)
+            stream.close()
+            self.connections -= 1
+
+    def close(self):
+        while self.idle:
+            stream, released_at = self.idle.popleft()
+            stream.set_close_callback(None)
+            stream.close()
+            self.connections -= 1
+
+    def gauges(self):
+        return {
+            "connections": self.connections,
+            "idle": len(self.idle),
+            "waiters": len(self.waiters)
+        }
+
+    def __take_idle__(self):
+        deadline = time.time() - self.idle_timeout
+
+        while self.idle:
+            stream, released_at = self.idle.pop()
+            stream.set_close_callback(None)
+
+            if stream.closed() or released_at < deadline:
+                stream.close()
+                self.connections -= 1
+                continue
+
+            return stream
+
+        return None
+
+    def __closed__(self, stream):
+        # the close callback is scheduled, so the stream might have been taken already
+        for item in self.idle:
+            if item[0] is stream:
+                self.idle.remove(item)
+                self.connections -= 1
+                return
+
+
+class ResponseReader(HTTPMessageDelegate):
+    def __init__(self):
+        self.code = None
+        self.reason = None
+        self.headers = None
+        self.chunks = []
+        self.finished = False
+
+    def headers_received(self, start_line, headers):
+        self.code = start_line.code
+        self.reason = start_line.reason
+        self.headers = headers
+
+    def data_received(self, chunk):
+        self.chunks.append(chunk)
+
+    def finish(self):
+        self.finished = True
+
+    def on_connection_close(self):
+        pass
+
+
+class KeepAliveHTTPClient(AsyncHTTPClient):
+    """
+    An HTTP/1.1 client that, unlike the default simple_httpclient, keeps connections alive and reuses them
+        for subsequent requests to the same host, at most <max_connections> connections per host (see HostPool).
+
+    A request that failed on a reused connection before any response came back (the other side
+        has closed it in the meantime) is retried once on a new connection, if its method is idempotent.
+
+    Requests are sent one at a time per connection, without pipelining: neither Tornado's HTTP1Connection
+        nor (recent versions of) libcurl support it, and a slow response would hold up every request queued
+        behind it anyway. Redirects are not followed, proxies and body_producer are not supported.
+
+    Usage:
+
+        client = KeepAliveHTTPClient(force_instance=True, max_connections=32)
+        response = await client.fetch("http://127.0.0.1:9500/hello")
+
+    """
+
+    IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+
+    # loading the system CA certificates takes a while, so the default context is created once
+    DEFAULT_SSL_CONTEXT = None
+
+    def initialize(self, max_connections=32, idle_timeout=30, max_buffer_size=104857600,
+                   max_header_size=None, max_body_size=None, name=None, report_period=60, defaults=None):
+        """
+        :param max_connections: a maximum number of connections per host
+        :param idle_timeout: idle connections are closed after that many seconds. Should be less
+            than the idle timeout of the other side, otherwise the requests would often find the connection closed
+        :param name: if set, connection reuse statistics are reported to the monitoring (see HTTPClientStatistics)
+        :param report_period: how often (in seconds) the statistics are reported
+        """
+        super(KeepAliveHTTPClient, self).initialize(defaults=defaults)
+
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.max_buffer_size = max_buffer_size
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.tcp_client = TCPClient()
+        self.pools = {}
+        self.statistics = HTTPClientStatistics(name, report_period, self.__gauges__)
+
+        if idle_timeout:
+            self.reap_callback = PeriodicCallback(self.__reap__, idle_timeout * 1000)
+            self.reap_callback.start()
+        else:
+            self.reap_callback = None
+
+    def close(self):
+        super(KeepAliveHTTPClient, self).close()
+
+        if self.reap_callback is not None:
+            self.reap_callback.stop()
+
+        self.statistics.stop()
+
+        for pool in self.pools.values():
+            pool.close()
+
+        self.tcp_client.close()
+
+    def fetch_impl(self, request, callback):
+        future = convert_yielded(self.__fetch__(request))
+        self.io_loop.add_future(future, lambda f: callback(f.result()))
+
+    async def __fetch__(self, request):
+        start_time = time.time()
+        started = self.io_loop.time()
+
+        parsed = parse.urlsplit(request.url)
+        scheme = parsed.scheme
+        port = parsed.port or (443 if scheme == "https" else 80)
+        host = "{0}:{1}".format(parsed.hostname, port)
+
+        pool = self.pools.get((scheme, host))
+        if pool is None:
+            pool = HostPool(self.max_connections, self.idle_timeout)
+            self.pools[(scheme, host)] = pool
+
+        statistics = self.statistics.get(host)
+        statistics.requests += 1
+
+        deadline = started + request.request_timeout if request.request_timeout else None
+        retry = request.method in KeepAliveHTTPClient.IDEMPOTENT_METHODS
+
+        try:
+            while True:
+                acquired = pool.acquire()
+
+                if not acquired.done():
+                    statistics.waited += 1
+
+                try:
+                    stream = await (with_timeout(deadline, acquired) if deadline else acquired)
+                except TimeoutError:
+                    pool.abandon(acquired)
+                    raise HTTPTimeoutError("Timeout in request queue")
+
+                reused = stream is not None
+
+                if reused:
+                    statistics.reused += 1
+                else:
+                    try:
+                        stream = await self.__connect__(scheme, parsed.hostname, port, request, deadline)
+                    except BaseException:
+                        pool.release(None)
+                        raise
+                    statistics.opened += 1
+
+                reader = ResponseReader()
+
+                try:
+                    keep_alive = await self.__send__(stream, request, parsed, reader, deadline)
+                except StreamClosedError as e:
+                    pool.discard(stream)
+                    if reused and retry and reader.code is None:
+                        retry = False
+                        statistics.retried += 1
+                        continue
+                    raise e.real_error or HTTPStreamClosedError("Stream closed")
+                except TimeoutError:
+                    pool.discard(stream)
+                    raise HTTPTimeoutError("Timeout during request")
+                except BaseException:
+                    pool.discard(stream)
+                    raise
+
+                if keep_alive:
+                    pool.release(stream)
+                else:
+                    pool.discard(stream)
+
+                return HTTPResponse(
+                    request, reader.code, reason=reader.reason, headers=reader.headers,
+                    buffer=BytesIO(b"".join(reader.chunks)), effective_url=request.url,
+                    request_time=self.io_loop.time() - started, start_time=start_time)
+
+        except HTTPError as e:
+            return HTTPResponse(
+                request, e.code, error=e, request_time=self.io_loop.time() - started, start_time=start_time)
+        except Exception as e:
+            return HTTPResponse(
+                request, 599, error=e, request_time=self.io_loop.time() - started, start_time=start_time)
+
+    async def __connect__(self, scheme, hostname, port, request, deadline):
+        timeout = self.io_loop.time() + request.connect_timeout if request.connect_timeout else None
+        if deadline is not None:
+            timeout = deadline if timeout is None else min(timeout, deadline)
+
+        try:
+            stream = await self.tcp_client.connect(
+                hostname, port,
+                ssl_options=KeepAliveHTTPClient.__ssl_options__(scheme, request),
+                max_buffer_size=self.max_buffer_size,
+                timeout=timeout)
+        except TimeoutError:
+            raise HTTPTimeoutError("Timeout while connecting")
+        except StreamClosedError as e:
+            raise e.real_error or HTTPStreamClosedError("Stream closed")
+
+        stream.set_nodelay(True)
+        return stream
+
+    async def __send__(self, stream, request, parsed, reader, deadline):
+        connection = HTTP1Connection(stream, True, HTTP1ConnectionParameters(
+            max_header_size=self.max_header_size,
+            max_body_size=self.max_body_size,
+            decompress=request.decompress_response))
+
+        headers = HTTPHeaders(request.headers)
+
+        if "Host" not in headers:
+            headers["Host"] = parsed.netloc.rpartition("@")[-1]
+        if request.user_agent:
+            headers["User-Agent"] = request.user_agent
+        if request.body is not None:
+            headers["Content-Length"] = str(len(request.body))
+        if request.method == "POST" and "Content-Type" not in headers:
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if request.decompress_response:
+            headers["Accept-Encoding"] = "gzip"
+
+        path = (parsed.path or "/") + (("?" + parsed.query) if parsed.query else "")
+
+        connection.write_headers(RequestStartLine(request.method, path, ""), headers)
+        if request.body is not None:
+            connection.write(request.body)
+        connection.finish()
+
+        response = connection.read_response(reader)
+        await (with_timeout(deadline, response, quiet_exceptions=StreamClosedError) if deadline else response)
+
+        if not reader.finished:
+            # the connection has been closed in the middle of the response
+            raise StreamClosedError()
+
+        return not stream.closed()
+
+    @staticmethod
+    def __ssl_options__(scheme, request):
+        if scheme != "https":
+            return None
+        if request.ssl_options is not None:
+            return request.ssl_options
+        if request.validate_cert and request.ca_certs is None and request.client_cert is None:
+            if KeepAliveHTTPClient.DEFAULT_SSL_CONTEXT is None:
+                KeepAliveHTTPClient.DEFAULT_SSL_CONTEXT = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+            return KeepAliveHTTPClient.DEFAULT_SSL_CONTEXT
+
+        ssl_ctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=request.ca_certs)
+        if not request.validate_cert:
+            ssl_ctx.check_hostname = False
+            ssl_ctx.verify_mode = ssl.CERT_NONE
+        if request.client_cert is not None:
+            ssl_ctx.load_cert_chain(request.client_cert, request.client_key)
+        return ssl_ctx
+
+    def __reap__(self):
+        for pool in self.pools.values():
+            pool.reap()
+
+    def __gauges__(self, host):
+        gauges = {"connections": 0, "idle": 0, "waiters": 0}
+        for (scheme, pool_host), pool in self.pools.items():
+            if pool_host == host:
+                for key, value in pool.gauges().items():
+                    gauges[key] += value
+        return gauges
+
+
+if CurlAsyncHTTPClient is not None:
+    class MeasuredCurlHTTPClient(CurlAsyncHTTPClient):
+        """
+        CurlAsyncHTTPClient that counts connection reuse per host, the way KeepAliveHTTPClient does.
+        libcurl keeps connections alive on its own (a connection cache shared by the <max_clients> handles).
+        """
+
+        def initialize(self, max_clients=32, name=None, report_period=60, defaults=None):
+            super(MeasuredCurlHTTPClient, self).initialize(max_clients=max_clients, defaults=defaults)
+            self.statistics = HTTPClientStatistics(name, report_period)
+
+        def close(self):
+            super(MeasuredCurlHTTPClient, self).close()
+            self.statistics.stop()
+
+        def _finish(self, curl, curl_error=None, curl_message=None):
+            parsed = parse.urlsplit(curl.info["request"].url)
+            port = parsed.port or (443 if parsed.scheme == "https" else 80)
+            statistics = self.statistics.get("{0}:{1}".format(parsed.hostname, port))
+
+            statistics.requests += 1
+            if not curl_error:
+                # a number of new connections the transfer had to open
+                if curl.getinfo(pycurl.NUM_CONNECTS):
+                    statistics.opened += 1
+                else:
+                    statistics.reused += 1
+
+            super(MeasuredCurlHTTPClient, self)._finish(curl, curl_error, curl_message)
+else:
+    MeasuredCurlHTTPClient = None
+
+
+def create_client(max_connections=32, idle_timeout=30, curl=False, name=None, report_period=60):
+    """
+    Creates a (non-shared) keep-alive HTTP client: a MeasuredCurlHTTPClient if <curl> is True
+        and pycurl is installed, a KeepAliveHTTPClient otherwise.
+    """
+
+    if curl:
+        if MeasuredCurlHTTPClient is not None:
+            return MeasuredCurlHTTPClient(
+                force_instance=True, max_clients=max_connections, name=name, report_period=report_period)
+
+        logging.warning("pycurl is not installed, falling back to KeepAliveHTTPClient")
+
+    return KeepAliveHTTPClient(
+        force_instance=True, max_connections=max_connections, idle_timeout=idle_timeout,
+        name=name, report_period=report_period)
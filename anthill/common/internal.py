@@ -5,6 +5,9 @@ from . import discover
 from . import singleton
 from . import rabbitrpc
 from . import jsonrpc
+from . import httpconn
+from . import latency
+from . import circuit
 from . import ElapsedTime
 
 from . options import options
@@ -24,7 +27,25 @@ class Internal(rabbitrpc.RabbitMQJsonRPC, metaclass=singleton.Singleton):
     def __init__(self):
         logging.info("Constructing new Internal instance")
 
-        self.client = tornado.httpclient.AsyncHTTPClient()
+        self.client = httpconn.create_client(
+            max_connections=options.internal_http_max_connections
+            if "internal_http_max_connections" in options else 32,
+            idle_timeout=options.internal_http_idle_timeout if "internal_http_idle_timeout" in options else 30,
+            curl=options.internal_http_curl if "internal_http_curl" in options else False,
+            name="internal")
+
+        self.adaptive_timeouts = options.internal_adaptive_timeouts \
+            if "internal_adaptive_timeouts" in options else True
+        self.hedging = options.internal_hedging if "internal_hedging" in options else True
+        self.latency = latency.LatencyTracker(name="internal")
+
+        self.circuits = circuit.CircuitBreakers(
+            name="internal",
+            reset_timeout=options.internal_circuit_reset_timeout if "internal_circuit_reset_timeout" in options else 10,
+            max_concurrent=options.internal_max_concurrent_requests
+            if "internal_max_concurrent_requests" in options else 256,
+            is_failure=Internal.__is_failure__
+        ) if (options.internal_circuit_breaker if "internal_circuit_breaker" in options else True) else None
 
         self.internal_locations = [
             ipaddress.ip_network(network, False)
@@ -34,7 +55,8 @@ class Internal(rabbitrpc.RabbitMQJsonRPC, metaclass=singleton.Singleton):
 
         super(Internal, self).__init__()
 
-    async def get(self, service, url, data, use_json=True, discover_service=True, timeout=20, network="internal"):
+    async def get(self, service, url, data, use_json=True, discover_service=True, timeout=None, network="internal",
+                  idempotent=True):
         """
         Requests a http GET page.
 
@@ -44,8 +66,11 @@ class Internal(rabbitrpc.RabbitMQJsonRPC, metaclass=singleton.Singleton):
         :param use_json: whenever should the result be converted to json or not
         :param discover_service: if True, <service> argument is a service ID,
             if False, <service> is just server location.
-        :param timeout: a request timeout in seconds
+        :param timeout: a request timeout in seconds. If not set, the timeout is derived from the latency
+            of the previous requests to the same url (see Internal.timeout), but is never more than 20 seconds
         :param network: a network to make request in. Default is internal network
+        :param idempotent: if True, a duplicate request may be sent if the response is late (see Internal.call),
+            if False, the timeout is always 20 seconds unless set
         :return: Requested data
         """
         if discover_service:
@@ -61,26 +86,29 @@ class Internal(rabbitrpc.RabbitMQJsonRPC, metaclass=singleton.Singleton):
 
         timer = ElapsedTime("get -> {0}@{1}".format(url, service))
 
-        try:
-            request = tornado.httpclient.HTTPRequest(
-                service_location + "/" + url + "?" + parse.urlencode(data),
-                method='GET',
-                request_timeout=timeout,
-                headers={
-                    "X-Api-Version": options.api_version
-                }
-            )
+        async def fetch(request_timeout):
+            try:
+                request = tornado.httpclient.HTTPRequest(
+                    service_location + "/" + url + "?" + parse.urlencode(data),
+                    method='GET',
+                    request_timeout=request_timeout,
+                    headers={
+                        "X-Api-Version": options.api_version
+                    }
+                )
 
-            result = await self.client.fetch(request)
+                return await self.client.fetch(request)
 
-        except tornado.httpclient.HTTPError as e:
-            message = e.response.body if hasattr(e.response, "body") else b""
-            raise InternalError(e.code, str(message, "utf-8"), e.response)
+            except tornado.httpclient.HTTPError as e:
+                message = e.response.body if hasattr(e.response, "body") else b""
+                raise InternalError(e.code, str(message, "utf-8"), e.response)
 
-        except socket.error as e:
-            logging.exception("get {0}: {1}".format(service, url))
-            raise InternalError(599, "Connection error: " + str(e), None)
+            except socket.error as e:
+                logging.exception("get {0}: {1}".format(service, url))
+                raise InternalError(599, "Connection error: " + str(e), None)
 
+        try:
+            result = await self.call(service, url, fetch, timeout, 20, idempotent)
         finally:
             logging.info(timer.done())
 
@@ -117,7 +145,7 @@ class Internal(rabbitrpc.RabbitMQJsonRPC, metaclass=singleton.Singleton):
         return content
 
     async def post(self, service, url, data, use_json=True, discover_service=True,
-             timeout=20, network="internal", return_headers=False):
+             timeout=None, network="internal", return_headers=False, idempotent=False):
         """
         Posts a http request to a certain service
 
@@ -127,9 +155,12 @@ class Internal(rabbitrpc.RabbitMQJsonRPC, metaclass=singleton.Singleton):
         :param use_json: whenever should the result be converted to json or not
         :param discover_service: if True, <service> argument is a service ID,
             if False, <service> is just server location.
-        :param timeout: a request timeout in seconds
+        :param timeout: a request timeout in seconds, 20 seconds if not set
         :param network: a network to make request in. Default is internal network
         :param return_headers: if True, a tuple (result, headers) instead of just result will be returned
+        :param idempotent: if True, a duplicate request may be sent if the response is late, and the timeout
+            (if not set) is derived from the latency of the previous requests to the same url, but is never more
+            than 20 seconds (see Internal.call)
         :return: Requested data
         """
         if discover_service:
@@ -145,55 +176,185 @@ class Internal(rabbitrpc.RabbitMQJsonRPC, metaclass=singleton.Singleton):
 
         timer = ElapsedTime("post -> {0}@{1}".format(url, service))
 
+        async def fetch(request_timeout):
+            try:
+                request = tornado.httpclient.HTTPRequest(
+                    service_location + "/" + url,
+                    method='POST',
+                    body=parse.urlencode(data),
+                    request_timeout=request_timeout,
+                    headers={
+                        "X-Api-Version": options.api_version
+                    })
+
+                return await self.client.fetch(request)
+
+            except tornado.httpclient.HTTPError as e:
+                raise InternalError(e.code, e.response.body if hasattr(e.response, "body") else "", e.response)
+
+            except socket.error as e:
+                raise InternalError(599, "Connection error: " + str(e), None)
+
         try:
-            request = tornado.httpclient.HTTPRequest(
-                service_location + "/" + url,
-                method='POST',
-                body=parse.urlencode(data),
-                request_timeout=timeout,
-                headers={
-                    "X-Api-Version": options.api_version
-                })
-
-            result = await self.client.fetch(request)
-
-        except tornado.httpclient.HTTPError as e:
-            raise InternalError(e.code, e.response.body if hasattr(e.response, "body") else "", e.response)
-
-        except socket.error as e:
-            raise InternalError(599, "Connection error: " + str(e), None)
+            result = await self.call(service, url, fetch, timeout, 20, idempotent)
         finally:
             logging.info(timer.done())
 
         return Internal.__parse_result__(result, use_json=use_json, return_headers=return_headers)
 
-    async def request(self, service, method, timeout=jsonrpc.JSONRPC_TIMEOUT, *args, **kwargs):
+    async def request(self, service, method, timeout=None, *args, **kwargs):
         """
         Makes a RabbitMQ RPC request to a certain service.
 
         :param service: Service ID the page is requested from
         :param method: Service Method to call (as described in internal handler)
         :param args, kwargs: Arguments to send to the method
-        :param timeout: A timeout
+        :param timeout: A timeout, jsonrpc.JSONRPC_TIMEOUT if not set
         
         :returns Request response from service from the other side
         :raises InternalError on either connection issues or the requested service responded so
         
         """
 
+        return await self.__request__(service, method, timeout, False, *args, **kwargs)
+
+    async def request_idempotent(self, service, method, timeout=None, *args, **kwargs):
+        """
+        Same as request, but for the methods that can be safely called twice: if the response is late,
+            a duplicate request is sent and the first response is taken, and if the timeout is not set, it's derived
+            from the latency of the previous requests to the same method, but is never more than
+            jsonrpc.JSONRPC_TIMEOUT (see Internal.call).
+        """
+
+        return await self.__request__(service, method, timeout, True, *args, **kwargs)
+
+    async def __request__(self, service, method, timeout, idempotent, *args, **kwargs):
         timer = ElapsedTime("request -> {0}@{1}".format(method, service))
 
-        try:
-            result = await self.send_mq_request(service, method, timeout, *args, **kwargs)
-        except jsonrpc.JsonRPCError as e:
-            raise InternalError(e.code, e.message, e.data)
-        except jsonrpc.JsonRPCTimeout:
-            raise InternalError(599, "Timed out for request {0}@{1}".format(method, service))
+        async def send(request_timeout):
+            try:
+                return await self.send_mq_request(service, method, request_timeout, *args, **kwargs)
+            except jsonrpc.JsonRPCError as e:
+                raise InternalError(e.code, e.message, e.data)
+            except jsonrpc.JsonRPCTimeout:
+                raise InternalError(599, "Timed out for request {0}@{1}".format(method, service))
+
+        result = await self.call(service, method, send, timeout, jsonrpc.JSONRPC_TIMEOUT, idempotent)
 
         logging.info(timer.done())
 
         return result
 
+    async def request_many(self, service, calls, timeout=None, idempotent=False, return_exceptions=False):
+        """
+        Makes a batch of RabbitMQ RPC requests to a certain service, in a single message.
+        The service processes them concurrently, and responds with a single message too.
+
+        :param service: Service ID the page is requested from
+        :param calls: a list of (method, params) tuples, params are either a dict of keyword arguments,
+            or a list of positional arguments to send to the method. At most jsonrpc.JSONRPC_MAX_BATCH of them.
+        :param timeout: A timeout for the whole batch (see Internal.request)
+        :param idempotent: if True, a duplicate batch may be sent if the response is late (see Internal.call)
+        :param return_exceptions: if True, the calls that failed have an InternalError in place of the result,
+            otherwise the first error is raised
+
+        :returns A list of results, in the order of <calls>
+        :raises InternalError on either connection issues or the requested service responded so
+
+        Usage:
+
+            profiles = await internal.request_many("profile", [
+                ("get_my_profile", {"gamespace_id": gamespace_id, "account_id": account_id})
+                for account_id in accounts
+            ])
+
+        """
+
+        if not calls:
+            return []
+
+        methods = set(method for method, params in calls)
+        batch_name = "batch:" + (methods.pop() if len(methods) == 1 else "*")
+
+        timer = ElapsedTime("request_many -> {0}x{1}@{2}".format(len(calls), batch_name, service))
+
+        async def send(request_timeout):
+            try:
+                return await self.send_mq_request_many(service, calls, request_timeout)
+            except jsonrpc.JsonRPCError as e:
+                raise InternalError(e.code, e.message, e.data)
+            except jsonrpc.JsonRPCTimeout:
+                raise InternalError(599, "Timed out for request {0}@{1}".format(batch_name, service))
+
+        futures = await self.call(service, batch_name, send, timeout, jsonrpc.JSONRPC_TIMEOUT, idempotent)
+
+        logging.info(timer.done())
+
+        results = []
+
+        for future in futures:
+            e = future.exception()
+            if e is None:
+                results.append(future.result())
+                continue
+
+            error = InternalError(e.code, e.message, e.data) if isinstance(e, jsonrpc.JsonRPCError) else \
+                InternalError(500, str(e))
+
+            if not return_exceptions:
+                raise error
+
+            results.append(error)
+
+        return results
+
+    def timeout(self, service, method, default):
+        """
+        A timeout for a call: a multiple of its 99th percentile latency, but no more than <default>
+            (see latency.LatencyTracker). Just <default> if the adaptive timeouts are disabled.
+        """
+
+        if not self.adaptive_timeouts:
+            return default
+
+        return self.latency.timeout(service, method, default)
+
+    async def call(self, service, method, call, timeout, default_timeout, idempotent=False):
+        """
+        Calls <call>(timeout), a coroutine function doing the actual request, while tracking its latency.
+
+        If the call is <idempotent>:
+            - if <timeout> is None, an adaptive one is used (see Internal.timeout);
+            - if the response is later than the 95th percentile latency of the call, a duplicate request
+              is sent and the first successful response is taken (unless hedging is disabled).
+
+        Otherwise, if <timeout> is None, <default_timeout> is used: a call with side effects that is cut short
+            cannot be simply retried, and would count against the service in the circuit breaker, so it's never
+            cut short just because it's slower than usual.
+
+        Calls to a service that keeps failing, or has too many calls in flight already, fail fast
+            with InternalError 503 (see circuit.CircuitBreaker).
+        """
+
+        if timeout is None:
+            timeout = self.timeout(service, method, default_timeout) if idempotent else default_timeout
+
+        def measured():
+            return self.latency.call(service, method, call, timeout, hedge=idempotent and self.hedging)
+
+        if self.circuits is None:
+            return await measured()
+
+        try:
+            return await self.circuits.call(service, measured)
+        except circuit.RejectedError as e:
+            raise InternalError(503, e.message)
+
+    @staticmethod
+    def __is_failure__(e):
+        # the service did respond to the ones below 500, so it's alive
+        return not isinstance(e, InternalError) or e.code >= 500
+
     async def rpc(self, service, method, *args, **kwargs):
         """
         Unlike 'request' method, sends a simple RabbitMQ message to a certain service (no response is ever returned)
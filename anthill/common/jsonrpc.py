@@ -1,12 +1,15 @@
 
-from tornado.gen import coroutine, Return, Future, with_timeout, TimeoutError
+from tornado.gen import coroutine, Return, Future, with_timeout, TimeoutError, multi
 
 import ujson
 import logging
+import asyncio
 import datetime
 
 
 JSONRPC_TIMEOUT = 10
+# maximum number of requests in a single batch
+JSONRPC_MAX_BATCH = 1000
 
 
 class JsonRPCFuture(Future):
@@ -15,6 +18,33 @@ class JsonRPCFuture(Future):
         self.msg_id = msg_id
 
 
+class JsonRPCBatchFuture(JsonRPCFuture):
+    """
+    Stands for a whole batch of requests (see JsonRPC.send_request_many): resolved once the batch of responses
+        is received. If it fails instead (say, the batch could not be delivered), all of the requests fail too,
+        and if it's cancelled, the requests that are not responded yet are cancelled as well.
+    """
+
+    def __init__(self, msg_id, futures):
+        super(JsonRPCBatchFuture, self).__init__(msg_id)
+        self.futures = futures
+        self.add_done_callback(JsonRPCBatchFuture.__done__)
+
+    @staticmethod
+    def __done__(batch):
+        if batch.cancelled():
+            for future in batch.futures:
+                future.cancel()
+            return
+
+        if batch.exception() is None:
+            return
+
+        for future in batch.futures:
+            if not future.done():
+                future.set_exception(batch.exception())
+
+
 class JsonRPC(object):
     """
     Asynchronous JSON-RPC protocol implementation. See http://www.jsonrpc.org/specification
@@ -90,17 +120,26 @@ class JsonRPC(object):
             return kwargs
         return None
 
-    async def __write_error__(self, context, code, message, data=None, msg_id=None):
+    @staticmethod
+    def __error__(code, message, data=None):
         JsonRPC.__log_error__(code, message, data)
 
-        to_write = {
+        return {
             "jsonrpc": "2.0",
             "error": JsonRPC.__serialize_error__(code, message, data)
         }
 
-        await self.write_object(context, to_write, id=msg_id)
+    async def __write_error__(self, context, code, message, data=None, msg_id=None):
+        await self.write_object(context, JsonRPC.__error__(code, message, data), id=msg_id)
 
     async def received(self, context, msg, **payload):
+        """
+        Processes an incoming message: a request, a notification, a response, or a batch (an array) of those.
+
+        Requests of a batch are processed concurrently, and responded with a single batch of responses
+            (notifications are not responded to). If the batch is a response to send_request_many,
+            the futures of all of its requests are resolved.
+        """
 
         try:
             msg = ujson.loads(msg)
@@ -108,19 +147,75 @@ class JsonRPC(object):
             await self.__write_error__(context, -32700, "Parse error")
             return
 
-        if "jsonrpc" not in msg:
-            await self.__write_error__(context, -32600, "Invalid Request", "No 'jsonrpc' field.")
+        if isinstance(msg, list):
+            await self.__received_batch__(context, msg, payload)
             return
 
-        if msg["jsonrpc"] != "2.0":
-            await self.__write_error__(context, -32600, "Bad version of 'jsonrpc': " + msg["jsonrpc"] + ".")
+        response = await self.__process__(context, msg, payload)
+
+        if response is not None:
+            data, msg_id = response
+            await self.write_object(context, data, id=msg_id)
+
+    async def __received_batch__(self, context, batch, payload):
+        batch_id = payload.get("id", None)
+
+        if not batch:
+            await self.__write_error__(context, -32600, "Invalid Request", "Empty batch.", batch_id)
+            return
+
+        if len(batch) > JSONRPC_MAX_BATCH:
+            await self.__write_error__(context, -32600, "Invalid Request", "Batch is too large.", batch_id)
+            return
+
+        logging.debug("Received a batch of {0}".format(len(batch)))
+
+        # the ids of the batch elements are in the elements themselves
+        responses = await multi([
+            self.__process__(context, msg, {})
+            for msg in batch
+        ])
+
+        if all(isinstance(msg, dict) and "method" not in msg and ("result" in msg or "error" in msg)
+               for msg in batch):
+            # a batch of responses, the requests of it are resolved already (and responses are not responded to)
+            future = self.handlers.get(batch_id, None) if batch_id is not None else None
+            if isinstance(future, JsonRPCBatchFuture) and not future.done():
+                future.set_result(None)
             return
 
+        to_write = []
+
+        for response in responses:
+            if response is not None:
+                data, msg_id = response
+                data["id"] = msg_id
+                to_write.append(data)
+
+        if to_write:
+            await self.write_object(context, to_write, id=batch_id)
+
+    async def __process__(self, context, msg, payload):
+        """
+        Processes a single message.
+        Returns a tuple (object to respond with, message id), or None if there is nothing to respond.
+        """
+
+        if not isinstance(msg, dict):
+            return JsonRPC.__error__(-32600, "Invalid Request", "Not an object."), None
+
+        if "jsonrpc" not in msg:
+            return JsonRPC.__error__(-32600, "Invalid Request", "No 'jsonrpc' field."), None
+
+        if msg["jsonrpc"] != "2.0":
+            return JsonRPC.__error__(-32600, "Bad version of 'jsonrpc': " + str(msg["jsonrpc"]) + "."), None
+
         msg.update(payload)
 
         logging.debug("Received: {0}".format(ujson.dumps(msg)))
 
-        has_id = "id" in msg
+        # errors to the messages that could not be parsed have null id, those are not responded to anyway
+        has_id = msg.get("id") is not None
         has_method = ("method" in msg) and msg["method"] is not None
         has_params = "params" in msg
         has_result = "result" in msg
@@ -139,42 +234,37 @@ class JsonRPC(object):
                 code, message, data = JsonRPC.__parse_error__(msg["error"])
             except JsonRPCError as e:
                 # ironically, error parsing may cause an error
-                await self.__write_error__(e.code, e.message, e.data)
-                return
+                return JsonRPC.__error__(e.code, e.message, e.data), None
             else:
                 error = JsonRPCError(code, message, data)
 
         if has_id and has_method:
             # a request
-            payload["id"] = msg_id
 
             args, kwargs = JsonRPC.__parse_params__(params)
             if self.on_receive:
                 try:
                     response = await self.on_receive(context, method, *args, **kwargs)
                 except JsonRPCError as e:
-                    await self.__write_error__(context, e.code, e.message, e.data, msg_id)
-                    return
+                    return JsonRPC.__error__(e.code, e.message, e.data), msg_id
                 else:
-                    await self.respond(context, response, **payload)
+                    return {
+                        "jsonrpc": "2.0",
+                        "result": response
+                    }, msg_id
             else:
-                await self.__write_error__(context, -32603,
-                                           "Internal error", "Receive handler is not assigned", msg_id)
-                return
+                return JsonRPC.__error__(-32603, "Internal error", "Receive handler is not assigned"), msg_id
         elif has_id:
             # a response
 
             if has_error == has_result:
-                await self.__write_error__(context, -32600,
-                                           "Invalid Request",
-                                           "Should be (only) one 'result' or 'error' field.")
-                return
+                return JsonRPC.__error__(
+                    -32600, "Invalid Request", "Should be (only) one 'result' or 'error' field."), None
 
             future = self.handlers.get(msg_id, None)
 
             if future is None:
-                await self.__write_error__(context, -32600, "Invalid Request", "Unknown message id")
-                return
+                return JsonRPC.__error__(-32600, "Invalid Request", "Unknown message id"), None
 
             if has_result:
                 # successful response
@@ -192,7 +282,9 @@ class JsonRPC(object):
         elif has_error:
             JsonRPC.__log_error__(error.code, error.message, error.data)
         else:
-            await self.__write_error__(context, -32600, "Invalid Request", "No 'method' nor 'id' field.")
+            return JsonRPC.__error__(-32600, "Invalid Request", "No 'method' nor 'id' field."), None
+
+        return None
 
     async def release(self):
         self.on_receive = None
@@ -223,6 +315,67 @@ class JsonRPC(object):
         else:
             return result
 
+    async def send_request_many(self, context, calls, timeout=JSONRPC_TIMEOUT):
+        """
+        Sends a batch of requests in a single message, and waits for all of the responses.
+
+        :param calls: a list of (method, params) tuples, where params are either a dict of keyword arguments,
+            or a list of positional ones (or None)
+        :param timeout: a timeout for the whole batch
+        :returns a list of resolved futures, in the order of <calls>
+        :raises JsonRPCTimeout if any of the responses has not arrived in time
+        """
+
+        if not calls:
+            # an empty batch is invalid, nothing is sent
+            return []
+
+        if len(calls) > JSONRPC_MAX_BATCH:
+            raise JsonRPCError(-32600, "Batch is too large")
+
+        data = []
+        futures = []
+
+        for method, params in calls:
+            msg_id = self.__get_next_id__()
+
+            request = {
+                "jsonrpc": "2.0",
+                "method": method,
+                "id": msg_id
+            }
+
+            if params:
+                request["params"] = params
+
+            future = JsonRPCFuture(msg_id)
+            self.handlers[msg_id] = future
+            future.add_done_callback(self.__request_future_done__)
+
+            data.append(request)
+            futures.append(future)
+
+        batch = JsonRPCBatchFuture(self.__get_next_id__(), futures)
+        self.handlers[batch.msg_id] = batch
+        batch.add_done_callback(self.__request_future_done__)
+
+        try:
+            # send it out
+            await self.write_object(context, data, id=batch.msg_id)
+
+            # and wait for the responses
+            done, pending = await asyncio.wait(futures, timeout=timeout)
+        finally:
+            # the requests that are not responded yet (if failed to send, timed out, or cancelled) are cancelled,
+            #   so they are not left in the handlers
+            if not batch.done():
+                batch.cancel()
+
+        if pending:
+            raise JsonRPCTimeout()
+
+        return futures
+
     async def respond(self, context, msg, **payload):
         await self.write_object(context, {
             "jsonrpc": "2.0",
@@ -247,7 +400,9 @@ class JsonRPC(object):
         raise NotImplementedError()
 
     async def write_object(self, context, data, **payload):
-        data.update(payload)
+        # a batch (a list) carries no payload of its own
+        if isinstance(data, dict):
+            data.update(payload)
         await self.write_data(context, ujson.dumps(data))
 
 
@@ -1,32 +1,679 @@
 
-from aioredis import ConnectionsPool, Redis
-from tornado.ioloop import IOLoop
+from aioredis import ConnectionsPool, Redis, ReplyError
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.gen import Future
+
+from contextlib import contextmanager
+import asyncio
+import bisect
+import hashlib
+import logging
+import time
+import weakref
+
+
+class PoolStatistics(object):
+    """
+    Usage statistics of a KeyValueStorage: connection acquire latency and per-command latency histograms.
+    Collected values are reported to the monitoring (along with the pool gauges) and reset periodically.
+    """
+
+    # upper bounds (in milliseconds) of the latency histogram buckets, the last bucket is everything above
+    LATENCY_BUCKETS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000]
+
+    def __init__(self):
+        self.last_used = time.time()
+        self.released_at = weakref.WeakKeyDictionary()
+        self.acquire_count = 0
+        self.acquire_time = 0.0
+        self.acquire_max = 0.0
+        self.commands = {}
+
+    def reset(self):
+        self.acquire_count = 0
+        self.acquire_time = 0.0
+        self.acquire_max = 0.0
+        self.commands = {}
+
+    def used(self):
+        self.last_used = time.time()
+
+    def released(self, connection):
+        self.released_at[connection] = time.time()
+
+    def idle_since(self, connection):
+        # the connections used right from the free pool (a pool with no AutoPipeline in sharded mode)
+        #   are never checked out, so only the storage as a whole tells when they were used
+        return self.released_at.get(connection, self.last_used)
+
+    def acquired(self, elapsed):
+        elapsed *= 1000.0
+        self.acquire_count += 1
+        self.acquire_time += elapsed
+        self.acquire_max = max(self.acquire_max, elapsed)
+
+    def command_done(self, command, elapsed):
+        elapsed *= 1000.0
+
+        histogram = self.commands.get(command)
+        if histogram is None:
+            histogram = {
+                "count": 0,
+                "total": 0.0,
+                "max": 0.0,
+                "buckets": [0] * (len(PoolStatistics.LATENCY_BUCKETS) + 1)
+            }
+            self.commands[command] = histogram
+
+        histogram["count"] += 1
+        histogram["total"] += elapsed
+        histogram["max"] = max(histogram["max"], elapsed)
+        histogram["buckets"][bisect.bisect_left(PoolStatistics.LATENCY_BUCKETS, elapsed)] += 1
+
+    def dump_commands(self):
+        result = {}
+
+        for command, histogram in self.commands.items():
+            values = {
+                "count": histogram["count"],
+                "avg": histogram["total"] / histogram["count"],
+                "max": histogram["max"]
+            }
+
+            for bound, count in zip(PoolStatistics.LATENCY_BUCKETS, histogram["buckets"]):
+                values["le_" + str(bound)] = count
+            values["le_inf"] = histogram["buckets"][-1]
+
+            result[command] = values
+
+        return result
+
+    def dump_acquire(self):
+        return {
+            "count": self.acquire_count,
+            "avg": (self.acquire_time / self.acquire_count) if self.acquire_count else 0.0,
+            "max": self.acquire_max
+        }
+
+    @staticmethod
+    def pool_gauges(pool):
+        # aioredis exposes no public counters for used connections and waiters
+        # noinspection PyProtectedMember
+        waiters = getattr(pool._cond, "_waiters", None) or ()
+        # noinspection PyProtectedMember
+        return {
+            "size": pool.size,
+            "free": pool.freesize,
+            "in_use": len(pool._used),
+            "waiters": len(waiters)
+        }
+
+
+class MeasuredExecutor(object):
+    """
+    Passes everything to the underlying connection (or AutoPipeline, or ShardedConnection),
+        but records latency of every command executed.
+    """
+
+    def __init__(self, executor, statistics):
+        self.executor = executor
+        self.statistics = statistics
+
+    def __getattr__(self, name):
+        return getattr(self.executor, name)
+
+    def execute(self, command, *args, **kwargs):
+        statistics = self.statistics
+        statistics.used()
+        started = time.time()
+
+        name = command.decode() if isinstance(command, bytes) else str(command)
+        result = asyncio.ensure_future(self.executor.execute(command, *args, **kwargs))
+        result.add_done_callback(lambda f: statistics.command_done(name.upper(), time.time() - started))
+        return result
 
 
 class Connection(object):
-    def __init__(self, pool):
+    def __init__(self, pool, statistics=None):
         self.pool = pool
+        self.statistics = statistics
 
     async def __aenter__(self):
+        if self.statistics is None:
+            self.connection = await self.pool.acquire()
+            return Redis(self.connection)
+
+        self.statistics.used()
+        started = time.time()
         self.connection = await self.pool.acquire()
-        return Redis(self.connection)
+        self.statistics.acquired(time.time() - started)
+
+        return Redis(MeasuredExecutor(self.connection, self.statistics))
 
     async def __aexit__(self, *exc_info):
         del exc_info
         if self.connection is not None:
+            if self.statistics is not None:
+                self.statistics.released(self.connection)
             self.pool.release(self.connection)
 
 
+class AutoPipelineError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class AutoPipeline(object):
+    """
+    Collects every command issued during the same IOLoop iteration and sends them as a single pipeline
+        on one shared connection, instead of checking out a connection (and doing a round trip) per command.
+
+    Each command gets its own future, resolved once the pipeline reply is received, so the callers
+        see no difference:
+
+        db = Redis(auto_pipeline)
+        a, b = await gather(db.get("a"), db.incr("b"))   # one write, one connection checkout
+
+    Explicit pipelines (db.pipeline()) simply join the current batch.
+    Blocking commands (BLPOP and such) would stall the whole batch, so they should not be used in this mode.
+
+    Transactions (db.multi_exec()) are queued MULTI to EXEC in one go, so they are sent together on one connection.
+        WATCH (and MULTI/EXEC issued one by one) would end up on whatever connection the next batch gets,
+        so those are rejected, use KeyValueStorage.acquire(dedicated=True) for them.
+    """
+
+    # commands that only make sense on the same connection as the ones issued later
+    CONNECTION_COMMANDS = {"WATCH", "UNWATCH", "MULTI", "EXEC", "DISCARD"}
+
+    # unless issued in one go, like MultiExec does
+    BUFFERED_COMMANDS = {"MULTI", "EXEC"}
+
+    def __init__(self, pool, statistics=None):
+        self.pool = pool
+        self.statistics = statistics
+        self.pending = []
+        self.scheduled = False
+        self.buffered = 0
+
+    @property
+    def db(self):
+        return self.pool.db
+
+    @property
+    def encoding(self):
+        return self.pool.encoding
+
+    @property
+    def address(self):
+        return self.pool.address
+
+    @property
+    def closed(self):
+        return self.pool.closed
+
+    @property
+    def in_transaction(self):
+        return False
+
+    @contextmanager
+    def _buffered(self):
+        # everything is buffered until the next IOLoop iteration anyway
+        self.buffered += 1
+        try:
+            yield self
+        finally:
+            self.buffered -= 1
+
+    def execute(self, command, *args, **kwargs):
+        name = command.decode() if isinstance(command, bytes) else str(command)
+        name = name.upper()
+
+        if name in AutoPipeline.CONNECTION_COMMANDS and not (
+                self.buffered and name in AutoPipeline.BUFFERED_COMMANDS):
+            raise AutoPipelineError("Command {0} is not supported in auto pipeline mode, "
+                                    "use a dedicated connection".format(name))
+
+        future = Future()
+        self.pending.append((future, command, args, kwargs))
+
+        if not self.scheduled:
+            self.scheduled = True
+            IOLoop.current().add_callback(self.__flush__)
+
+        return future
+
+    def execute_pubsub(self, command, *channels):
+        return self.pool.execute_pubsub(command, *channels)
+
+    @staticmethod
+    def __resolve__(future, result):
+        if future.done():
+            return
+        if result.cancelled():
+            future.cancel()
+        elif result.exception() is not None:
+            future.set_exception(result.exception())
+        else:
+            future.set_result(result.result())
+
+    async def __flush__(self):
+        self.scheduled = False
+        pending, self.pending = self.pending, []
+
+        if not pending:
+            return
+
+        started = time.time()
+
+        try:
+            connection = await self.pool.acquire()
+        except Exception as e:
+            logging.error("Failed to acquire a connection for a pipeline: {0}".format(str(e)))
+            for future, command, args, kwargs in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if self.statistics is not None:
+            self.statistics.acquired(time.time() - started)
+
+        try:
+            waiters = []
+
+            with connection._buffered():
+                for future, command, args, kwargs in pending:
+                    try:
+                        result = connection.execute(command, *args, **kwargs)
+                    except Exception as e:
+                        future.set_exception(e)
+                    else:
+                        result.add_done_callback(lambda r, f=future: AutoPipeline.__resolve__(f, r))
+                        waiters.append(result)
+
+            await asyncio.gather(*waiters, return_exceptions=True)
+        finally:
+            if self.statistics is not None:
+                self.statistics.released(connection)
+            self.pool.release(connection)
+
+
+class SharedConnection(object):
+    """
+    Same as Connection, but over an object that executes commands on its own (AutoPipeline, ShardedConnection),
+        so nothing is checked out of the pool.
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+
+    async def __aenter__(self):
+        return Redis(self.executor)
+
+    async def __aexit__(self, *exc_info):
+        del exc_info
+
+
+class ShardingError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class HashRing(object):
+    """
+    Consistent hash ring: a key is served by the first node clockwise from the key's hash, so adding or removing
+        a node only moves about 1/N of the keys.
+
+    Like in Redis Cluster, if a key contains a hash tag ("{...}"), only the tag is hashed, so keys like
+        "{gamespace:1}:apps" and "{gamespace:1}:info" always end up on the same node.
+    """
+
+    REPLICAS = 160
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        self.nodes = list(nodes)
+        self.ring = []
+
+        for node in self.nodes:
+            for replica in range(replicas):
+                self.ring.append((HashRing.hash("{0}-{1}".format(node, replica)), node))
+
+        self.ring.sort()
+        self.hashes = [h for h, node in self.ring]
+
+    @staticmethod
+    def hash(key):
+        if isinstance(key, str):
+            key = key.encode("utf-8")
+        elif not isinstance(key, bytes):
+            key = str(key).encode("utf-8")
+        return int.from_bytes(hashlib.md5(key).digest()[:8], "big")
+
+    @staticmethod
+    def hash_tag(key):
+        if isinstance(key, bytes):
+            start, end = key.find(b"{"), -1
+            if start >= 0:
+                end = key.find(b"}", start + 1)
+        else:
+            key = str(key)
+            start, end = key.find("{"), -1
+            if start >= 0:
+                end = key.find("}", start + 1)
+
+        # same as Redis Cluster, an empty tag "{}" does not count
+        if start >= 0 and end > start + 1:
+            return key[start + 1:end]
+
+        return key
+
+    def get_node(self, key):
+        index = bisect.bisect(self.hashes, HashRing.hash(HashRing.hash_tag(key)))
+        if index == len(self.hashes):
+            index = 0
+        return self.ring[index][1]
+
+
+class ShardedConnection(object):
+    """
+    Routes every command to a node of the HashRing by the command's key(s). Each node has its own
+        ConnectionsPool (or AutoPipeline on top of it).
+
+    Commands that touch several keys (MGET, DEL, RENAME, BLPOP, ZUNIONSTORE, EVAL with several keys etc) are only
+        allowed if all the keys belong to the same node (ShardingError is raised otherwise), use hash tags
+        to colocate them. Any other command is routed by its first argument. Transactions (MULTI/EXEC/WATCH) are not supported,
+        explicit pipelines are allowed, but the commands are sent to their nodes independently.
+    """
+
+    # commands where every argument is a key
+    ALL_KEYS_COMMANDS = {
+        "MGET", "DEL", "EXISTS", "UNLINK", "TOUCH", "SDIFF", "SINTER", "SUNION", "PFCOUNT",
+        "SDIFFSTORE", "SINTERSTORE", "SUNIONSTORE", "PFMERGE"
+    }
+
+    # commands where the first two arguments are keys
+    TWO_KEYS_COMMANDS = {"RENAME", "RENAMENX", "RPOPLPUSH", "BRPOPLPUSH", "SMOVE"}
+
+    # commands where every argument but the last one (a timeout) is a key
+    BLOCKING_KEYS_COMMANDS = {"BLPOP", "BRPOP", "BZPOPMIN", "BZPOPMAX"}
+
+    # commands where keys and values are interleaved
+    INTERLEAVED_KEYS_COMMANDS = {"MSET", "MSETNX"}
+
+    # commands with "numkeys" argument
+    SCRIPT_COMMANDS = {"EVAL", "EVALSHA"}
+
+    # commands with a destination key, followed by "numkeys" argument
+    STORE_KEYS_COMMANDS = {"ZUNIONSTORE", "ZINTERSTORE"}
+
+    # commands with a key, that may store the result into another key (STORE <key> option)
+    STORE_OPTION_COMMANDS = {"SORT", "GEORADIUS", "GEORADIUSBYMEMBER"}
+
+    # commands that do not have any key, but can be sent to every node (the first node's result is returned)
+    BROADCAST_COMMANDS = {"PING", "SCRIPT", "FLUSHDB", "FLUSHALL"}
+
+    UNSUPPORTED_COMMANDS = {"MULTI", "EXEC", "DISCARD", "WATCH", "UNWATCH", "KEYS", "SCAN", "RANDOMKEY"}
+
+    def __init__(self, ring, executors):
+        self.ring = ring
+        self.executors = executors
+
+    @property
+    def db(self):
+        return next(iter(self.executors.values())).db
+
+    @property
+    def encoding(self):
+        return next(iter(self.executors.values())).encoding
+
+    @property
+    def address(self):
+        return self.ring.nodes
+
+    @property
+    def closed(self):
+        return any(executor.closed for executor in self.executors.values())
+
+    @property
+    def in_transaction(self):
+        return False
+
+    @contextmanager
+    def _buffered(self):
+        yield self
+
+    @staticmethod
+    def __command_keys__(command, args):
+        if command in ShardedConnection.ALL_KEYS_COMMANDS:
+            return args
+        if command in ShardedConnection.TWO_KEYS_COMMANDS:
+            return args[:2]
+        if command in ShardedConnection.BLOCKING_KEYS_COMMANDS:
+            return args[:-1]
+        if command in ShardedConnection.INTERLEAVED_KEYS_COMMANDS:
+            return args[::2]
+        if command in ShardedConnection.SCRIPT_COMMANDS:
+            num_keys = int(args[1])
+            return args[2:2 + num_keys]
+        if command in ShardedConnection.STORE_KEYS_COMMANDS:
+            num_keys = int(args[1])
+            return args[:1] + args[2:2 + num_keys]
+        if command == "BITOP":
+            return args[1:]
+        if command in ("XREAD", "XREADGROUP"):
+            streams = ShardedConnection.__option_index__(args, "STREAMS")
+            if streams is None:
+                return ()
+            keys = args[streams + 1:]
+            return keys[:len(keys) // 2]
+        if command in ShardedConnection.STORE_OPTION_COMMANDS:
+            keys = args[:1]
+            for option in ("STORE", "STOREDIST"):
+                index = ShardedConnection.__option_index__(args, option)
+                if index is not None and index + 1 < len(args):
+                    keys += args[index + 1:index + 2]
+            return keys
+        if command in ShardedConnection.BROADCAST_COMMANDS:
+            return None
+        return args[:1]
+
+    @staticmethod
+    def __option_index__(args, option):
+        for index, arg in enumerate(args):
+            if isinstance(arg, (str, bytes)):
+                name = arg.decode() if isinstance(arg, bytes) else arg
+                if name.upper() == option:
+                    return index
+        return None
+
+    def get_node(self, command, args):
+        keys = ShardedConnection.__command_keys__(command, args)
+
+        if keys is None:
+            return None
+
+        if not keys:
+            raise ShardingError("Command {0} has no keys to route".format(command))
+
+        nodes = {self.ring.get_node(key) for key in keys}
+
+        if len(nodes) > 1:
+            raise ShardingError("Command {0} touches keys on different nodes, use hash tags".format(command))
+
+        return nodes.pop()
+
+    def execute(self, command, *args, **kwargs):
+        name = command.decode() if isinstance(command, bytes) else str(command)
+        name = name.upper()
+
+        if name in ShardedConnection.UNSUPPORTED_COMMANDS:
+            raise ShardingError("Command {0} is not supported in sharded mode".format(name))
+
+        node = self.get_node(name, args)
+
+        if node is None:
+            results = [
+                asyncio.ensure_future(executor.execute(command, *args, **kwargs))
+                for executor in self.executors.values()
+            ]
+            return asyncio.ensure_future(ShardedConnection.__first_result__(results))
+
+        return asyncio.ensure_future(self.executors[node].execute(command, *args, **kwargs))
+
+    @staticmethod
+    async def __first_result__(results):
+        results = await asyncio.gather(*results)
+        return results[0]
+
+    def execute_pubsub(self, command, *channels):
+        return self.executors[self.ring.nodes[0]].execute_pubsub(command, *channels)
+
+
+class Script(object):
+    """
+    A Lua script, called with EVALSHA. If the script is not loaded on the server yet (NOSCRIPT),
+        it's sent with EVAL once, and the server caches it since.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.sha = hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+    async def __call__(self, db, keys, args):
+        try:
+            return await db.evalsha(self.sha, keys=keys, args=args)
+        except ReplyError as e:
+            if not str(e).startswith("NOSCRIPT"):
+                raise
+            return await db.eval(self.source, keys=keys, args=args)
+
+
 class KeyValueStorage(object):
-    def __init__(self, host='localhost', port=6379, db=0, max_connections=500, **kwargs):
+    def __init__(self, host='localhost', port=6379, db=0, max_connections=500, auto_pipeline=False,
+                 nodes=None, min_connections=1, idle_timeout=0, name=None, report_period=60, **kwargs):
+        """
+        :param auto_pipeline: if True, commands issued by concurrent coroutines in the same IOLoop iteration
+            are sent as one pipeline on a shared connection (see AutoPipeline)
+        :param nodes: a list of "host:port" locations. If more than one is passed, the keys are spread
+            across the nodes with consistent hashing (see HashRing and ShardedConnection), and
+            <host> and <port> are ignored
+        :param min_connections: a number of connections each pool keeps open. Connections are opened lazily,
+            upon first use, so with 0 an unused storage holds no sockets at all
+        :param idle_timeout: if set, free connections above <min_connections> are closed once they have not
+            been used for that many seconds
+        :param name: if set, pool gauges and command latencies are reported to the monitoring
+            as keyvalue.pool, keyvalue.acquire and keyvalue.command actions, tagged with storage=<name>
+        :param report_period: how often (in seconds) the statistics are reported
+        """
+
+        if not nodes:
+            nodes = ["{0}:{1}".format(host, port)]
+
+        self.name = name
+        self.idle_timeout = idle_timeout
+        self.statistics = PoolStatistics() if (name or idle_timeout) else None
+
+        self.connection_pools = {
+            node: ConnectionsPool(
+                "redis://{0}".format(node),
+                db=db, minsize=min_connections, maxsize=max_connections,
+                loop=IOLoop.current().asyncio_loop
+            )
+            for node in nodes
+        }
+
+        if len(nodes) > 1:
+            self.connection_pool = None
+            self.auto_pipeline = None
+            self.sharded = ShardedConnection(HashRing(nodes), {
+                node: AutoPipeline(pool, self.statistics) if auto_pipeline else pool
+                for node, pool in self.connection_pools.items()
+            })
+        else:
+            self.connection_pool = self.connection_pools[nodes[0]]
+            self.auto_pipeline = AutoPipeline(self.connection_pool, self.statistics) if auto_pipeline else None
+            self.sharded = None
+
+        if self.statistics is not None:
+            if self.sharded is not None:
+                self.sharded = MeasuredExecutor(self.sharded, self.statistics)
+            if self.auto_pipeline is not None:
+                self.auto_pipeline = MeasuredExecutor(self.auto_pipeline, self.statistics)
+
+        if name:
+            self.report_callback = PeriodicCallback(self.__report__, report_period * 1000)
+            self.report_callback.start()
+        else:
+            self.report_callback = None
+
+        if idle_timeout:
+            self.reap_callback = PeriodicCallback(self.__reap__, idle_timeout * 1000)
+            self.reap_callback.start()
+        else:
+            self.reap_callback = None
+
+    def __report__(self):
+        from . import monitoring
+
+        for node, pool in self.connection_pools.items():
+            monitoring.monitor_action("keyvalue.pool", PoolStatistics.pool_gauges(pool), storage=self.name, node=node)
+
+        monitoring.monitor_action("keyvalue.acquire", self.statistics.dump_acquire(), storage=self.name)
 
-        self.connection_pool = ConnectionsPool(
-            "redis://{0}:{1}".format(host, port),
-            db=db, minsize=1, maxsize=max_connections,
-            loop=IOLoop.current().asyncio_loop
-        )
+        for command, values in self.statistics.dump_commands().items():
+            monitoring.monitor_action("keyvalue.command", values, storage=self.name, command=command)
 
-    def acquire(self):
+        self.statistics.reset()
+
+    def __reap__(self):
+        IOLoop.current().spawn_callback(self.reap)
+
+    async def reap(self):
+        """
+        Closes the free connections (above <min_connections>) that have not been used for <idle_timeout> seconds
+        """
+
+        deadline = time.time() - self.idle_timeout
+
+        for pool in self.connection_pools.values():
+            # free connections are acquired in the order they were released, so the least recently used one
+            #   comes first, and once a recently used one comes, the rest are recent too
+            while pool.freesize > pool.minsize and not pool.closed:
+                connection = await pool.acquire()
+
+                if self.statistics.idle_since(connection) > deadline:
+                    pool.release(connection)
+                    break
+
+                connection.close()
+                await connection.wait_closed()
+                pool.release(connection)
+
+    def stop(self):
+        if self.report_callback is not None:
+            self.report_callback.stop()
+        if self.reap_callback is not None:
+            self.reap_callback.stop()
+
+    async def close(self):
+        """
+        Stops the periodic callbacks and closes every connection of the storage
+        """
+
+        self.stop()
+
+        for pool in self.connection_pools.values():
+            pool.close()
+
+        for pool in self.connection_pools.values():
+            await pool.wait_closed()
+
+    def acquire(self, dedicated=False):
         """
         Acquires a connection from connection pool
 
@@ -34,9 +681,18 @@ class KeyValueStorage(object):
             async with kv.acquire() as db:
                 await db.set("test", "value")
                 test = await db.get("test")
+
+        :param dedicated: if True, a connection is checked out of the pool even in auto pipeline mode,
+            for the commands that need to stay on one connection (WATCH and such)
         """
 
+        if self.sharded is not None:
+            return SharedConnection(self.sharded)
+
         if self.connection_pool is None:
             raise Exception("Connection pool is not created yet")
 
-        return Connection(self.connection_pool)
+        if self.auto_pipeline is not None and not dedicated:
+            return SharedConnection(self.auto_pipeline)
+
+        return Connection(self.connection_pool, self.statistics)
@@ -0,0 +1,201 @@
+
+from tornado.gen import TimeoutError, convert_yielded, with_timeout
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from collections import OrderedDict, deque
+import asyncio
+import datetime
+import math
+
+
+class LatencyWindow(object):
+    """
+    The last <size> latencies (in seconds) of a single call. Percentiles are taken from a sorted copy
+        of the window, that is cached until <refresh> more samples are added.
+    """
+
+    def __init__(self, size=500, refresh=50):
+        self.samples = deque(maxlen=size)
+        self.refresh = refresh
+        self.added = 0
+        self.sorted = None
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, latency):
+        self.samples.append(latency)
+        self.added += 1
+
+        if self.sorted is not None and self.added >= self.refresh:
+            self.sorted = None
+
+    def percentile(self, percent):
+        if not self.samples:
+            return None
+
+        if self.sorted is None:
+            self.sorted = sorted(self.samples)
+            self.added = 0
+
+        index = int(math.ceil(len(self.sorted) * percent / 100.0)) - 1
+        return self.sorted[min(max(index, 0), len(self.sorted) - 1)]
+
+
+class LatencyTracker(object):
+    """
+    Tracks latencies of calls, per (service, method), and derives from them:
+
+        - adaptive timeouts: the <timeout_percentile> latency multiplied by <timeout_factor>,
+          but no less than <min_timeout> and no more than the default timeout;
+        - hedging delays: if the call has not finished in the <hedge_percentile> latency,
+          a duplicate one is sent and the first successful response is taken (see call).
+
+    Until a call has <min_samples> samples, the default timeout is used and no duplicates are sent.
+    Calls that time out are counted in as taking the whole timeout, so the timeout grows back
+        once the service slows down.
+    Only the <max_calls> most recently used calls are tracked.
+
+    If <name> is set, the percentiles and the number of duplicates sent (and won) are reported
+        to the monitoring every <report_period> seconds as "<name>.latency" action.
+    """
+
+    def __init__(self, window=500, min_samples=50, timeout_percentile=99, timeout_factor=2.0, min_timeout=0.5,
+                 hedge_percentile=95, max_calls=256, name=None, report_period=60):
+
+        self.window_size = window
+        self.min_samples = min_samples
+        self.timeout_percentile = timeout_percentile
+        self.timeout_factor = timeout_factor
+        self.min_timeout = min_timeout
+        self.hedge_percentile = hedge_percentile
+        self.max_calls = max_calls
+        self.windows = OrderedDict()
+        self.name = name
+
+        if name and report_period:
+            self.report_callback = PeriodicCallback(self.__report__, report_period * 1000)
+            self.report_callback.start()
+        else:
+            self.report_callback = None
+
+    def window(self, service, method):
+        key = (service, method)
+        window = self.windows.get(key)
+
+        if window is None:
+            window = LatencyWindow(self.window_size)
+            self.windows[key] = window
+
+            if len(self.windows) > self.max_calls:
+                self.windows.popitem(last=False)
+        else:
+            self.windows.move_to_end(key)
+
+        return window
+
+    def record(self, service, method, latency):
+        self.window(service, method).add(latency)
+
+    def timeout(self, service, method, default):
+        window = self.window(service, method)
+
+        if len(window) < self.min_samples:
+            return default
+
+        adaptive = window.percentile(self.timeout_percentile) * self.timeout_factor
+        return min(max(adaptive, self.min_timeout), default)
+
+    def hedge_delay(self, service, method, timeout):
+        window = self.window(service, method)
+
+        if len(window) < self.min_samples:
+            return None
+
+        delay = window.percentile(self.hedge_percentile)
+        return delay if delay < timeout else None
+
+    async def call(self, service, method, call, timeout, hedge=False):
+        """
+        Calls <call>(timeout), a coroutine function, and records how long it took.
+
+        If <hedge> is True (the call should be idempotent for that) and the call did not finish within
+            the hedging delay, a duplicate call(<remaining timeout>) is sent. The first one to succeed wins,
+            the other one is left to finish on its own. If both fail, the error of the first one is raised.
+        """
+
+        delay = self.hedge_delay(service, method, timeout) if hedge else None
+        first = convert_yielded(self.__measure__(service, method, call, timeout))
+
+        if delay is None:
+            return await first
+
+        try:
+            # the first call is still awaited below, if it fails later it's not an error to log
+            return await with_timeout(datetime.timedelta(seconds=delay), first, quiet_exceptions=Exception)
+        except TimeoutError:
+            pass
+
+        window = self.window(service, method)
+        window.hedged += 1
+
+        second = convert_yielded(self.__measure__(service, method, call, timeout - delay))
+        pending = {first, second}
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        window.hedge_wins += 1
+                    for other in pending:
+                        other.add_done_callback(LatencyTracker.__ignore__)
+                    return future.result()
+
+        return first.result()
+
+    async def __measure__(self, service, method, call, timeout):
+        started = IOLoop.current().time()
+
+        try:
+            result = await call(timeout)
+        except Exception:
+            elapsed = IOLoop.current().time() - started
+            # only the timed out ones count, a call that failed fast tells nothing about the latency
+            if elapsed >= timeout:
+                self.record(service, method, timeout)
+            raise
+
+        self.record(service, method, IOLoop.current().time() - started)
+        return result
+
+    @staticmethod
+    def __ignore__(future):
+        # retrieve the exception of a lost call, so it is not logged as never retrieved
+        if not future.cancelled():
+            future.exception()
+
+    def __report__(self):
+        from . import monitoring
+
+        for (service, method), window in list(self.windows.items()):
+            if len(window) < self.min_samples:
+                continue
+
+            monitoring.monitor_action(self.name + ".latency", {
+                "p50": window.percentile(50) * 1000.0,
+                "p95": window.percentile(95) * 1000.0,
+                "p99": window.percentile(99) * 1000.0,
+                "hedged": window.hedged,
+                "hedge_wins": window.hedge_wins
+            }, service=service, method=method)
+
+            window.hedged = 0
+            window.hedge_wins = 0
+
+    def stop(self):
+        if self.report_callback is not None:
+            self.report_callback.stop()
@@ -1,7 +1,7 @@
 
 from tornado.gen import Task
 
-from . import cached
+from . import cached, cache_key, invalidate_cache
 from . validate import validate
 from . internal import Internal, InternalError
 
@@ -30,6 +30,7 @@ class LoginClientError(Exception):
 
 
 class LoginClient(object, metaclass=singleton.Singleton):
+    CACHE_NAMESPACE = "login"
 
     def __init__(self, cache):
         self.cache = cache
@@ -43,12 +44,31 @@ class LoginClient(object, metaclass=singleton.Singleton):
         """
 
         async with self.cache.acquire() as db:
-            await db.set("gamespace_info:" + gamespace_name, ujson.dumps(gamespace_info.dump()))
+            key = await cache_key(
+                db, "gamespace_info:" + gamespace_name,
+                namespace=LoginClient.CACHE_NAMESPACE,
+                tags=["gamespace_name:" + gamespace_name])
+            await db.set(key, ujson.dumps(gamespace_info.dump()))
+
+    async def invalidate(self, gamespace_name=None):
+        """
+        Drops cached information about the gamespace <gamespace_name>, or everything cached if it's None
+
+        The gamespace information is looked up by name, so it's tagged with "gamespace_name:<name>",
+            while "gamespace:<id>" tags are for the things cached by the gamespace id (see social).
+        """
+
+        if gamespace_name is None:
+            await invalidate_cache(self.cache, namespace=LoginClient.CACHE_NAMESPACE)
+        else:
+            await invalidate_cache(self.cache, tags=["gamespace_name:" + gamespace_name])
 
     async def find_gamespace(self, gamespace_name):
 
         @cached(kv=self.cache,
                 h=lambda: "gamespace_info:" + gamespace_name,
+                namespace=LoginClient.CACHE_NAMESPACE,
+                tags=lambda: ["gamespace_name:" + gamespace_name],
                 ttl=300,
                 json=True)
         async def get():
@@ -73,6 +93,7 @@ class LoginClient(object, metaclass=singleton.Singleton):
     async def get_gamespaces(self):
         @cached(kv=self.cache,
                 h=lambda: "gamespaces_list",
+                namespace=LoginClient.CACHE_NAMESPACE,
                 ttl=30,
                 json=True)
         async def get():
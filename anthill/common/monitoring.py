@@ -20,6 +20,35 @@ class MonitoringRate(object):
         self.tags = tags
 
 
+def monitor_action(action_name, values, **tags):
+    """
+    Same as Server.monitor_action, but for the places that have no reference to the application
+        (key/value storages, rate limits, internal calls). Does nothing if monitoring is not enabled.
+    """
+    from .server import Server
+
+    application = Server.instance()
+    if application is None or getattr(application, "monitoring", None) is None or \
+            getattr(application, "name", None) is None:
+        return
+
+    application.monitor_action(action_name, values, **tags)
+
+
+def monitor_rate(action_name, name_property, **tags):
+    """
+    Same as Server.monitor_rate, but for the places that have no reference to the application.
+    """
+    from .server import Server
+
+    application = Server.instance()
+    if application is None or getattr(application, "monitoring", None) is None or \
+            getattr(application, "name", None) is None:
+        return
+
+    application.monitor_rate(action_name, name_property, **tags)
+
+
 class Monitoring(object):
     def __init__(self):
         pass
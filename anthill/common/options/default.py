@@ -34,6 +34,56 @@ define("internal_channel_prefetch_count",
        group="internal",
        type=int)
 
+define("internal_http_max_connections",
+       default=32,
+       help="Maximum keep-alive connections per service for internal HTTP requests (Internal.get/post).",
+       group="internal",
+       type=int)
+
+define("internal_http_idle_timeout",
+       default=30,
+       help="Idle internal HTTP connections are closed after that many seconds.",
+       group="internal",
+       type=int)
+
+define("internal_http_curl",
+       default=False,
+       help="Use libcurl (pycurl) for internal HTTP requests instead of the built-in keep-alive client.",
+       group="internal",
+       type=bool)
+
+define("internal_adaptive_timeouts",
+       default=True,
+       help="Derive timeouts of idempotent internal requests from their 99th percentile latency, "
+            "unless set explicitly.",
+       group="internal",
+       type=bool)
+
+define("internal_hedging",
+       default=True,
+       help="Send a duplicate of an idempotent internal request if the response is later than "
+            "the 95th percentile latency, and take the first response.",
+       group="internal",
+       type=bool)
+
+define("internal_circuit_breaker",
+       default=True,
+       help="Fail internal requests to a service fast (with 503) while most of the recent ones have failed.",
+       group="internal",
+       type=bool)
+
+define("internal_circuit_reset_timeout",
+       default=10,
+       help="How long (in seconds) requests to a failing service fail fast, before a trial one is let through.",
+       group="internal",
+       type=int)
+
+define("internal_max_concurrent_requests",
+       default=256,
+       help="Maximum internal requests in flight to a single service, the ones above that fail with 503.",
+       group="internal",
+       type=int)
+
 # Token cache
 
 define("token_cache_host",
@@ -60,6 +110,27 @@ define("token_cache_max_connections",
        group="token_cache",
        type=int)
 
+define("token_cache_min_connections",
+       default=1,
+       help="Minimum connections to the token cache to keep open (0 means no idle connections are kept).",
+       group="token_cache",
+       type=int)
+
+define("token_cache_idle_timeout",
+       default=0,
+       help="Close free connections to the token cache above token_cache_min_connections after that many "
+            "seconds of inactivity (0 to disable).",
+       group="token_cache",
+       type=int)
+
+define("token_cache_nodes",
+       default=[],
+       help="Locations (host:port) of the access token cache nodes (redis). If more than one is passed, "
+            "the keys are sharded across them and token_cache_host/token_cache_port are ignored.",
+       group="token_cache",
+       multiple=True,
+       type=str)
+
 # Discovery
 
 define("discovery_service",
@@ -120,6 +191,32 @@ define("monitoring_password",
        group="monitoring",
        type=str)
 
+# Validation
+
+define("json_max_size",
+       default=1048576,
+       help="Maximum length of a JSON string accepted by the validators.",
+       group="validate",
+       type=int)
+
+define("json_max_depth",
+       default=32,
+       help="Maximum depth of nesting of a JSON object accepted by the validators.",
+       group="validate",
+       type=int)
+
+define("json_max_elements",
+       default=100000,
+       help="Maximum number of values (including nested ones) of a JSON object accepted by the validators.",
+       group="validate",
+       type=int)
+
+define("json_max_string",
+       default=65536,
+       help="Maximum length of a string (or a key) of a JSON object accepted by the validators.",
+       group="validate",
+       type=int)
+
 # Static content
 
 define("serve_static",
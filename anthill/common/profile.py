@@ -1,5 +1,27 @@
 
+from . import keyvalue
+
 from abc import ABCMeta, abstractmethod
+from tornado.gen import sleep, Future
+from tornado.ioloop import PeriodicCallback, IOLoop
+from expiringdict import ExpiringDict
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+
+import heapq
+import logging
+import operator
+import os
+import random
+import time
+import ujson
+import zlib
+
+try:
+    # optional, speeds up the top_child_where function on large objects
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class FuncError(Exception):
@@ -189,10 +211,55 @@ class Functions(object):
         if object_value:
             if not isinstance(object_value, list):
                 raise FuncError("Object is not a list")
+            # the original list is shared with the old profile
+            object_value = object_value + [value]
         else:
-            object_value = []
+            object_value = [value]
+
+        limit = arguments.get("@limit", None)
+        if limit:
+            if not isinstance(limit, (int, float)):
+                raise FuncError("@limit is not a number")
+            if len(object_value) > limit:
+                if arguments.get("@shift", False):
+                    object_value = object_value[-limit:]
+                else:
+                    raise FuncError("limit_exceeded")
+
+        return True, object_value
+
+    @staticmethod
+    def func_array_extend(field_name, object_value, arguments, **ignored):
+        """
+        Function that appends several objects into the end of the array (list), same as array_append does
+            for each of them
 
-        object_value.append(value)
+        Arguments:
+            @values: A list of valid JSON objects to add
+            @limit: (Optional) A maximum size of the array. If the limit is reached, 'limit_exceeded' is raised.
+            @shift: (Optional) If true, and limit is reached, the first elements will be deleted to free space
+
+        Example value:
+        {"a": ["test1", "test2", "test3"]}
+
+        Example updates
+        {"a": { "@func": "array_extend", "@values": [5, 6] }} -> {"a": ["test1", "test2", "test3", 5, 6]}
+        {"a": { "@func": "array_extend", "@values": [5, 6], "@limit": 3, "@shift": true }} -> {"a": ["test3", 5, 6]}
+
+        """
+
+        values = arguments.get("@values", None)
+        if not values:
+            raise FuncError("@values is not defined")
+        if not isinstance(values, list):
+            raise FuncError("@values is not a list")
+
+        if object_value:
+            if not isinstance(object_value, list):
+                raise FuncError("Object is not a list")
+            object_value = object_value + values
+        else:
+            object_value = list(values)
 
         limit = arguments.get("@limit", None)
         if limit:
@@ -284,29 +351,168 @@ class Functions(object):
         if field_name is None:
             raise FuncError("@field is not defined")
 
+        test = Functions.child_predicate(func_name, field_name, arguments)
+
+        if isinstance(object_value, dict):
+            children = object_value.values()
+        elif isinstance(object_value, list):
+            children = object_value
+        else:
+            raise FuncError("Object is neither dict or list")
+
+        return True, sum(1 for child in children if isinstance(child, dict) and test(child.get(field_name)))
+
+    @staticmethod
+    def func_sum_child_where(field_name, object_value, arguments):
+        """
+        Function that returns a sum of a field of child objects (that assumes that the object in question is a dict
+            or a list of dicts), optionally of these that pass some criteria.
+
+        Arguments:
+            @field: Field name of child objects to sum up, children with no such numeric field are skipped
+            @test: (Optional) Conditional function to test child object's fields upon
+            @where: (Optional) Field name of child objects to test, @field by default
+            ... others are passed to Conditional function
+
+        For example, say you have this object:
+        {"members": {"a": {"gold": 20, "level": 2}, "b": {"gold": 10, "level": 5}, "c": {"gold": 5, "level": 7}}}
+
+        Total gold of members of level 5 and above:
+
+        {
+            "members": {"@func": "sum_child_where", "@field": "gold", "@test": ">=", "@where": "level", "@cond": 5}
+        }
+
+        """
+        keys, values = Functions.__child_values__(object_value, arguments)
+        return True, sum(values)
+
+    @staticmethod
+    def func_min_child_where(field_name, object_value, arguments):
+        """
+        Same as sum_child_where, but returns the smallest value, or None if there is no such children.
+        """
+        keys, values = Functions.__child_values__(object_value, arguments)
+        return True, min(values) if values else None
+
+    @staticmethod
+    def func_max_child_where(field_name, object_value, arguments):
+        """
+        Same as sum_child_where, but returns the greatest value, or None if there is no such children.
+        """
+        keys, values = Functions.__child_values__(object_value, arguments)
+        return True, max(values) if values else None
+
+    @staticmethod
+    def func_top_child_where(field_name, object_value, arguments):
+        """
+        Same as sum_child_where, but returns keys (or indexes, in case of list) of the children with the greatest
+            values, the greatest first. Of the children with equal values, the first one goes first.
+
+        Additional arguments:
+            @count: (Optional) Number of keys to return, 10 by default
+        """
+        count = arguments.get("@count", 10)
+
+        if not isinstance(count, int) or count <= 0:
+            raise FuncError("@count should be a positive number")
+
+        keys, values = Functions.__child_values__(object_value, arguments)
+
+        if count >= len(values):
+            order = sorted(range(len(values)), key=values.__getitem__, reverse=True)
+        elif numpy is not None and len(values) >= Functions.NUMPY_MIN_CHILDREN:
+            array = numpy.array(values)
+            # the count-th greatest value, anything greater or equal is a candidate
+            threshold = numpy.partition(array, len(values) - count)[len(values) - count]
+            candidates = numpy.flatnonzero(array >= threshold).tolist()
+            order = sorted(candidates, key=values.__getitem__, reverse=True)[:count]
+        else:
+            order = heapq.nlargest(count, range(len(values)), key=values.__getitem__)
+
+        return True, [keys[index] for index in order]
+
+    @staticmethod
+    def child_predicate(func_name, field_name, arguments):
+        """
+        Resolves the conditional function <func_name> into a predicate of a child's value, once for all children.
+            Simple conditions (no @value, @then or @else) become plain comparisons, the rest are tested by calling
+            the function itself.
+        """
         f = Functions.FUNCTIONS.get(func_name)
         if f is None:
             raise FuncError("No such function: " + str(func_name))
 
-        def check(child):
-            if isinstance(child, dict):
-                child_value = child.get(field_name, None)
-                try:
-                    # return values are ignored
-                    f.__func__(field_name, child_value, arguments)
-                except FuncError:
-                    return False
-                else:
-                    return True
-            return False
+        if not (arguments.get("@value") or arguments.get("@then") or arguments.get("@else")):
+            condition = arguments.get("@cond", None)
+
+            if func_name == "exists":
+                return lambda value: value is not None
+            if func_name == "not_exists":
+                return lambda value: value is None
+
+            if func_name in Functions.CHILD_PREDICATES:
+                if not condition:
+                    # every child fails with '@cond is not defined'
+                    return lambda value: False
+
+                if func_name == "==":
+                    return lambda value: value == condition
+                if func_name == "!=":
+                    return lambda value: value != condition
+
+                if isinstance(condition, (int, float)):
+                    compare = Functions.CHILD_PREDICATES[func_name]
+                    return lambda value: (value is None or isinstance(value, (int, float))) and \
+                        compare(value or 0, condition)
+
+        f = f.__func__
+
+        def check(value):
+            try:
+                # return values are ignored
+                f(field_name, value, arguments)
+            except FuncError:
+                return False
+            else:
+                return True
+
+        return check
+
+    @staticmethod
+    def __child_values__(object_value, arguments):
+        field_name = arguments.get("@field")
+        if field_name is None:
+            raise FuncError("@field is not defined")
+
+        func_name = arguments.get("@test")
+        where = arguments.get("@where", field_name)
+        test = Functions.child_predicate(func_name, where, arguments) if func_name is not None else None
 
         if isinstance(object_value, dict):
-            return True, sum(1 for item in object_value.values() if check(item))
+            children = object_value.items()
         elif isinstance(object_value, list):
-            return True, sum(1 for item in object_value if check(item))
+            children = enumerate(object_value)
         else:
             raise FuncError("Object is neither dict or list")
 
+        keys = []
+        values = []
+
+        for key, child in children:
+            if not isinstance(child, dict):
+                continue
+            value = child.get(field_name)
+            # bool is not a number here
+            if value.__class__ is not int and value.__class__ is not float:
+                continue
+            if test is not None and not test(child.get(where)):
+                continue
+            keys.append(key)
+            values.append(value)
+
+        return keys, values
+
     @staticmethod
     def func_greater_equal_than(field_name, object_value, arguments):
         """
@@ -559,6 +765,19 @@ class Functions(object):
 
         return False, None
 
+    # conditional functions that can be resolved into plain predicates (see child_predicate)
+    CHILD_PREDICATES = {
+        "==": operator.eq,
+        "!=": operator.ne,
+        ">": operator.gt,
+        ">=": operator.ge,
+        "<": operator.lt,
+        "<=": operator.le
+    }
+
+    # below that, NumPy is slower than heapq
+    NUMPY_MIN_CHILDREN = 1000
+
     FUNCTIONS = {
         "++": func_increment,
         "--": func_decrement,
@@ -571,14 +790,168 @@ class Functions(object):
         "exists": func_exists,
         "not_exists": func_not_exists,
         "array_append": func_array_append,
+        "array_extend": func_array_extend,
         ">=": func_greater_equal_than,
         "<=": func_smaller_equal_than,
         ">": func_greater_than,
         "<": func_smaller_than,
-        "num_child_where": func_num_child_where
+        "num_child_where": func_num_child_where,
+        "count_child_where": func_num_child_where,
+        "sum_child_where": func_sum_child_where,
+        "min_child_where": func_min_child_where,
+        "max_child_where": func_max_child_where,
+        "top_child_where": func_top_child_where
     }
 
 
+class UpdatePlan(object):
+    """
+    An update (see Profile) compiled into a tree of closures, with the functions already resolved.
+
+    Updates of the same structure (same keys, same functions, but any values, like "increment field X by N
+        if it's < 50") share the same plan, so the structure is walked once and then only the values are applied.
+
+    Plans are cached by the top level keys of the update only: a complete structural key would take
+        a walk over the whole update, which costs about as much as applying it. Instead, every node checks
+        that a value is what the node was compiled for (a function of the same name, a nested object),
+        and if not, applies that value the usual way (see Profile.__set_profile_field__).
+    """
+
+    # how many plans to keep
+    MAX_PLANS = 4096
+
+    PLANS = {}
+
+    def __init__(self, fields, merge=True):
+        self.merge = merge
+        self.nodes = UpdatePlan.__compile_fields__(fields, merge)
+
+    @staticmethod
+    def get(fields, merge=True):
+        """
+        :returns a plan for the update <fields>, compiled once per structure
+        """
+        key = (merge, tuple(fields))
+        plan = UpdatePlan.PLANS.get(key)
+
+        if plan is None:
+            plan = UpdatePlan(fields, merge)
+
+            if len(UpdatePlan.PLANS) >= UpdatePlan.MAX_PLANS:
+                # drop the oldest plan
+                UpdatePlan.PLANS.pop(next(iter(UpdatePlan.PLANS)))
+
+            UpdatePlan.PLANS[key] = plan
+
+        return plan
+
+    def apply(self, item, fields, changes=None, prefix=()):
+        """
+        Applies the update <fields> (should have the same keys the plan is compiled from) to <item>
+
+        :param changes: if a list is passed, the changes are recorded into it (see Profile.merge_data)
+        :param prefix: a path of the <item> in the whole profile, to record the changes with
+        """
+        nodes = self.nodes
+
+        for key, value in fields.items():
+            nodes[key](item, value, changes, prefix)
+
+    @staticmethod
+    def __compile_fields__(fields, merge):
+        return {
+            key: UpdatePlan.__compile_field__(key, value, merge)
+            for key, value in fields.items()
+        }
+
+    @staticmethod
+    def __compile_field__(field, value, merge):
+        if isinstance(value, dict):
+            func_name = value.get("@func", None)
+            if func_name:
+                return UpdatePlan.__compile_function__(field, func_name, merge)
+
+            if merge:
+                return UpdatePlan.__compile_object__(field, UpdatePlan.__compile_fields__(value, merge))
+
+        def assign(item, value_, changes, prefix):
+            if value_.__class__ is dict:
+                Profile.__set_profile_field__(item, field, value_, merge, changes, prefix)
+            elif value_ is None:
+                if field in item:
+                    del item[field]
+                    if changes is not None:
+                        changes.append((prefix + (field,), None))
+            else:
+                item[field] = value_
+                if changes is not None:
+                    changes.append((prefix + (field,), value_))
+
+        return assign
+
+    @staticmethod
+    def __compile_function__(field, func_name, merge):
+        try:
+            f = Functions.FUNCTIONS[str(func_name)].__func__
+        except KeyError:
+            raise ProfileError("No such function: " + str(func_name))
+
+        def apply_function(item, arguments, changes, prefix):
+            if arguments.__class__ is not dict or arguments.get("@func", None) != func_name:
+                Profile.__set_profile_field__(item, field, arguments, merge, changes, prefix)
+                return
+
+            object_value = item.get(field, None)
+
+            try:
+                do_apply, new_value = f(field, object_value, arguments)
+            except FuncError as e:
+                raise ProfileError("Failed to update field '{0}': {1}".format(field, e.message))
+
+            if do_apply:
+                # what the function returned is not known beforehand
+                Profile.__put_profile_field__(item, field, object_value, new_value, merge, changes, prefix)
+
+        return apply_function
+
+    @staticmethod
+    def __compile_object__(field, nodes):
+
+        def apply_object(item, value, changes, prefix):
+            if value.__class__ is not dict or value.get("@func", None):
+                Profile.__set_profile_field__(item, field, value, True, changes, prefix)
+                return
+
+            object_value = item.get(field, None)
+
+            if object_value is None:
+                # a new object is recorded as a whole
+                object_value = {}
+                item[field] = object_value
+                object_changes = None
+            elif isinstance(object_value, dict):
+                # copy on write: the original object is shared with the old profile
+                object_value = object_value.copy()
+                item[field] = object_value
+                object_changes = changes
+            else:
+                return
+
+            object_prefix = prefix + (field,) if changes is not None else prefix
+
+            for key, value_ in value.items():
+                node = nodes.get(key)
+                if node is None:
+                    Profile.__set_profile_field__(object_value, key, value_, True, object_changes, object_prefix)
+                else:
+                    node(object_value, value_, object_changes, object_prefix)
+
+            if changes is not None and object_changes is None:
+                changes.append((object_prefix, object_value))
+
+        return apply_object
+
+
 class NoDataError(Exception):
     pass
 
@@ -656,23 +1029,20 @@ class Profile(object, metaclass=ABCMeta):
     @staticmethod
     def __get_field__(item, path):
         try:
-            key = path.pop(0)
-
-            if not path:
-                return item[key]
-            else:
-                return Profile.__get_field__(item[key], path)
+            for key in path:
+                item = item[key]
         except KeyError:
             return None
+        return item
 
     @staticmethod
-    def __merge_profiles__(old_root, new_data, path, merge=True):
+    def __merge_profiles__(old_root, new_data, path, merge=True, changes=None):
         merged = (old_root or {}).copy()
-        Profile.__set_profile_fields__(merged, path, new_data, merge=merge)
+        Profile.__set_profile_fields__(merged, path, new_data, merge=merge, changes=changes)
         return merged
 
     @staticmethod
-    def __set_profile_field__(item, field, value, merge=True):
+    def __set_profile_field__(item, field, value, merge=True, changes=None, prefix=()):
         object_value = item[field] if field in item else None
 
         do_apply, value = Functions.check_value(field, object_value, value)
@@ -680,38 +1050,68 @@ class Profile(object, metaclass=ABCMeta):
         if not do_apply:
             return
 
+        Profile.__put_profile_field__(item, field, object_value, value, merge, changes, prefix)
+
+    @staticmethod
+    def __put_profile_field__(item, field, object_value, value, merge=True, changes=None, prefix=()):
         if merge:
             # in case both items are objects, merge them
             if isinstance(value, dict):
                 if object_value is None:
+                    # a new object is recorded as a whole
                     object_value = {}
                     item[field] = object_value
                     for item_key, item_value in value.items():
                         Profile.__set_profile_field__(object_value, item_key, item_value, merge=merge)
+                    if changes is not None:
+                        changes.append((prefix + (field,), object_value))
                 elif isinstance(object_value, dict):
+                    # copy on write: the original object is shared with the old profile
+                    object_value = object_value.copy()
+                    item[field] = object_value
+                    object_prefix = prefix + (field,) if changes is not None else prefix
                     for item_key, item_value in value.items():
-                        Profile.__set_profile_field__(object_value, item_key, item_value, merge=merge)
+                        Profile.__set_profile_field__(
+                            object_value, item_key, item_value, merge, changes, object_prefix)
                 return
 
         # if a field's value is None, delete such field
         if value is None:
-            try:
-                item.pop(field)
-            except KeyError:
-                pass
+            if field in item:
+                del item[field]
+                if changes is not None:
+                    changes.append((prefix + (field,), None))
         else:
             item[field] = value
+            if changes is not None:
+                changes.append((prefix + (field,), value))
 
     @staticmethod
-    def __set_profile_fields__(profile, path, fields, merge=True):
+    def __set_profile_fields__(profile, path, fields, merge=True, changes=None):
+        prefix = ()
+        created = None
+
         if isinstance(path, list):
             for key in path:
                 if key not in profile:
-                    profile[key] = {}
-                profile = profile[key]
-
-        for key, value in fields.items():
-            Profile.__set_profile_field__(profile, key, value, merge=merge)
+                    child = {}
+                    if created is None:
+                        created = (prefix + (key,), child)
+                elif isinstance(profile[key], dict):
+                    # copy on write
+                    child = profile[key].copy()
+                else:
+                    child = profile[key]
+                profile[key] = child
+                profile = child
+                prefix += (key,)
+
+        if created is not None and changes is not None:
+            # the path did not exist, so the first object created is recorded as a whole
+            UpdatePlan.get(fields, merge).apply(profile, fields)
+            changes.append(created)
+        else:
+            UpdatePlan.get(fields, merge).apply(profile, fields, changes, prefix)
 
     @abstractmethod
     async def get(self):
@@ -746,6 +1146,23 @@ class Profile(object, metaclass=ABCMeta):
 
         pass
 
+    async def patch(self, data, changes):
+        """
+        Called instead of `update` if `records_changes` is True, with a list of the changes made
+            (see Profile.merge_data). By default, simply calls `update`.
+
+        :param data: A complete JSON object that should be used to update the Profile object
+        :param changes: A list of (path, value) tuples that turn the old JSON object into <data>
+        """
+
+        await self.update(data)
+
+    def records_changes(self):
+        """
+        :returns True if `patch` should be called with the changes made instead of `update`
+        """
+        return False
+
     async def init(self):
         """
         Called upon initialization of the Profile instance.
@@ -779,23 +1196,43 @@ class Profile(object, metaclass=ABCMeta):
         else:
             return data
 
-    async def set_data(self, fields, path, merge=True):
+    async def read(self, path):
+        """
+        A read-only counterpart of get_data: nothing is locked, so the result may already be outdated once returned,
+            and it should not be modified. By default, simply calls get_data.
+        """
+        return await self.get_data(path)
+
+    async def set_data(self, fields, path, merge=True, changes=None):
+        """
+        Applies the update <fields> to the Profile object (see Profile)
+
+        :param changes: if a list is passed, the changes made are recorded into it (see Profile.merge_data)
+        """
         if path is not None and not isinstance(path, list):
             path = list(path)
 
         if not isinstance(fields, dict):
             raise ProfileError("Expected fields to be a dict.")
 
+        patch = self.records_changes()
+
+        if patch and changes is None:
+            changes = []
+
         await self.init()
 
         try:
             data = await self.get()
         except NoDataError:
-            updated = Profile.__merge_profiles__({}, fields, path=path, merge=merge)
+            updated = Profile.__merge_profiles__({}, fields, path=path, merge=merge, changes=changes)
             await self.insert(updated)
         else:
-            updated = Profile.__merge_profiles__(data, fields, path=path, merge=merge)
-            await self.update(updated)
+            updated = Profile.__merge_profiles__(data, fields, path=path, merge=merge, changes=changes)
+            if patch:
+                await self.patch(updated, changes)
+            else:
+                await self.update(updated)
         finally:
             await self.release()
 
@@ -805,8 +1242,19 @@ class Profile(object, metaclass=ABCMeta):
             return updated
 
     @staticmethod
-    def merge_data(old_root, new_data, path, merge=True):
-        return Profile.__merge_profiles__(old_root, new_data, path=path, merge=merge)
+    def merge_data(old_root, new_data, path, merge=True, changes=None):
+        """
+        Applies the update <new_data> to <old_root> and returns the result. <old_root> is left as is: objects
+            on the way to the changed fields are copied, the rest is shared between the old and the new profile.
+
+        :param changes: if a list is passed, the changes made are recorded into it, as (path, value) tuples,
+            in the order applied. A path is a tuple of keys from the root, the value is the new value of the field,
+            or None if the field was removed. A new object is recorded as a whole, not field by field.
+
+            For example, merging {"a": {"b": {"@func": "++", "@value": 1}}, "c": None, "d": {"e": 1}}
+                into {"a": {"b": 1}, "c": 2} records [(("a", "b"), 2), (("c", ), None), (("d", ), {"e": 1})]
+        """
+        return Profile.__merge_profiles__(old_root, new_data, path=path, merge=merge, changes=changes)
 
 
 class DatabaseProfile(Profile, metaclass=ABCMeta):
@@ -847,21 +1295,1210 @@ class DatabaseProfile(Profile, metaclass=ABCMeta):
                     SET `profile_object`=%s
                     WHERE ...;
                 ''', ujson.dumps(data), ...)
-    
+
+    Partial updates: rewriting the whole JSON column of a large profile because of a single counter is expensive.
+        If constructed with partial_updates=True, and `update_partial` is implemented, only the changed paths
+        are written with JSON_SET/JSON_REMOVE:
+
+        async def update_partial(self, expression, args):
+            await self.conn.execute(
+                '''
+                    UPDATE `table`
+                    SET `profile_object`=''' + expression + '''
+                    WHERE ...;
+                ''', *args, ...)
+
+        If there are too many changes (see MAX_PARTIAL_CHANGES), the whole document is written with `update`.
+
+    Optimistic mode: locking the row with FOR UPDATE serializes every update of a popular profile (a clan,
+        a group) for the whole read-merge-write cycle. If constructed with optimistic=True, the row is read
+        without a lock, and written only if nobody has written it in between (by a version column),
+        otherwise the cycle is retried (see MAX_CONFLICT_RETRIES). `get_versioned` and `update_versioned`
+        should be implemented for that:
+
+        async def get_versioned(self):
+            profile = await self.conn.get(
+                '''
+                    SELECT `profile_object`, `profile_version`
+                    FROM `table`
+                    WHERE ...;
+                ''', ...)
+
+            if profile:
+                return profile["profile_object"], profile["profile_version"]
+
+            raise common.profile.NoDataError()
+
+        async def update_versioned(self, data, version):
+            updated = await self.conn.execute(
+                '''
+                    UPDATE `table`
+                    SET `profile_object`=%s, `profile_version`=`profile_version` + 1
+                    WHERE ... AND `profile_version`=%s;
+                ''', ujson.dumps(data), ..., version)
+
+            return updated == 1
+
+        A concurrent `insert` of the same profile should raise database.DuplicateError (a unique key).
+
+        Partial updates are not supported in optimistic mode (the whole document is written by `update_versioned`),
+            so the two cannot be combined.
+
+    Read-only access: `read` does not lock anything (there is no transaction), and if `get_partial` is implemented,
+        only the requested path is selected with JSON_EXTRACT, instead of the whole document:
+
+        async def get_partial(self, expression, args):
+            profile = await self.conn.get(
+                '''
+                    SELECT ''' + expression + ''' AS `value`
+                    FROM `table`
+                    WHERE ...;
+                ''', *args, ...)
+
+            if profile:
+                return profile["value"]
+
+            raise common.profile.NoDataError()
+
+        Alternatively, if constructed with a ProfileCache, and `cache_key`, `get_version` and `get_versioned`
+            are implemented, only the version is selected, and the document is parsed once per version:
+
+        def cache_key(self):
+            return ...
+
+        async def get_version(self):
+            profile = await self.conn.get(
+                '''
+                    SELECT `profile_version`
+                    FROM `table`
+                    WHERE ...;
+                ''', ...)
+
+            if profile:
+                return profile["profile_version"]
+
+            raise common.profile.NoDataError()
+
     """
 
-    def __init__(self, db):
+    # a column the expression for update_partial is built upon
+    PROFILE_COLUMN = "profile_object"
+    # more changes than that are written as a whole document
+    MAX_PARTIAL_CHANGES = 64
+    # how many times an optimistic update is retried, before giving up
+    MAX_CONFLICT_RETRIES = 16
+    # a maximum (random) delay between retries, in seconds, doubled with every retry
+    CONFLICT_BACKOFF = 0.002
+
+    def __init__(self, db, partial_updates=False, optimistic=False, cache=None):
         super(Profile, self).__init__()
+
+        if partial_updates and optimistic:
+            raise ProfileError("Partial updates are not supported in optimistic mode")
+
         self.db = db
         self.conn = None
+        self.partial_updates = partial_updates
+        self.optimistic = optimistic
+        self.cache = cache
+        self.conflicts = 0
 
-    async def init(self):
-        self.conn = self.db.acquire(auto_commit=False)
-        await self.conn.init()
+    def records_changes(self):
+        return self.partial_updates
 
-    async def release(self):
-        await self.conn.commit()
-        self.conn.close()
+    async def get_versioned(self):
+        """
+        Called in optimistic mode instead of `get`, should not lock anything.
+
+        :returns a tuple (a complete JSON object that represents the Profile, its version)
+        :raises NoDataError if no Profile could be found
+        """
+        raise NotImplementedError()
+
+    async def update_versioned(self, data, version):
+        """
+        Called in optimistic mode instead of `update`, should write <data> only if the version is still <version>,
+            and increase the version.
+
+        :returns True if written, False if the version has changed in between
+        """
+        raise NotImplementedError()
+
+    async def set_data(self, fields, path, merge=True, changes=None):
+        if not self.optimistic:
+            return await super(DatabaseProfile, self).set_data(fields, path, merge=merge, changes=changes)
+
+        from .database import DuplicateError
+
+        if path is not None and not isinstance(path, list):
+            path = list(path)
+
+        if not isinstance(fields, dict):
+            raise ProfileError("Expected fields to be a dict.")
+
+        await self.init()
+
+        try:
+            for attempt in range(0, self.MAX_CONFLICT_RETRIES):
+                # the changes of a failed attempt are thrown away
+                attempt_changes = [] if changes is not None else None
+
+                try:
+                    data, version = await self.get_versioned()
+                except NoDataError:
+                    updated = Profile.merge_data({}, fields, path, merge=merge, changes=attempt_changes)
+                    try:
+                        await self.insert(updated)
+                    except DuplicateError:
+                        pass
+                    else:
+                        break
+                else:
+                    updated = Profile.merge_data(data, fields, path, merge=merge, changes=attempt_changes)
+                    if await self.update_versioned(updated, version):
+                        break
+
+                self.conflicts += 1
+                await sleep(random.random() * self.CONFLICT_BACKOFF * (2 ** attempt))
+            else:
+                raise ProfileError("Too many concurrent updates, try again later")
+        finally:
+            await self.release()
+
+        if changes is not None:
+            changes.extend(attempt_changes)
+
+        if path:
+            return Profile.__get_field__(updated, path)
+        else:
+            return updated
+
+    async def get_partial(self, expression, args):
+        """
+        Called by `read` to select only a part of the Profile object (see read-only access above).
+
+        :param expression: An SQL expression to select
+        :param args: Arguments for the expression, in order of its placeholders
+        :returns the value selected as is (a JSON string, or None if there's no such path)
+        :raises NoDataError if no Profile could be found
+        """
+        raise NotImplementedError()
+
+    async def get_version(self):
+        """
+        Called by `read` to check the version of the Profile object, if constructed with a ProfileCache.
+
+        :returns the current version of the Profile object (see get_versioned)
+        :raises NoDataError if no Profile could be found
+        """
+        raise NotImplementedError()
+
+    def cache_key(self):
+        """
+        :returns a key that identifies the Profile object in a ProfileCache
+        """
+        raise NotImplementedError()
+
+    async def read(self, path):
+        if path is not None and not isinstance(path, list):
+            path = list(path)
+
+        await self.init_read()
+
+        try:
+            if self.cache is not None and self.__implements__("cache_key", "get_version", "get_versioned"):
+                data = await self.__read_cached__()
+                return Profile.__get_field__(data, path) if path else data
+
+            if path and self.__implements__("get_partial"):
+                expression, args = DatabaseProfile.json_extract_expression(self.PROFILE_COLUMN, path)
+                value = await self.get_partial(expression, args)
+                return DatabaseProfile.__json_value__(value)
+
+            if self.__implements__("get_versioned"):
+                data, version = await self.get_versioned()
+            else:
+                data = await self.get()
+        finally:
+            await self.release_read()
+
+        return Profile.__get_field__(data, path) if path else data
+
+    def __implements__(self, *methods):
+        # the optional methods are checked up front, so a NotImplementedError raised inside of an implemented one
+        # is not mistaken for a missing method
+        return all(
+            getattr(type(self), method) is not getattr(DatabaseProfile, method)
+            for method in methods)
+
+    async def __read_cached__(self):
+        key = self.cache_key()
+        version = await self.get_version()
+        data = self.cache.get(key, version)
+
+        if data is None:
+            data, version = await self.get_versioned()
+            self.cache.put(key, version, data)
+
+        return data
+
+    @staticmethod
+    def __json_value__(value):
+        if isinstance(value, (str, bytes)):
+            return ujson.loads(value)
+        return value
+
+    async def update_partial(self, expression, args):
+        """
+        Called to write only the changed parts of the Profile object (see partial updates above).
+
+        :param expression: An SQL expression to assign the profile column to
+        :param args: Arguments for the expression, in order of its placeholders
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def json_path(path):
+        """
+        :returns a MySQL JSON path for a tuple of keys, every key is quoted: ("a", "b c") -> $."a"."b c"
+        """
+        return "$" + "".join(
+            '."' + str(key).replace("\\", "\\\\").replace('"', '\\"') + '"'
+            for key in path)
+
+    @staticmethod
+    def json_extract_expression(column, path):
+        """
+        :returns a tuple (an SQL expression that selects <path> of the JSON column <column>, a list of arguments)
+        """
+        return "JSON_EXTRACT(`" + column + "`, %s)", [DatabaseProfile.json_path(path)]
+
+    @staticmethod
+    def json_patch_expression(column, changes):
+        """
+        Builds an SQL expression that applies <changes> (see Profile.merge_data) to the JSON column <column>.
+            Consecutive sets (and removes) are grouped into a single JSON_SET (JSON_REMOVE) call.
+
+        :returns a tuple (expression, a list of arguments)
+        """
+        expression = "`" + column + "`"
+        args = []
+
+        group = None
+        group_args = []
+
+        for path, value in changes:
+            kind = "remove" if value is None else "set"
+
+            if kind != group and group is not None:
+                expression = DatabaseProfile.__json_call__(group, expression, group_args)
+                args.extend(group_args)
+                group_args = []
+
+            group = kind
+            group_args.append(DatabaseProfile.json_path(path))
+
+            if value is not None:
+                group_args.append(ujson.dumps(value))
+
+        if group is not None:
+            expression = DatabaseProfile.__json_call__(group, expression, group_args)
+            args.extend(group_args)
+
+        return expression, args
+
+    @staticmethod
+    def __json_call__(kind, expression, args):
+        if kind == "set":
+            return "JSON_SET(" + expression + ", " + ", ".join(
+                ["%s, CAST(%s AS JSON)"] * (len(args) // 2)) + ")"
+
+        return "JSON_REMOVE(" + expression + ", " + ", ".join(["%s"] * len(args)) + ")"
+
+    async def patch(self, data, changes):
+        if not changes:
+            # nothing has changed
+            return
+
+        if len(changes) <= self.MAX_PARTIAL_CHANGES and self.__implements__("update_partial"):
+            expression, args = DatabaseProfile.json_patch_expression(self.PROFILE_COLUMN, changes)
+            await self.update_partial(expression, args)
+            return
+
+        await self.update(data)
+
+    async def init(self):
+        # optimistic updates need no transaction
+        self.conn = self.db.acquire(auto_commit=self.optimistic)
+        await self.conn.init()
+
+    async def release(self):
+        if not self.optimistic:
+            await self.conn.commit()
+        self.conn.close()
+
+    async def init_read(self):
+        # a read-only access needs no transaction
+        self.conn = self.db.acquire(auto_commit=True)
+        await self.conn.init()
+
+    async def release_read(self):
+        self.conn.close()
+
+
+class ProfileCache(object):
+    """
+    Parsed Profile objects, by their versions (see DatabaseProfile, read-only access). A single instance is meant
+        to be shared across DatabaseProfile instances. The objects are shared as well, so they should not
+        be modified (Profile.merge_data does not modify the original object).
+    """
+
+    def __init__(self, max_len=1000, max_age=60):
+        self.profiles = ExpiringDict(max_len, max_age)
+
+    def get(self, key, version):
+        """
+        :returns a Profile object cached for <key> if it is of <version>, otherwise None
+        """
+        cached = self.profiles.get(key)
+
+        if cached is None or cached[0] != version:
+            return None
+
+        return cached[1]
+
+    def put(self, key, version, data):
+        self.profiles[key] = (version, data)
+
+
+class DatabaseProfiles(object, metaclass=ABCMeta):
+
+    """
+    A batch of Profile objects of the same kind, that are updated together (for example, rewards for every member
+        of a clan): loaded with a single query, updated in memory, and written back with a single query,
+        all in a single transaction.
+
+    Typical usage:
+
+        async def get_many(self, ids):
+            profiles = await self.conn.query(
+                '''
+                    SELECT `id`, `profile_object`
+                    FROM `table`
+                    WHERE `id` IN %s
+                    FOR UPDATE;
+                ''', ids)
+
+            return {
+                profile["id"]: profile["profile_object"]
+                for profile in profiles
+            }
+
+        async def write_many(self, profiles):
+            args = []
+            for profile_id, data in profiles.items():
+                args.extend([profile_id, ujson.dumps(data)])
+
+            await self.conn.execute(
+                '''
+                    INSERT INTO `table`
+                    (`id`, `profile_object`)
+                    VALUES ''' + ", ".join(["(%s, %s)"] * len(profiles)) + '''
+                    ON DUPLICATE KEY UPDATE `profile_object`=VALUES(`profile_object`);
+                ''', *args)
+
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.conn = None
+
+    @abstractmethod
+    async def get_many(self, ids):
+        """
+        Called to load (and lock) the Profile objects.
+
+        :param ids: A tuple of ids of the Profile objects
+        :returns a dict id -> a complete JSON object that represents the Profile, missing ones should be skipped
+        """
+
+        pass
+
+    @abstractmethod
+    async def write_many(self, profiles):
+        """
+        Called to write (insert or update) the changed Profile objects.
+
+        :param profiles: A dict id -> a complete JSON object that should be written
+        """
+
+        pass
+
+    async def init(self):
+        self.conn = self.db.acquire(auto_commit=False)
+        await self.conn.init()
+
+    async def release(self):
+        await self.conn.commit()
+        self.conn.close()
+
+    async def set_data_many(self, updates, path=None, merge=True, atomic=False):
+        """
+        Applies a different update for every Profile object (see Profile.set_data).
+
+        :param updates: A dict id -> an update (fields) to apply
+        :param atomic: If True, and any of the updates fails, nothing is written and ProfileError is raised
+        :returns a dict id -> the result of the update (see Profile.set_data), or ProfileError if it has failed.
+            Failed Profile objects are not written.
+        """
+
+        if path is not None and not isinstance(path, list):
+            path = list(path)
+
+        for fields in updates.values():
+            if not isinstance(fields, dict):
+                raise ProfileError("Expected fields to be a dict.")
+
+        results = {}
+        written = {}
+
+        if not updates:
+            # get_many would get no ids to select ("IN ()" is not valid)
+            return results
+
+        await self.init()
+
+        try:
+            existing = await self.get_many(tuple(updates.keys()))
+
+            for profile_id, fields in updates.items():
+                data = existing.get(profile_id)
+                changes = []
+
+                try:
+                    updated = Profile.merge_data(data, fields, path, merge=merge, changes=changes)
+                except ProfileError as e:
+                    if atomic:
+                        raise
+                    results[profile_id] = e
+                    continue
+
+                # nothing to write if an existing profile has not changed
+                if changes or data is None:
+                    written[profile_id] = updated
+
+                results[profile_id] = Profile.__get_field__(updated, list(path)) if path else updated
+
+            if written:
+                await self.write_many(written)
+        finally:
+            await self.release()
+
+        return results
+
+    async def set_data_all(self, ids, fields, path=None, merge=True, atomic=False):
+        """
+        Applies the same update to every Profile object (see set_data_many)
+        """
+        return await self.set_data_many({
+            profile_id: fields
+            for profile_id in ids
+        }, path=path, merge=merge, atomic=atomic)
+
+
+class ProfileDryRun(object):
+
+    """
+    Evaluates a single update (see Profile) against many Profile objects without writing anything, for example,
+        to check a balance change against a snapshot of all the user profiles before actually applying it.
+        The documents are evaluated in chunks across a pool of processes.
+
+        dry_run = ProfileDryRun({"gold": {"@func": "--/0", "@value": 100}}, changes=True)
+
+        try:
+            async for profile_id, result in dry_run.evaluate(documents):
+                if isinstance(result, ProfileError):
+                    ...
+        finally:
+            dry_run.stop()
+
+    """
+
+    # documents sent to a worker process at once
+    CHUNK_SIZE = 1000
+    # chunks being evaluated at once, per process
+    CHUNKS_PER_PROCESS = 2
+
+    def __init__(self, fields, path=None, merge=True, changes=False, processes=None, chunk_size=CHUNK_SIZE):
+        """
+        :param changes: if True, the results are lists of the changes made (see Profile.merge_data) instead of
+            the updated Profile objects (or their fields on the path)
+        :param processes: a number of worker processes, the number of CPUs by default, or 0 to evaluate everything
+            in the current process (blocks the IOLoop)
+        """
+
+        if path is not None and not isinstance(path, list):
+            path = list(path)
+
+        if not isinstance(fields, dict):
+            raise ProfileError("Expected fields to be a dict.")
+
+        self.fields = fields
+        self.path = path
+        self.merge = merge
+        self.changes = changes
+        self.chunk_size = chunk_size
+        self.executor = ProcessPoolExecutor(processes) if processes != 0 else None
+        self.max_pending = (processes or os.cpu_count() or 1) * ProfileDryRun.CHUNKS_PER_PROCESS
+
+    @staticmethod
+    def __evaluate__(fields, path, merge, record_changes, documents):
+        # runs in a worker process, errors are passed back as messages
+        results = []
+
+        for key, data in documents:
+            changes = [] if record_changes else None
+
+            try:
+                if isinstance(data, (str, bytes)):
+                    data = ujson.loads(data)
+                updated = Profile.merge_data(data, fields, path, merge=merge, changes=changes)
+            except ProfileError as e:
+                results.append((key, False, e.message))
+            except Exception as e:
+                results.append((key, False, "Failed to evaluate: " + str(e)))
+            else:
+                if record_changes:
+                    result = changes
+                elif path:
+                    result = Profile.__get_field__(updated, path)
+                else:
+                    result = updated
+                results.append((key, True, result))
+
+        return results
+
+    async def __chunks__(self, documents):
+        chunk = []
+
+        if hasattr(documents, "__aiter__"):
+            async for document in documents:
+                chunk.append(document)
+                if len(chunk) >= self.chunk_size:
+                    yield chunk
+                    chunk = []
+        else:
+            for document in documents:
+                chunk.append(document)
+                if len(chunk) >= self.chunk_size:
+                    yield chunk
+                    chunk = []
+
+        if chunk:
+            yield chunk
+
+    def __submit__(self, chunk):
+        args = (self.fields, self.path, self.merge, self.changes, chunk)
+
+        if self.executor is None:
+            future = Future()
+            future.set_result(ProfileDryRun.__evaluate__(*args))
+            return future
+
+        return IOLoop.current().run_in_executor(self.executor, ProfileDryRun.__evaluate__, *args)
+
+    async def evaluate(self, documents):
+        """
+        :param documents: an iterable (or an async iterable) of tuples (key, a JSON object or a JSON string),
+            None stands for a missing Profile object
+        :returns an async iterator of tuples (key, the result of the update (see Profile.set_data),
+            or ProfileError if it has failed), in order of the documents
+        """
+
+        pending = deque()
+
+        async for chunk in self.__chunks__(documents):
+            pending.append(self.__submit__(chunk))
+
+            if len(pending) >= self.max_pending:
+                for key, success, result in await pending.popleft():
+                    yield key, result if success else ProfileError(result)
+
+        while pending:
+            for key, success, result in await pending.popleft():
+                yield key, result if success else ProfileError(result)
+
+    async def evaluate_all(self, documents):
+        """
+        Same as evaluate, but collects the results
+
+        :returns a dict key -> the result of the update, or ProfileError if it has failed
+        """
+        return {
+            key: result
+            async for key, result in self.evaluate(documents)
+        }
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+
+class ProfileDeltas(object):
+    """
+    Pending commutative changes of a single Profile object (see WriteBehindProfiles): sums of increments
+        and lists of appended values, by path.
+    """
+
+    def __init__(self):
+        # path -> a sum
+        self.increments = {}
+        # path -> a list of [values, limit, shift], consecutive appends with the same limit share one
+        self.appends = {}
+        # how many updates are coalesced in
+        self.updates = 0
+
+    def __len__(self):
+        return len(self.increments) + sum(len(runs) for runs in self.appends.values())
+
+    def increment(self, path, value):
+        self.increments[path] = self.increments.get(path, 0) + value
+
+    def append(self, path, value, limit, shift):
+        runs = self.appends.get(path)
+
+        if runs is None:
+            self.appends[path] = [[[value], limit, shift]]
+            return
+
+        last = runs[-1]
+
+        if last[1] == limit and last[2] == shift:
+            last[0].append(value)
+        else:
+            # a different limit cuts the array at another place, so it has to be a separate update
+            runs.append([[value], limit, shift])
+
+    def extend(self, other):
+        for path, value in other.increments.items():
+            self.increment(path, value)
+
+        for path, runs in other.appends.items():
+            for values, limit, shift in runs:
+                for value in values:
+                    self.append(path, value, limit, shift)
+
+        self.updates += other.updates
+
+    def build(self):
+        """
+        :returns a list of updates (see Profile) that apply the deltas, in order. Usually it's a single update,
+            but if one path is a prefix of another (say, both "a" and "a.b" are incremented), or a path
+            is appended to with different limits, they cannot be a part of the same update.
+        """
+        return [update for update, deltas in self.__split__()]
+
+    def split(self):
+        """
+        Same as build, but returns a ProfileDeltas object for each of the updates
+        """
+        return [deltas for update, deltas in self.__split__()]
+
+    def paths(self):
+        """
+        :returns a ProfileDeltas object for each of the paths (and each of the appends with a different limit)
+        """
+        result = []
+
+        for path, value in self.increments.items():
+            deltas = ProfileDeltas()
+            deltas.increments[path] = value
+            result.append(deltas)
+
+        for path, runs in self.appends.items():
+            for values, limit, shift in runs:
+                deltas = ProfileDeltas()
+                deltas.appends[path] = [[list(values), limit, shift]]
+                result.append(deltas)
+
+        return result
+
+    def __split__(self):
+        parts = []
+
+        def place(path, value):
+            for update, deltas in parts:
+                if ProfileDeltas.__place__(update, path, value):
+                    return deltas
+            update = {}
+            deltas = ProfileDeltas()
+            ProfileDeltas.__place__(update, path, value)
+            parts.append((update, deltas))
+            return deltas
+
+        for path, value in self.increments.items():
+            # a zero is not a valid increment
+            if value:
+                place(path, {"@func": "++", "@value": value}).increment(path, value)
+
+        for path, runs in self.appends.items():
+            for values, limit, shift in runs:
+                function = {"@func": "array_extend", "@values": values}
+                if limit:
+                    function["@limit"] = limit
+                    function["@shift"] = shift
+                place(path, function).appends.setdefault(path, []).append([list(values), limit, shift])
+
+        return parts
+
+    @staticmethod
+    def __place__(update, path, value):
+        for key in path[:-1]:
+            child = update.get(key)
+            if child is None:
+                child = {}
+                update[key] = child
+            elif "@func" in child:
+                return False
+            update = child
+
+        if path[-1] in update:
+            return False
+
+        update[path[-1]] = value
+        return True
+
+
+class WriteBehindProfiles(object):
+    """
+    A write-behind layer above Profile objects, for very hot counters: instead of a transaction per
+        increment, commutative updates are coalesced in a buffer and written periodically.
+
+    Only updates that consist entirely of these functions are coalesced:
+
+        ++, --, increment, decrement: with a numeric @value
+        array_append: without @limit, or with @limit and @shift (so it cannot fail)
+
+    Any other update of the Profile object flushes its pending deltas first, and then is applied as usual.
+        Still, the order of updates is not guaranteed: the deltas taken by a flush that is in progress elsewhere,
+        or put back after a failed write, may land after such an update.
+
+    Appends to the same path with different @limit (or @shift) are not merged together, each of them
+        is applied with its own limit, in order.
+
+    Durability depends on the buffer:
+
+        MemoryProfileDeltasBuffer: (the default) pending deltas are lost if the process dies
+        KeyValueProfileDeltasBuffer: pending deltas are kept in a key/value storage (redis) and survive restarts,
+            they also can be coalesced across processes. The keys are passed to <profile_factory> as strings.
+
+    Usage:
+
+        profiles = WriteBehindProfiles(lambda account: UserProfile(db, gamespace, account), name="user_profile")
+        await profiles.set_data(account, {"stats": {"kills": {"@func": "++", "@value": 1}}}, path=None)
+
+    :param profile_factory: a function that returns a Profile object to write the deltas into, by a key
+    :param buffer: a buffer to keep the pending deltas in
+    :param flush_period: how often (in seconds) all of the pending deltas are written
+    :param max_pending: if that many updates of a single Profile object are pending, it's written immediately
+    :param name: if set, every flush is reported to the monitoring as profile.write_behind action,
+        tagged with name=<name>
+    """
+
+    COALESCED_FUNCTIONS = {
+        "++": 1,
+        "increment": 1,
+        "--": -1,
+        "decrement": -1,
+        "array_append": 0
+    }
+
+    def __init__(self, profile_factory, buffer=None, flush_period=1, max_pending=1000, name=None):
+        self.profile_factory = profile_factory
+        self.buffer = buffer or MemoryProfileDeltasBuffer()
+        self.max_pending = max_pending
+        self.name = name
+
+        if flush_period:
+            self.flush_callback = PeriodicCallback(self.flush, flush_period * 1000)
+            self.flush_callback.start()
+        else:
+            self.flush_callback = None
+
+    @staticmethod
+    def coalesce(fields, path=None):
+        """
+        :returns ProfileDeltas for the update, or None if it cannot be coalesced
+        """
+        deltas = ProfileDeltas()
+        deltas.updates = 1
+
+        if not WriteBehindProfiles.__coalesce__(deltas, tuple(path or ()), fields):
+            return None
+
+        return deltas
+
+    @staticmethod
+    def __coalesce__(deltas, prefix, fields):
+        if not fields:
+            return False
+
+        for key, value in fields.items():
+            if not isinstance(value, dict):
+                return False
+
+            path = prefix + (key,)
+            func_name = value.get("@func", None)
+
+            if not func_name:
+                if not WriteBehindProfiles.__coalesce__(deltas, path, value):
+                    return False
+                continue
+
+            sign = WriteBehindProfiles.COALESCED_FUNCTIONS.get(func_name) if isinstance(func_name, str) else None
+
+            if sign is None:
+                return False
+
+            argument = value.get("@value", None)
+
+            if sign:
+                if not argument or isinstance(argument, bool) or not isinstance(argument, (int, float)):
+                    return False
+                deltas.increment(path, sign * argument)
+            else:
+                limit = value.get("@limit", None)
+                shift = value.get("@shift", False)
+                if not argument or isinstance(argument, dict) or (limit and not shift):
+                    return False
+                if limit and not isinstance(limit, (int, float)):
+                    return False
+                deltas.append(path, argument, limit, shift)
+
+        return True
+
+    async def set_data(self, key, fields, path=None, merge=True):
+        """
+        Applies the update <fields> to the Profile object <key>.
+
+        :returns None if the update is coalesced (and is going to be written later),
+            otherwise the result of Profile.set_data
+        """
+        if not isinstance(fields, dict):
+            raise ProfileError("Expected fields to be a dict.")
+
+        deltas = WriteBehindProfiles.coalesce(fields, path) if merge else None
+
+        if deltas is None:
+            await self.flush_key(key)
+            return await self.profile_factory(key).set_data(fields, path, merge=merge)
+
+        pending = await self.buffer.add(key, deltas)
+
+        if pending >= self.max_pending:
+            await self.flush_key(key)
+
+    async def get_data(self, key, path):
+        """
+        Same as Profile.get_data, but with the pending deltas applied
+        """
+        deltas = await self.buffer.peek(key)
+
+        try:
+            data = await self.profile_factory(key).read(None)
+        except NoDataError:
+            if deltas is None:
+                raise
+            data = {}
+
+        if deltas is not None:
+            for update in deltas.build():
+                data = Profile.merge_data(data, update, None)
+
+        if path:
+            return Profile.__get_field__(data, list(path))
+
+        return data
+
+    async def flush_key(self, key):
+        """
+        Writes pending deltas of the Profile object <key>
+        """
+        deltas = await self.buffer.take(key)
+
+        if deltas is not None:
+            await self.__write__(key, deltas)
+
+    async def __write__(self, key, deltas):
+        """
+        Writes the deltas update by update. If an update fails because of the data (ProfileError),
+            its paths are written one by one, so only the ones to blame are dropped. If it fails otherwise,
+            the deltas that are not written yet are put back to the buffer.
+
+        :returns False if failed
+        """
+        pending = deque(deltas.split())
+        success = True
+
+        while pending:
+            part = pending[0]
+
+            try:
+                for update in part.build():
+                    await self.profile_factory(key).set_data(update, None)
+            except ProfileError as e:
+                pending.popleft()
+
+                if len(part) > 1:
+                    pending.extendleft(reversed(part.paths()))
+                    continue
+
+                # these would have failed without the buffer as well
+                logging.error("Failed to write pending deltas of profile {0}: {1}".format(key, e.message))
+                success = False
+                continue
+            except Exception:
+                logging.exception("Failed to write pending deltas of profile {0}".format(key))
+
+                # put the rest back to try again later
+                remaining = ProfileDeltas()
+                for part in pending:
+                    remaining.extend(part)
+                remaining.updates = deltas.updates
+
+                await self.buffer.add(key, remaining)
+                return False
+
+            pending.popleft()
+
+        return success
+
+    async def flush(self):
+        """
+        Writes all of the pending deltas
+        """
+        started = time.time()
+        profiles = 0
+        updates = 0
+        errors = 0
+
+        for key in await self.buffer.keys():
+            deltas = await self.buffer.take(key)
+
+            if deltas is None:
+                continue
+
+            profiles += 1
+            updates += deltas.updates
+
+            if not await self.__write__(key, deltas):
+                errors += 1
+
+        if self.name and profiles:
+            from . import monitoring
+
+            monitoring.monitor_action("profile.write_behind", {
+                "profiles": profiles,
+                "updates": updates,
+                "errors": errors,
+                "time": time.time() - started
+            }, name=self.name)
+
+    def stop(self):
+        if self.flush_callback is not None:
+            self.flush_callback.stop()
+
+
+class ProfileDeltasBuffer(object, metaclass=ABCMeta):
+    """
+    Keeps pending ProfileDeltas of WriteBehindProfiles
+    """
+
+    @abstractmethod
+    async def add(self, key, deltas):
+        """
+        Adds <deltas> to the pending ones of the Profile object <key>
+
+        :returns how many updates of the Profile object are pending now
+        """
+        pass
+
+    @abstractmethod
+    async def take(self, key):
+        """
+        Removes pending deltas of the Profile object <key>
+
+        :returns ProfileDeltas, or None if there's nothing pending
+        """
+        pass
+
+    @abstractmethod
+    async def peek(self, key):
+        """
+        Same as take, but leaves the pending deltas as is
+        """
+        pass
+
+    @abstractmethod
+    async def keys(self):
+        """
+        :returns a list of keys of Profile objects that have something pending
+        """
+        pass
+
+
+class MemoryProfileDeltasBuffer(ProfileDeltasBuffer):
+    def __init__(self):
+        self.pending = {}
+
+    async def add(self, key, deltas):
+        pending = self.pending.get(key)
+
+        if pending is None:
+            pending = ProfileDeltas()
+            self.pending[key] = pending
+
+        pending.extend(deltas)
+        return pending.updates
+
+    async def take(self, key):
+        return self.pending.pop(key, None)
+
+    async def peek(self, key):
+        return self.pending.get(key)
+
+    async def keys(self):
+        return list(self.pending.keys())
+
+
+class KeyValueProfileDeltasBuffer(ProfileDeltasBuffer):
+    """
+    Keeps the deltas in a key/value storage (see keyvalue.KeyValueStorage):
+
+        <prefix>{<bucket>}:<key>:i - a hash of integer increments, by path
+        <prefix>{<bucket>}:<key>:f - a hash of float increments, by path
+        <prefix>{<bucket>}:<key>:a - a list of appends [path, value, limit, shift]
+        <prefix>{<bucket>}:<key>:n - a number of updates coalesced
+        <prefix>{<bucket>}:keys - a set of keys of the bucket that have something pending
+
+    Every Profile object belongs to one of <buckets> buckets (by a hash of its key), and all the keys
+        of a bucket share a hash tag. So the deltas and the set of keys are updated together by a single
+        Lua script, which is atomic, in sharded mode as well.
+    """
+
+    ADD_SCRIPT = keyvalue.Script("""
+        local index = 3
+        for k, command in ipairs({"HINCRBY", "HINCRBYFLOAT"}) do
+            local count = tonumber(ARGV[index])
+            for i = 1, count do
+                redis.call(command, KEYS[k], ARGV[index + i * 2 - 1], ARGV[index + i * 2])
+            end
+            index = index + count * 2 + 1
+        end
+        for i = index, #ARGV do
+            redis.call("RPUSH", KEYS[3], ARGV[i])
+        end
+        redis.call("SADD", KEYS[5], ARGV[1])
+        return redis.call("INCRBY", KEYS[4], ARGV[2])
+    """)
+
+    READ_SCRIPT = keyvalue.Script("""
+        local updates = redis.call("GET", KEYS[4])
+        local result = false
+        if updates then
+            result = {
+                updates,
+                redis.call("HGETALL", KEYS[1]),
+                redis.call("HGETALL", KEYS[2]),
+                redis.call("LRANGE", KEYS[3], 0, -1)
+            }
+        end
+        if ARGV[2] == "1" then
+            redis.call("DEL", KEYS[1], KEYS[2], KEYS[3], KEYS[4])
+            redis.call("SREM", KEYS[5], ARGV[1])
+        end
+        return result
+    """)
+
+    def __init__(self, kv, prefix="profile_deltas:", buckets=16):
+        self.kv = kv
+        self.prefix = prefix
+        self.buckets = buckets
+
+    def __bucket__(self, bucket):
+        return self.prefix + "{" + str(bucket) + "}:"
+
+    def __keys__(self, key):
+        key = str(key)
+        bucket = self.__bucket__(zlib.crc32(key.encode("utf-8")) % self.buckets)
+        base = bucket + key + ":"
+        return [base + "i", base + "f", base + "a", base + "n", bucket + "keys"]
+
+    async def add(self, key, deltas):
+        integers = []
+        floats = []
+        appends = []
+
+        for path, value in deltas.increments.items():
+            field = ujson.dumps(path)
+            if isinstance(value, int):
+                integers.extend((field, str(value)))
+            else:
+                floats.extend((field, repr(value)))
+
+        for path, runs in deltas.appends.items():
+            for values, limit, shift in runs:
+                appends.extend(
+                    ujson.dumps([path, value, limit, shift])
+                    for value in values)
+
+        args = [str(key), deltas.updates, len(integers) // 2] + integers + [len(floats) // 2] + floats + appends
+
+        async with self.kv.acquire() as db:
+            pending = await KeyValueProfileDeltasBuffer.ADD_SCRIPT(db, self.__keys__(key), args)
+
+        return int(pending)
+
+    async def __read__(self, key, delete):
+        async with self.kv.acquire() as db:
+            result = await KeyValueProfileDeltasBuffer.READ_SCRIPT(
+                db, self.__keys__(key), [str(key), "1" if delete else "0"])
+
+        if not result:
+            return None
+
+        updates, integers, floats, appends = result
+
+        deltas = ProfileDeltas()
+        deltas.updates = int(updates)
+
+        for field, value in zip(integers[::2], integers[1::2]):
+            deltas.increment(tuple(ujson.loads(field)), int(value))
+
+        for field, value in zip(floats[::2], floats[1::2]):
+            deltas.increment(tuple(ujson.loads(field)), float(value))
+
+        for item in appends:
+            path, value, limit, shift = ujson.loads(item)
+            deltas.append(tuple(path), value, limit, shift)
+
+        return deltas
+
+    async def take(self, key):
+        return await self.__read__(key, True)
+
+    async def peek(self, key):
+        return await self.__read__(key, False)
+
+    async def keys(self):
+        result = []
+
+        async with self.kv.acquire() as db:
+            for bucket in range(self.buckets):
+                keys = await db.smembers(self.__bucket__(bucket) + "keys")
+                result.extend(key.decode() if isinstance(key, bytes) else key for key in keys)
+
+        return result
 
 
 class PredefinedProfile(Profile):
@@ -263,6 +263,14 @@ class RabbitMQJsonRPC(jsonrpc.JsonRPC):
         result = await self.send_request(context, method, timeout, *args, **kwargs)
         return result
 
+    async def send_mq_request_many(self, service, calls, timeout=jsonrpc.JSONRPC_TIMEOUT):
+        """
+        Same as send_mq_request, but for a batch of calls (see JsonRPC.send_request_many)
+        """
+        context = await self.__get_context__(service)
+        futures = await self.send_request_many(context, calls, timeout)
+        return futures
+
     async def send_mq_rpc(self, service, method, *args, **kwargs):
         """
         This method has to be distinguished from send_rpc because it does not yet have a context required
@@ -1,19 +1,573 @@
 
 from . import keyvalue, to_int
+from . keyvalue import Script
 from . options import options
 
+from abc import ABCMeta, abstractmethod
+from expiringdict import ExpiringDict
+from tornado.gen import multi
+from tornado.ioloop import PeriodicCallback
+
+import heapq
 import logging
+import time
 
 
 class RateLimitExceeded(Exception):
-    pass
+    def __init__(self, retry_after=None):
+        """
+        :param retry_after: (if known) in how many seconds the action is going to be allowed again
+        """
+        self.retry_after = retry_after
+
+
+class RateLimitEngine(object, metaclass=ABCMeta):
+    """
+    An algorithm to count the actions with. Every call to `limit` should either reserve one action,
+        or raise RateLimitExceeded.
+
+    All keys of a single (action, key) pair have the same hash tag (except for the buckets engine outside
+        of sharded mode), so they end up on the same node in sharded mode (see keyvalue.HashRing).
+
+    Engines that can reserve several actions at once (CAN_RESERVE) may be used with leases (see RateLimit),
+        engines that define an `entry` (MULTI_KIND) can be checked together with others in a single atomic
+        call (see RateLimit.limit_many and MULTI_SCRIPT).
+    """
+
+    # True if the engine implements `reserve`
+    CAN_RESERVE = False
+
+    # a kind of entry in MULTI_SCRIPT, None if the engine cannot be a part of it
+    MULTI_KIND = None
+
+    def __init__(self, sharded=False):
+        """
+        :param sharded: True if the key/value storage is sharded (see keyvalue.ShardedConnection)
+        """
+        self.sharded = sharded
+
+    @staticmethod
+    def prefix(action, key):
+        return "{" + action + ":" + key + "}"
+
+    @abstractmethod
+    async def limit(self, db, action, key, max_requests, requests_in_time):
+        """
+        Reserves one action <action> for key <key>
+
+        :returns a state object that is passed to `rollback` later
+        :raises RateLimitExceeded If the limit is exceeded
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def rollback(self, db, action, key, state):
+        """
+        Gives back an action previously reserved with `limit`
+        """
+        raise NotImplementedError()
+
+    async def reserve(self, db, action, key, max_requests, requests_in_time, amount):
+        """
+        Reserves up to <amount> actions at once, used to lease a part of the limit to spend it locally.
+        Reserved actions cannot be given back. Only called if CAN_RESERVE is True.
+
+        :returns a tuple (reserved amount, retry after in seconds if nothing is reserved)
+        """
+        raise NotImplementedError("{0} cannot reserve actions".format(self.__class__.__name__))
+
+    def entry(self, action, key, max_requests, requests_in_time, now):
+        """
+        Describes a check of one action for MULTI_SCRIPT. Only called if MULTI_KIND is set.
+
+        :returns a tuple (two keys, four arguments, a state object that is passed to `rollback` later)
+        """
+        raise NotImplementedError("{0} cannot be a part of MULTI_SCRIPT".format(self.__class__.__name__))
+
+    def multi_retry_after(self, max_requests, requests_in_time, now, a, b):
+        """
+        :returns in how many seconds the action is allowed again, out of what MULTI_SCRIPT returned
+        """
+        raise NotImplementedError("{0} cannot be a part of MULTI_SCRIPT".format(self.__class__.__name__))
+
+
+class BucketsRateLimitEngine(RateLimitEngine):
+    """
+    The original scheme: four overlapping fixed buckets of 1/8, 1/4, 1/2 and 1 of the limit,
+        spanning 1x, 2x, 4x and 8x of the time, each should have something left.
+
+    Costs two round trips (MGET and a pipeline), and the check is not atomic with the decrement,
+        so concurrent calls may overshoot the limit.
+
+    The keys keep the original format "rate:<action>:<key>:<range>", so the counters survive an upgrade.
+        Only in sharded mode (which the original scheme did not support, so there's nothing to keep)
+        they are "rate:{<action>:<key>}:<range>", for MGET to find all of them on one node.
+    """
+
+    RANGES = [(8, 16), (4, 8), (2, 4), (1, 1)]
+
+    def keys(self, action, key):
+        if self.sharded:
+            prefix = "rate:" + RateLimitEngine.prefix(action, key) + ":"
+        else:
+            prefix = "rate:" + action + ":" + key + ":"
+
+        return [
+            prefix + str(range_)
+            for range_, time_ in BucketsRateLimitEngine.RANGES
+        ]
+
+    async def limit(self, db, action, key, max_requests, requests_in_time):
+        keys = self.keys(action, key)
+        values = await db.mget(*keys)
+
+        for value in values:
+            if value is not None and to_int(value) <= 0:
+                raise RateLimitExceeded()
+
+        pipe = db.pipeline()
+
+        for (range_, time_), value, key_ in zip(BucketsRateLimitEngine.RANGES, values, keys):
+            if value is None:
+                pipe.setex(key_, requests_in_time * time_, max_requests * range_ - 1)
+            else:
+                pipe.decr(key_)
+
+        await pipe.execute()
+
+    async def rollback(self, db, action, key, state):
+        keys = self.keys(action, key)
+
+        values = await db.mget(*keys)
+        pipe = db.pipeline()
+
+        for key_, value in zip(keys, values):
+            if value is not None:
+                pipe.incr(key_)
+
+        await pipe.execute()
+
+
+class SlidingWindowRateLimitEngine(RateLimitEngine):
+    """
+    Sliding window counter: the count of the previous fixed window, weighted by how much of it still overlaps
+        the sliding window, plus the count of the current one. Check and increment are done atomically
+        in a single Lua call (one round trip).
+    """
+
+    CAN_RESERVE = True
+
+    SCRIPT = Script("""
+        local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+        local previous = tonumber(redis.call('GET', KEYS[2]) or '0')
+        local limit = tonumber(ARGV[1])
+        local weight = tonumber(ARGV[3])
+        local available = limit - math.floor(previous * weight) - current
+
+        if available <= 0 then
+            return {0, current, previous}
+        end
+
+        local granted = math.min(available, tonumber(ARGV[4]))
+
+        redis.call('INCRBY', KEYS[1], granted)
+        redis.call('EXPIRE', KEYS[1], tonumber(ARGV[2]) * 2)
+        return {granted, current, previous}
+    """)
+
+    @staticmethod
+    def retry_after(max_requests, requests_in_time, weight, current, previous):
+        # the weight of the previous window decreases linearly until the end of the current window
+        if current < max_requests:
+            if previous <= 0:
+                return 0
+            return max(0.0, (weight - float(max_requests - current) / previous) * requests_in_time)
+
+        # the current window has to become the previous one and lose enough weight
+        return (weight + 1.0 - float(max_requests) / current) * requests_in_time
+
+    async def __call__(self, db, action, key, max_requests, requests_in_time, amount):
+        window, weight = SlidingWindowRateLimitEngine.window(time.time(), requests_in_time)
+
+        prefix = "rate_w:" + RateLimitEngine.prefix(action, key) + ":"
+        current_key = prefix + str(window)
+
+        granted, current, previous = await SlidingWindowRateLimitEngine.SCRIPT(
+            db,
+            keys=[current_key, prefix + str(window - 1)],
+            args=[max_requests, requests_in_time, "{0:.6f}".format(weight), amount])
+
+        if not to_int(granted):
+            return 0, current_key, SlidingWindowRateLimitEngine.retry_after(
+                max_requests, requests_in_time, weight, to_int(current), to_int(previous))
+
+        return to_int(granted), current_key, None
+
+    async def limit(self, db, action, key, max_requests, requests_in_time):
+        granted, current_key, retry_after = await self(db, action, key, max_requests, requests_in_time, 1)
+
+        if not granted:
+            raise RateLimitExceeded(retry_after)
+
+        return current_key
+
+    async def reserve(self, db, action, key, max_requests, requests_in_time, amount):
+        granted, current_key, retry_after = await self(db, action, key, max_requests, requests_in_time, amount)
+        return granted, retry_after
+
+    MULTI_KIND = "w"
+
+    @staticmethod
+    def window(now, requests_in_time):
+        window = int(now // requests_in_time)
+        return window, 1.0 - (now - window * requests_in_time) / requests_in_time
+
+    def entry(self, action, key, max_requests, requests_in_time, now):
+        window, weight = SlidingWindowRateLimitEngine.window(now, requests_in_time)
+        prefix = "rate_w:" + RateLimitEngine.prefix(action, key) + ":"
+        current_key = prefix + str(window)
+
+        return (
+            [current_key, prefix + str(window - 1)],
+            [SlidingWindowRateLimitEngine.MULTI_KIND, max_requests, requests_in_time, "{0:.6f}".format(weight)],
+            current_key)
+
+    def multi_retry_after(self, max_requests, requests_in_time, now, a, b):
+        window, weight = SlidingWindowRateLimitEngine.window(now, requests_in_time)
+        return SlidingWindowRateLimitEngine.retry_after(max_requests, requests_in_time, weight, a, b)
+
+    # the window may have expired already, a bare DECR would bring it back with no TTL
+    ROLLBACK_SCRIPT = Script("""
+        if redis.call('EXISTS', KEYS[1]) == 1 then
+            return redis.call('DECR', KEYS[1])
+        end
+        return 0
+    """)
+
+    async def rollback(self, db, action, key, state):
+        await SlidingWindowRateLimitEngine.ROLLBACK_SCRIPT(db, keys=[state], args=[])
+
+
+class TokenBucketRateLimitEngine(RateLimitEngine):
+    """
+    Token bucket: the bucket holds up to <max_requests> tokens and refills at <max_requests>/<requests_in_time>
+        tokens per second, every action takes one token. Unlike the windows, allows bursts of the full size
+        after a quiet period. Check and take are done atomically in a single Lua call (one round trip).
+    """
+
+    CAN_RESERVE = True
+
+    SCRIPT = Script("""
+        local capacity = tonumber(ARGV[1])
+        local rate = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+
+        local data = redis.call('HMGET', KEYS[1], 't', 'ts')
+        local tokens = tonumber(data[1])
+        local ts = tonumber(data[2])
+
+        if tokens == nil or ts == nil then
+            tokens = capacity
+            ts = now
+        end
+
+        tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+        local granted = math.min(math.floor(tokens), tonumber(ARGV[5]))
+        local wait = 0
+
+        if granted > 0 then
+            tokens = tokens - granted
+        else
+            granted = 0
+            wait = math.ceil((1 - tokens) / rate * 1000)
+        end
+
+        redis.call('HMSET', KEYS[1], 't', tostring(tokens), 'ts', tostring(now))
+        redis.call('EXPIRE', KEYS[1], tonumber(ARGV[4]))
+        return {granted, wait}
+    """)
+
+    @staticmethod
+    def key(action, key):
+        return "rate_t:" + RateLimitEngine.prefix(action, key)
+
+    async def reserve(self, db, action, key, max_requests, requests_in_time, amount):
+        granted, wait = await TokenBucketRateLimitEngine.SCRIPT(
+            db,
+            keys=[TokenBucketRateLimitEngine.key(action, key)],
+            args=[
+                max_requests,
+                "{0:.6f}".format(float(max_requests) / requests_in_time),
+                "{0:.6f}".format(time.time()),
+                requests_in_time * 2,
+                amount])
+
+        if not to_int(granted):
+            return 0, to_int(wait) / 1000.0
+
+        return to_int(granted), None
+
+    async def limit(self, db, action, key, max_requests, requests_in_time):
+        granted, retry_after = await self.reserve(db, action, key, max_requests, requests_in_time, 1)
+
+        if not granted:
+            raise RateLimitExceeded(retry_after)
+
+    MULTI_KIND = "t"
+
+    def entry(self, action, key, max_requests, requests_in_time, now):
+        key_ = TokenBucketRateLimitEngine.key(action, key)
+
+        return (
+            [key_, key_],
+            [TokenBucketRateLimitEngine.MULTI_KIND, max_requests, requests_in_time, "{0:.6f}".format(now)],
+            None)
+
+    def multi_retry_after(self, max_requests, requests_in_time, now, a, b):
+        return a / 1000.0
+
+    # the bucket may have expired already, a bare HINCRBYFLOAT would bring it back with no TTL (and no 'ts')
+    ROLLBACK_SCRIPT = Script("""
+        if redis.call('HEXISTS', KEYS[1], 'ts') == 1 then
+            redis.call('HINCRBYFLOAT', KEYS[1], 't', 1)
+        end
+        return 0
+    """)
+
+    async def rollback(self, db, action, key, state):
+        await TokenBucketRateLimitEngine.ROLLBACK_SCRIPT(
+            db, keys=[TokenBucketRateLimitEngine.key(action, key)], args=[])
+
+
+MULTI_SCRIPT = Script("""
+    -- every entry takes two keys and four arguments: kind, limit, period, and
+    --   for the window (w): the weight of the previous window
+    --   for the token bucket (t): current time
+    -- nothing is taken unless every entry is allowed
+
+    local count = #ARGV / 4
+    local tokens = {}
+
+    for i = 1, count do
+        local kind = ARGV[i * 4 - 3]
+        local limit = tonumber(ARGV[i * 4 - 2])
+        local period = tonumber(ARGV[i * 4 - 1])
+        local value = tonumber(ARGV[i * 4])
+
+        if kind == 'w' then
+            local current = tonumber(redis.call('GET', KEYS[i * 2 - 1]) or '0')
+            local previous = tonumber(redis.call('GET', KEYS[i * 2]) or '0')
+
+            if math.floor(previous * value) + current >= limit then
+                return {i, current, previous}
+            end
+        else
+            local rate = limit / period
+            local data = redis.call('HMGET', KEYS[i * 2 - 1], 't', 'ts')
+            local t = tonumber(data[1])
+            local ts = tonumber(data[2])
+
+            if t == nil or ts == nil then
+                t = limit
+                ts = value
+            end
+
+            t = math.min(limit, t + math.max(0, value - ts) * rate)
+
+            if t < 1 then
+                return {i, math.ceil((1 - t) / rate * 1000), 0}
+            end
+
+            tokens[i] = t
+        end
+    end
+
+    for i = 1, count do
+        local period = tonumber(ARGV[i * 4 - 1])
+
+        if ARGV[i * 4 - 3] == 'w' then
+            redis.call('INCR', KEYS[i * 2 - 1])
+        else
+            redis.call('HMSET', KEYS[i * 2 - 1], 't', tostring(tokens[i] - 1), 'ts', ARGV[i * 4])
+        end
+
+        redis.call('EXPIRE', KEYS[i * 2 - 1], period * 2)
+    end
+
+    return {0, 0, 0}
+""")
+
+
+class HeavyHitters(object):
+    """
+    Space-Saving sketch: approximately the most frequent keys of a stream, in a fixed amount of memory.
+
+    At most <capacity> keys are counted. When a new key comes and there's no room left, it replaces
+        the least counted one and inherits its count (which is remembered as the error of the new key).
+        Any key that appears more than total/<capacity> times is guaranteed to be in the sketch,
+        and its count is overestimated by at most its error.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.total = 0
+        # key -> [count, error]
+        self.counters = {}
+        # a min-heap of (count, key), an entry per key. Counts only grow, so the entries are allowed to lag
+        #   behind the counters, and are brought up to date only when they get to the top
+        self.heap = []
+
+    def add(self, key, amount=1):
+        self.total += amount
+
+        counter = self.counters.get(key)
+
+        if counter is not None:
+            counter[0] += amount
+            return
+
+        if len(self.counters) < self.capacity:
+            self.counters[key] = [amount, 0]
+            heapq.heappush(self.heap, (amount, key))
+            return
+
+        least_count = self.__pop_least__()
+        self.counters[key] = [least_count + amount, least_count]
+        heapq.heappush(self.heap, (least_count + amount, key))
+
+    def __pop_least__(self):
+        # amortized O(log capacity): every stale entry on the way is an increment that happened before
+        while True:
+            count, key = self.heap[0]
+            actual = self.counters[key][0]
+
+            if actual == count:
+                heapq.heappop(self.heap)
+                del self.counters[key]
+                return count
+
+            heapq.heapreplace(self.heap, (actual, key))
+
+    def top(self, n):
+        """
+        :returns a list of (key, count, error) tuples, the most counted first
+        """
+        return sorted(
+            ((key, count, error) for key, (count, error) in self.counters.items()),
+            key=lambda item: item[1], reverse=True)[:n]
+
+    def __len__(self):
+        return len(self.counters)
+
+
+class RateLimitTelemetry(object):
+    """
+    Counts admitted and rejected keys per action (see HeavyHitters), and every <report_period> seconds
+        reports totals to the monitoring as "ratelimit.verdicts" action, and how concentrated the rejections are
+        as "ratelimit.offenders" (the number of keys rejected, the count of the top one, and the share
+        of the top <report_top> in the total), both tagged with the action only, then starts over.
+
+    The keys themselves (account ids, addresses) are never sent to the monitoring, as every one of them would
+        become a series of its own. The current and the last reported periods are kept for the admin view
+        instead (see admin.RateLimitAdminController).
+    """
+
+    VERDICTS = ("admitted", "rejected")
+
+    def __init__(self, capacity=1000, report_period=60, report_top=10):
+        self.capacity = capacity
+        self.report_top = report_top
+        self.started = time.time()
+        # action -> verdict -> HeavyHitters
+        self.sketches = {}
+        self.reported = {}
+        self.reported_period = None
+
+        if report_period:
+            self.report_callback = PeriodicCallback(self.__report__, report_period * 1000)
+            self.report_callback.start()
+        else:
+            self.report_callback = None
+
+    def add(self, action, key, verdict):
+        sketches = self.sketches.get(action)
+
+        if sketches is None:
+            sketches = {v: HeavyHitters(self.capacity) for v in RateLimitTelemetry.VERDICTS}
+            self.sketches[action] = sketches
+
+        sketches[verdict].add(key)
+
+    def top(self, n):
+        """
+        :returns a dict action -> verdict -> {"total": <total>, "keys": <keys tracked>,
+            "top": [(key, count, error), ...]} for the current period
+        """
+        return {
+            action: {
+                verdict: {"total": sketch.total, "keys": len(sketch), "top": sketch.top(n)}
+                for verdict, sketch in sketches.items()
+            }
+            for action, sketches in self.sketches.items()
+        }
+
+    def __report__(self):
+        from . import monitoring
+
+        now = time.time()
+        top = self.top(self.report_top)
+
+        for action, verdicts in top.items():
+            monitoring.monitor_action("ratelimit.verdicts", {
+                verdict: data["total"]
+                for verdict, data in verdicts.items()
+            }, action=action)
+
+            rejected = verdicts["rejected"]
+
+            if rejected["top"]:
+                monitoring.monitor_action("ratelimit.offenders", {
+                    "keys": rejected["keys"],
+                    "top_count": rejected["top"][0][1],
+                    "top_share": float(sum(count for key, count, error in rejected["top"])) / rejected["total"]
+                }, action=action, verdict="rejected")
+
+        self.reported = top
+        self.reported_period = (self.started, now)
+        self.sketches = {}
+        self.started = now
+
+    def stop(self):
+        if self.report_callback is not None:
+            self.report_callback.stop()
+
+
+class RateLimitLease(object):
+    """
+    A part of the limit reserved from the storage, that is spent locally (see RateLimit lease argument)
+    """
+
+    def __init__(self, remaining, expires):
+        self.remaining = remaining
+        self.expires = expires
+
+    def take(self, now):
+        if self.remaining <= 0 or now >= self.expires:
+            return False
+
+        self.remaining -= 1
+        return True
 
 
 class RateLimitLock(object):
-    def __init__(self, limit, action, key):
+    def __init__(self, limit, action, key, engine=None, state=None, lease=None):
         self.limit = limit
         self.action = action
         self.key = key
+        self.engine = engine or limit.engines[RateLimit.DEFAULT_ENGINE]
+        self.state = state
+        self.lease = lease
         self._allowed = True
 
     async def rollback(self):
@@ -22,20 +576,24 @@ class RateLimitLock(object):
 
         self._allowed = False
 
+        if self.lease is not None:
+            self.lease.remaining += 1
+            return
+
         async with self.limit.kv.acquire() as db:
-            keys = [
-                "rate:" + self.action + ":" + self.key + ":" + str(range_)
-                for range_, time_ in RateLimit.RANGES
-            ]
+            await self.engine.rollback(db, self.action, self.key, self.state)
+
 
-            values = await db.mget(*keys)
-            pipe = db.pipeline()
+class RateLimitLocks(object):
+    """
+    A combined lock of several actions, returned by RateLimit.limit_many
+    """
 
-            for key, value in zip(keys, values):
-                if value is not None:
-                    pipe.incr(key)
+    def __init__(self, locks):
+        self.locks = locks
 
-            await pipe.execute()
+    async def rollback(self):
+        await multi([lock.rollback() for lock in self.locks])
 
 
 class RateLimit(object):
@@ -45,15 +603,16 @@ class RateLimit(object):
     Initialization (see constructor):
 
     RateLimit({
-        "start_server": (1, 15),
-        "upload_score": (10, 60)
+        "start_server": "1,15",
+        "upload_score": "10,60,window"
     })
 
     Usage:
 
     try:
         limit = await ratelimit.limit("test", 5)
-    except RateLimitExceeded:
+    except RateLimitExceeded as e:
+        # e.retry_after may tell when to try again
         code_is_not_allowed()
     else:
         try:
@@ -64,34 +623,87 @@ class RateLimit(object):
 
     """
 
-    RANGES = [(8, 16), (4, 8), (2, 4), (1, 1)]
+    RANGES = BucketsRateLimitEngine.RANGES
+
+    DEFAULT_ENGINE = "buckets"
+
+    ENGINES = {
+        "buckets": BucketsRateLimitEngine,
+        "window": SlidingWindowRateLimitEngine,
+        "token_bucket": TokenBucketRateLimitEngine
+    }
+
+    # how many of (action, key) pairs to keep local verdicts and leases for
+    LOCAL_MAX_KEYS = 100000
+    # how long at most the local verdicts and leases live
+    LOCAL_MAX_AGE = 60
 
-    def __init__(self, actions):
+    def __init__(self, actions, kv=None, engine=DEFAULT_ENGINE, local_deny=False, lease=0, telemetry=None):
         """
         :param actions: A disc of tuples where:
 
             A key: is action to be limited
-            A value is (amount, time) - maximum <amount> of actions for a <time>
+            A value is "amount,time[,engine]" - maximum <amount> of actions for a <time>,
+                optionally counted with the engine <engine> (see RateLimit.ENGINES)
 
             Missing actions considered unlimited
 
+        :param kv: A key/value storage to use, if not passed, a one is created from rate_cache_* options
+        :param engine: An engine to use for actions that have no engine defined:
+
+            buckets: (the default) four overlapping fixed buckets, two round trips, not atomic
+            window: atomic sliding window counter, one round trip
+            token_bucket: atomic token bucket, one round trip, allows bursts
+
+        :param local_deny: If True, once a key exceeded the limit, every call until the moment it's known to be
+            allowed again (see RateLimitExceeded.retry_after) is rejected locally, without asking the storage.
+            Engines that don't tell the moment (buckets) are rejected locally for 1/<amount> of the <time>.
+
+        :param lease: A fraction of the limit (0..1) this process may reserve at once and spend locally.
+            For example, with "100,60" and lease=0.05 this process asks the storage once for every 5 actions.
+            Leased actions are never over-admitted, but those not spent within lease * <time>
+            are lost, so up to <lease> * <amount> actions per process may be under-admitted: this is the
+            error bound. Only the engines that support reservation (window, token_bucket) use leases.
+
+        :param telemetry: A RateLimitTelemetry to count admitted and rejected keys with, if not passed,
+            a one is created if the option rate_cache_telemetry is set
+
         """
-        self.kv = keyvalue.KeyValueStorage(
+        self.kv = kv or keyvalue.KeyValueStorage(
             host=options.rate_cache_host,
             port=options.rate_cache_port,
             db=options.rate_cache_db,
-            max_connections=options.rate_cache_max_connections)
+            max_connections=options.rate_cache_max_connections,
+            nodes=options.rate_cache_nodes if "rate_cache_nodes" in options else None,
+            min_connections=options.rate_cache_min_connections if "rate_cache_min_connections" in options else 1,
+            idle_timeout=options.rate_cache_idle_timeout if "rate_cache_idle_timeout" in options else 0,
+            name="rate_cache")
+
+        self.engines = {
+            engine_name: engine_class(sharded=self.kv.sharded is not None)
+            for engine_name, engine_class in RateLimit.ENGINES.items()
+        }
+
+        if engine not in self.engines:
+            raise KeyError("No such rate limit engine: " + str(engine))
 
         self.actions = {}
 
         for action_name, value in actions.items():
             split = value.split(",")
-            if len(split) != 2:
+            if len(split) not in (2, 3):
                 logging.error("Bad tuple {0}: wrong number of arguments, expected {1}, got {2}".format(
                     action_name, 2, len(split)
                 ))
                 continue
 
+            action_engine = split[2].strip() if len(split) == 3 else engine
+            if action_engine not in self.engines:
+                logging.error("Bad tuple {0}: no such engine {1}".format(
+                    action_name, action_engine
+                ))
+                continue
+
             try:
                 value_a = int(split[0])
                 value_b = int(split[1])
@@ -101,7 +713,50 @@ class RateLimit(object):
                 ))
                 continue
             else:
-                self.actions[action_name] = (value_a, value_b)
+                self.actions[action_name] = (value_a, value_b, self.engines[action_engine])
+
+        self.local_deny = local_deny
+        self.lease = lease
+
+        # (action, key) -> the time the key is allowed again
+        self.denied = ExpiringDict(RateLimit.LOCAL_MAX_KEYS, RateLimit.LOCAL_MAX_AGE) if local_deny else None
+        # (action, key) -> RateLimitLease
+        self.leases = ExpiringDict(RateLimit.LOCAL_MAX_KEYS, RateLimit.LOCAL_MAX_AGE) if lease else None
+
+        if telemetry is None and "rate_cache_telemetry" in options and options.rate_cache_telemetry:
+            telemetry = RateLimitTelemetry(
+                capacity=options.rate_cache_telemetry_capacity if "rate_cache_telemetry_capacity" in options else 1000,
+                report_period=options.rate_cache_telemetry_period if "rate_cache_telemetry_period" in options else 60)
+
+        self.telemetry = telemetry
+
+    def __deny__(self, local_key, now, retry_after, requests_in_time, max_requests):
+        if self.denied is None:
+            return
+
+        if retry_after is None:
+            retry_after = float(requests_in_time) / max_requests
+
+        self.denied[local_key] = now + min(retry_after, RateLimit.LOCAL_MAX_AGE)
+
+    async def __lease__(self, local_key, now, action, key, max_requests, requests_in_time, engine):
+        lease = self.leases.get(local_key)
+
+        if lease is not None and lease.take(now):
+            return RateLimitLock(self, action, key, engine, lease=lease)
+
+        amount = max(1, int(max_requests * self.lease))
+
+        async with self.kv.acquire() as db:
+            granted, retry_after = await engine.reserve(db, action, key, max_requests, requests_in_time, amount)
+
+        if not granted:
+            self.__deny__(local_key, now, retry_after, requests_in_time, max_requests)
+            raise RateLimitExceeded(retry_after)
+
+        lease = RateLimitLease(granted - 1, now + self.lease * requests_in_time)
+        self.leases[local_key] = lease
+        return RateLimitLock(self, action, key, engine, lease=lease)
 
     async def limit(self, action, key):
         """
@@ -116,30 +771,126 @@ class RateLimit(object):
         if not limit:
             return True
 
-        max_requests, requests_in_time = limit
+        if self.telemetry is None:
+            return await self.__limit__(action, key, limit)
 
-        async with self.kv.acquire() as db:
+        try:
+            lock = await self.__limit__(action, key, limit)
+        except RateLimitExceeded:
+            self.telemetry.add(action, key, "rejected")
+            raise
+
+        self.telemetry.add(action, key, "admitted")
+        return lock
+
+    async def __limit__(self, action, key, limit):
+        max_requests, requests_in_time, engine = limit
+
+        local_key = (action, key)
+        now = time.time()
 
-            keys = [
-                "rate:" + action + ":" + key + ":" + str(range_)
-                for range_, time_ in RateLimit.RANGES
-            ]
+        if self.denied is not None:
+            denied_until = self.denied.get(local_key)
+            if denied_until is not None and now < denied_until:
+                raise RateLimitExceeded(denied_until - now)
 
-            values = await db.mget(*keys)
+        if self.leases is not None and engine.CAN_RESERVE:
+            return await self.__lease__(local_key, now, action, key, max_requests, requests_in_time, engine)
+
+        try:
+            async with self.kv.acquire() as db:
+                state = await engine.limit(db, action, key, max_requests, requests_in_time)
+                return RateLimitLock(self, action, key, engine, state)
+        except RateLimitExceeded as e:
+            self.__deny__(local_key, now, e.retry_after, requests_in_time, max_requests)
+            raise
+
+    async def limit_many(self, pairs):
+        """
+        Tries to proceed several actions at once, for example, both per account and per ip address:
 
-            for value in values:
-                if value is not None and to_int(value) <= 0:
-                    raise RateLimitExceeded()
+            limit = await ratelimit.limit_many([("login", account), ("login_ip", ip)])
 
-            pipe = db.pipeline()
+        Either every action is allowed, or none of them is used up.
 
-            for (range_, time_), value in zip(RateLimit.RANGES, values):
-                key_ = "rate:" + action + ":" + key + ":" + str(range_)
+        If all of the actions use the engines that support it (window, token_bucket), they are checked
+            and reserved in a single atomic call. Otherwise (buckets engine, or in sharded mode, when
+            the keys live on different nodes) they are reserved one by one, and the reserved ones are
+            rolled back if one of them is exceeded.
+
+        :param pairs: a list of (action, key) tuples, each pair should not appear twice
+        :returns RateLimitLocks That allows to rollback all of the actions at once
+        :raises RateLimitExceeded If any of the actions exceeded its limit
+        """
+
+        entries = []
+        now = time.time()
+
+        for action, key in pairs:
+            limit = self.actions.get(action)
+
+            if not limit:
+                continue
 
-                if value is None:
-                    pipe.setex(key_, requests_in_time * time_, max_requests * range_ - 1)
-                else:
-                    pipe.decr(key_)
+            if self.denied is not None:
+                denied_until = self.denied.get((action, key))
+                if denied_until is not None and now < denied_until:
+                    if self.telemetry is not None:
+                        self.telemetry.add(action, key, "rejected")
+                    raise RateLimitExceeded(denied_until - now)
 
-            await pipe.execute()
-            return RateLimitLock(self, action, key)
+            entries.append((action, key) + limit)
+
+        if not entries:
+            return RateLimitLocks([])
+
+        if all(engine.MULTI_KIND for action, key, max_requests, requests_in_time, engine in entries):
+            try:
+                locks = await self.__limit_atomic__(entries, now)
+            except keyvalue.ShardingError:
+                pass
+            else:
+                if self.telemetry is not None:
+                    for action, key, max_requests, requests_in_time, engine in entries:
+                        self.telemetry.add(action, key, "admitted")
+                return locks
+
+        locks = []
+
+        try:
+            for action, key, max_requests, requests_in_time, engine in entries:
+                locks.append(await self.limit(action, key))
+        except RateLimitExceeded:
+            await RateLimitLocks(locks).rollback()
+            raise
+
+        return RateLimitLocks(locks)
+
+    async def __limit_atomic__(self, entries, now):
+        keys = []
+        args = []
+        states = []
+
+        for action, key, max_requests, requests_in_time, engine in entries:
+            entry_keys, entry_args, state = engine.entry(action, key, max_requests, requests_in_time, now)
+            keys.extend(entry_keys)
+            args.extend(entry_args)
+            states.append(state)
+
+        async with self.kv.acquire() as db:
+            failed, a, b = await MULTI_SCRIPT(db, keys=keys, args=args)
+
+        failed = to_int(failed)
+
+        if failed:
+            action, key, max_requests, requests_in_time, engine = entries[failed - 1]
+            retry_after = engine.multi_retry_after(max_requests, requests_in_time, now, to_int(a), to_int(b))
+            self.__deny__((action, key), now, retry_after, requests_in_time, max_requests)
+            if self.telemetry is not None:
+                self.telemetry.add(action, key, "rejected")
+            raise RateLimitExceeded(retry_after)
+
+        return RateLimitLocks([
+            RateLimitLock(self, action, key, engine, state)
+            for (action, key, max_requests, requests_in_time, engine), state in zip(entries, states)
+        ])
@@ -61,6 +61,12 @@ class Server(tornado.web.Application):
         self.http_server = None
         self.api_version = options.api_version
 
+        validate.set_json_limits(
+            max_size=options.json_max_size,
+            max_depth=options.json_max_depth,
+            max_elements=options.json_max_elements,
+            max_string=options.json_max_string)
+
         handlers = self.get_handlers() or []
 
         admin_actions = self.get_admin()
@@ -248,6 +254,11 @@ class Server(tornado.web.Application):
 
          {"hello, your name is": "john"}
 
+        Several calls can be sent in a single message with internal.request_many, those are
+            processed concurrently (see __on_internal_receive__):
+
+        results = await internal.request_many("<service_id>", [("hello", {"name": "john"}), ("hello", ["jane"])])
+
         """
 
         return None
@@ -439,10 +450,13 @@ class Server(tornado.web.Application):
 
     # noinspection PyUnusedLocal
     async def __on_internal_receive__(self, context, method, *args, **kwargs):
-        if hasattr(self.internal_handler, method):
+        # requests of a batch are dispatched here concurrently (see JsonRPC.received), so any error of a single
+        # request has to end up as JsonRPCError, otherwise the whole batch would fail
 
-            if not isinstance(method, str):
-                raise jsonrpc.JsonRPCError(-32600, "Method is not a string")
+        if not isinstance(method, str):
+            raise jsonrpc.JsonRPCError(-32600, "Method is not a string")
+
+        if hasattr(self.internal_handler, method):
 
             if method.startswith("_"):
                 raise jsonrpc.JsonRPCError(-32600, "No such method")
@@ -484,6 +498,9 @@ class Server(tornado.web.Application):
         if self.subscriber:
             await self.subscriber.release()
 
+        if self.token_cache:
+            await self.token_cache.release()
+
         for model in self.get_models():
             if hasattr(model, "stopped"):
                 await model.stopped()
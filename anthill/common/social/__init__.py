@@ -52,6 +52,8 @@ class SocialNetworkAPI(object):
 
             @cached(kv=self.cache,
                     h=lambda: "auth_key:" + str(gamespace) + ":" + key_name,
+                    namespace="social",
+                    tags=lambda: ["gamespace:" + str(gamespace)],
                     ttl=300,
                     json=True)
             async def get():
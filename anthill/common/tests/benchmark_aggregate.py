@@ -0,0 +1,86 @@
+"""
+Aggregate child functions (see anthill.common.profile.Functions), the way num_child_where used to test
+every child (calling the predicate function and catching FuncError) versus the predicates resolved once,
+with and without numpy:
+
+    python -m anthill.common.tests.benchmark_aggregate
+
+All of them are applied to the same children, and are checked to produce the same results.
+"""
+
+from anthill.common.profile import Functions, FuncError
+from anthill.common import profile as profile_module
+
+import time
+
+
+CHILDREN = 10000
+ROUNDS = 5
+
+ARGUMENTS = {"@field": "score", "@test": ">=", "@where": "level", "@cond": 25, "@count": 10}
+
+
+def children(count):
+    return {str(i): {"score": (i * 7919) % 1000, "level": i % 50} for i in range(count)}
+
+
+def generic(members, arguments):
+    f = Functions.FUNCTIONS[arguments["@test"]]
+
+    def check(child):
+        try:
+            f.__func__(arguments["@where"], child.get(arguments["@where"]), arguments)
+        except FuncError:
+            return False
+        else:
+            return True
+
+    field = arguments["@field"]
+    passed = [(key, child[field]) for key, child in members.items() if check(child)]
+    return sum(value for key, value in passed), [
+        key for key, value in sorted(passed, key=lambda item: item[1], reverse=True)[:arguments["@count"]]]
+
+
+def resolved(members, arguments):
+    ignored, total = Functions.func_sum_child_where(None, members, arguments)
+    ignored, top = Functions.func_top_child_where(None, members, arguments)
+    return total, top
+
+
+def resolved_no_numpy(members, arguments):
+    numpy = profile_module.numpy
+    profile_module.numpy = None
+    try:
+        return resolved(members, arguments)
+    finally:
+        profile_module.numpy = numpy
+
+
+def measure(method, members):
+    best = None
+    result = None
+
+    # the best of several rounds, to filter out the noise
+    for round_ in range(ROUNDS):
+        started = time.time()
+        result = method(members, ARGUMENTS)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, result
+
+
+def main():
+    members = children(CHILDREN)
+    results = {}
+
+    for name, method in (("generic", generic), ("resolved", resolved), ("resolved, no numpy", resolved_no_numpy)):
+        best, results[name] = measure(method, members)
+        print("{0:<20}{1:>8.2f} ms per sum and top-{2} of {3} children".format(
+            name, best * 1000, ARGUMENTS["@count"], CHILDREN))
+
+    assert results["generic"] == results["resolved"] == results["resolved, no numpy"]
+
+
+if __name__ == "__main__":
+    main()
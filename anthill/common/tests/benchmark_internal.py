@@ -0,0 +1,108 @@
+"""
+Internal HTTP transport: the default simple_httpclient (a new connection for every request) versus
+KeepAliveHTTPClient (see anthill.common.httpconn), and libcurl if pycurl is installed:
+
+    python -m anthill.common.tests.benchmark_internal [url]
+
+Without an url, a local benchmark server is started in the same process. To keep the client and
+the server from sharing the CPU, run the server separately and pass its location:
+
+    python -m anthill.common.tests.benchmark_internal server [port]
+    python -m anthill.common.tests.benchmark_internal http://127.0.0.1:9599
+"""
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.web import Application, RequestHandler
+from tornado.gen import multi
+
+from anthill.common.httpconn import KeepAliveHTTPClient, MeasuredCurlHTTPClient
+
+from urllib import parse
+import sys
+import time
+
+
+REQUESTS = 2000
+CONCURRENCY = [1, 10, 50]
+ROUNDS = 3
+
+
+class EchoHandler(RequestHandler):
+    def get(self):
+        self.write(self.get_argument("value"))
+
+    def post(self):
+        self.write(self.get_argument("value"))
+
+
+def start_server(port=0):
+    sockets = bind_sockets(port, "127.0.0.1")
+    server = HTTPServer(Application([(r"/echo", EchoHandler)]))
+    server.add_sockets(sockets)
+    return "http://127.0.0.1:{0}".format(sockets[0].getsockname()[1])
+
+
+async def run(client, location, concurrency):
+
+    async def worker(worker_id, count):
+        for i in range(count):
+            value = "{0}-{1}".format(worker_id, i)
+            if i % 2:
+                request = HTTPRequest(location + "/echo?" + parse.urlencode({"value": value}), method="GET")
+            else:
+                request = HTTPRequest(location + "/echo", method="POST", body=parse.urlencode({"value": value}))
+            response = await client.fetch(request)
+            assert response.body.decode() == value
+
+    best = None
+
+    # the best of several rounds, to filter out the noise
+    for round_ in range(ROUNDS):
+        started = time.time()
+        await multi([worker(worker_id, REQUESTS // concurrency) for worker_id in range(concurrency)])
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    return (REQUESTS // concurrency) * concurrency / best
+
+
+async def main(location):
+    clients = [
+        ("simple", lambda concurrency: AsyncHTTPClient(force_instance=True, max_clients=concurrency)),
+        ("keepalive", lambda concurrency: KeepAliveHTTPClient(force_instance=True, max_connections=concurrency))
+    ]
+
+    if MeasuredCurlHTTPClient is not None:
+        clients.append(
+            ("curl", lambda concurrency: MeasuredCurlHTTPClient(force_instance=True, max_clients=concurrency)))
+
+    print("{0:<12}{1:>14}{2:>14}{3:>10}{4:>10}".format("client", "concurrency", "requests/s", "opened", "reused"))
+
+    for concurrency in CONCURRENCY:
+        for name, create in clients:
+            client = create(concurrency)
+            rate = await run(client, location, concurrency)
+
+            statistics = getattr(client, "statistics", None)
+            if statistics is not None:
+                opened = sum(host.opened for host in statistics.hosts.values())
+                reused = sum(host.reused for host in statistics.hosts.values())
+            else:
+                opened, reused = (REQUESTS // concurrency) * concurrency * ROUNDS, 0
+
+            client.close()
+
+            print("{0:<12}{1:>14}{2:>14.0f}{3:>10}{4:>10}".format(name, concurrency, rate, opened, reused))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+
+    if args and args[0] == "server":
+        print("Listening on " + start_server(int(args[1]) if len(args) > 1 else 9599))
+        IOLoop.current().start()
+    else:
+        IOLoop.current().run_sync(lambda: main(args[0] if args else start_server()))
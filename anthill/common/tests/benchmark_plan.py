@@ -0,0 +1,66 @@
+"""
+Profile updates, applied field by field (the way Profile.__set_profile_field__ interprets them) versus
+compiled into a cached UpdatePlan (see anthill.common.profile):
+
+    python -m anthill.common.tests.benchmark_plan
+
+Both are applied to the same profile, and are checked to produce the same result.
+"""
+
+from anthill.common.profile import Profile, UpdatePlan
+
+import time
+
+
+UPDATES = 5000
+ROUNDS = 5
+
+
+def update(i):
+    return {"stats": {
+        "score": {"@func": "<", "@cond": 50000, "@value": {"@func": "++", "@value": i % 5 + 1}},
+        "gold": {"@func": "--/0", "@value": 1},
+        "last": i
+    }}
+
+
+def interpreted(profile, fields):
+    for key, value in fields.items():
+        Profile.__set_profile_field__(profile, key, value)
+
+
+def compiled(profile, fields):
+    UpdatePlan.get(fields).apply(profile, fields)
+
+
+def measure(method, updates):
+    best = None
+    profile = None
+
+    # the best of several rounds, to filter out the noise
+    for round_ in range(ROUNDS):
+        profile = {"stats": {"score": 0, "gold": UPDATES}}
+        started = time.time()
+
+        for fields in updates:
+            method(profile, fields)
+
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, profile
+
+
+def main():
+    updates = [update(i) for i in range(UPDATES)]
+    results = {}
+
+    for name, method in (("interpreted", interpreted), ("compiled", compiled)):
+        best, results[name] = measure(method, updates)
+        print("{0:<12}{1:>10.0f} updates/s".format(name, UPDATES / best))
+
+    assert results["interpreted"] == results["compiled"]
+
+
+if __name__ == "__main__":
+    main()
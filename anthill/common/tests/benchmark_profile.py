@@ -0,0 +1,158 @@
+"""
+Contention of DatabaseProfile updates: locking (SELECT ... FOR UPDATE) versus optimistic (version column) mode.
+Requires a running MySQL, that's why it's not a part of the test suite:
+
+    python -m anthill.common.tests.benchmark_profile [host] [database] [user] [password]
+
+A number of concurrent clients increment a counter of the same (hot) profile, the table is created if missing.
+"""
+
+from tornado.ioloop import IOLoop
+from tornado.gen import multi
+
+from anthill.common.database import Database
+from anthill.common.profile import DatabaseProfile, NoDataError
+
+import ujson
+import sys
+import time
+
+
+UPDATES = 2000
+CONCURRENCY = [1, 10, 50]
+
+
+def load(profile_object):
+    # depending on the driver, json columns may come as strings
+    if isinstance(profile_object, str):
+        return ujson.loads(profile_object)
+    return profile_object
+
+
+class BenchmarkProfile(DatabaseProfile):
+    def __init__(self, db, profile_id, optimistic):
+        super(BenchmarkProfile, self).__init__(db, optimistic=optimistic)
+        self.profile_id = profile_id
+
+    async def get(self):
+        profile = await self.conn.get(
+            """
+                SELECT `profile_object`
+                FROM `benchmark_profiles`
+                WHERE `profile_id`=%s
+                FOR UPDATE;
+            """, self.profile_id)
+
+        if profile:
+            return load(profile["profile_object"])
+
+        raise NoDataError()
+
+    async def get_versioned(self):
+        profile = await self.conn.get(
+            """
+                SELECT `profile_object`, `profile_version`
+                FROM `benchmark_profiles`
+                WHERE `profile_id`=%s;
+            """, self.profile_id)
+
+        if profile:
+            return load(profile["profile_object"]), profile["profile_version"]
+
+        raise NoDataError()
+
+    async def insert(self, data):
+        await self.conn.insert(
+            """
+                INSERT INTO `benchmark_profiles`
+                (`profile_id`, `profile_object`, `profile_version`)
+                VALUES (%s, %s, 1);
+            """, self.profile_id, ujson.dumps(data))
+
+    async def update(self, data):
+        await self.conn.execute(
+            """
+                UPDATE `benchmark_profiles`
+                SET `profile_object`=%s, `profile_version`=`profile_version` + 1
+                WHERE `profile_id`=%s;
+            """, ujson.dumps(data), self.profile_id)
+
+    async def update_versioned(self, data, version):
+        updated = await self.conn.execute(
+            """
+                UPDATE `benchmark_profiles`
+                SET `profile_object`=%s, `profile_version`=`profile_version` + 1
+                WHERE `profile_id`=%s AND `profile_version`=%s;
+            """, ujson.dumps(data), self.profile_id, version)
+
+        return updated == 1
+
+
+async def run(db, profile_id, optimistic, concurrency):
+    conflicts = 0
+
+    await db.insert(
+        """
+            INSERT INTO `benchmark_profiles`
+            (`profile_id`, `profile_object`, `profile_version`)
+            VALUES (%s, '{}', 1);
+        """, profile_id)
+
+    async def client(count):
+        nonlocal conflicts
+
+        for i in range(count):
+            profile = BenchmarkProfile(db, profile_id, optimistic)
+            await profile.set_data({"counter": {"@func": "++", "@value": 1}}, path=None)
+            conflicts += profile.conflicts
+
+    started = time.time()
+    await multi([client(UPDATES // concurrency) for _ in range(concurrency)])
+    elapsed = time.time() - started
+
+    result = await db.get(
+        """
+            SELECT `profile_object`
+            FROM `benchmark_profiles`
+            WHERE `profile_id`=%s;
+        """, profile_id)
+
+    counter = load(result["profile_object"])["counter"]
+    return (UPDATES // concurrency) * concurrency / elapsed, conflicts, counter
+
+
+async def main(host, database, user, password):
+    db = Database(host=host, database=database, user=user, password=password)
+
+    await db.execute(
+        """
+            CREATE TABLE IF NOT EXISTS `benchmark_profiles` (
+                `profile_id` int(11) NOT NULL,
+                `profile_object` json NOT NULL,
+                `profile_version` int(11) NOT NULL,
+                PRIMARY KEY (`profile_id`)
+            ) ENGINE=InnoDB;
+        """)
+
+    await db.execute("DELETE FROM `benchmark_profiles`;")
+
+    print("{0:<12}{1:>14}{2:>14}{3:>12}{4:>10}".format("mode", "concurrency", "updates/s", "conflicts", "counter"))
+
+    profile_id = 0
+
+    for concurrency in CONCURRENCY:
+        for optimistic in (False, True):
+            profile_id += 1
+            rate, conflicts, counter = await run(db, profile_id, optimistic, concurrency)
+
+            print("{0:<12}{1:>14}{2:>14.0f}{3:>12}{4:>10}".format(
+                "optimistic" if optimistic else "locking", concurrency, rate, conflicts, counter))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    IOLoop.current().run_sync(lambda: main(
+        args[0] if len(args) > 0 else "127.0.0.1",
+        args[1] if len(args) > 1 else "test",
+        args[2] if len(args) > 2 else "root",
+        args[3] if len(args) > 3 else ""))
@@ -0,0 +1,88 @@
+"""
+Accuracy and throughput of the rate limit engines (see anthill.common.ratelimit).
+Requires a running Redis, that's why it's not a part of the test suite:
+
+    python -m anthill.common.tests.benchmark_ratelimit [host] [port] [db]
+
+Accuracy: a burst of concurrent calls is fired at a fresh key, the ideal number of admitted calls is the limit.
+Throughput: sequential and concurrent calls per second on keys that are never exceeded.
+"""
+
+from tornado.ioloop import IOLoop
+from tornado.gen import multi
+
+from anthill.common import random_string
+from anthill.common.keyvalue import KeyValueStorage
+from anthill.common.ratelimit import RateLimit, RateLimitExceeded
+
+import sys
+import time
+
+
+LIMIT = 100
+PERIOD = 60
+BURST = 1000
+CONCURRENCY = 50
+CALLS = 5000
+
+
+async def admitted(limit, action, key):
+    try:
+        await limit.limit(action, key)
+    except RateLimitExceeded:
+        return 0
+    else:
+        return 1
+
+
+async def accuracy(limit, action):
+    key = random_string(16)
+    total = 0
+
+    for i in range(0, BURST, CONCURRENCY):
+        results = await multi([admitted(limit, action, key) for _ in range(CONCURRENCY)])
+        total += sum(results)
+
+    return total
+
+
+async def throughput(limit, action, concurrency):
+    # a new key every LIMIT calls, so the limit is never exceeded
+    keys = [random_string(16) for _ in range(CALLS // LIMIT + 1)]
+    started = time.time()
+
+    for i in range(0, CALLS, concurrency):
+        await multi([
+            admitted(limit, action, keys[(i + j) // LIMIT])
+            for j in range(concurrency)
+        ])
+
+    return CALLS / (time.time() - started)
+
+
+async def main(host, port, db):
+    kv = KeyValueStorage(host=host, port=port, db=db, max_connections=CONCURRENCY)
+
+    engines = sorted(RateLimit.ENGINES.keys())
+    limit = RateLimit({
+        engine: "{0},{1},{2}".format(LIMIT, PERIOD, engine)
+        for engine in engines
+    }, kv=kv)
+
+    print("{0:<14}{1:>22}{2:>18}{3:>18}".format(
+        "engine", "admitted/" + str(LIMIT) + " burst", "sequential/s", "concurrent/s"))
+
+    for engine in engines:
+        admitted_calls = await accuracy(limit, engine)
+        sequential = await throughput(limit, engine, 1)
+        concurrent = await throughput(limit, engine, CONCURRENCY)
+
+        print("{0:<14}{1:>22}{2:>18.0f}{3:>18.0f}".format(engine, admitted_calls, sequential, concurrent))
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    IOLoop.current().run_sync(lambda: main(
+        args[0] if len(args) > 0 else "127.0.0.1",
+        int(args[1]) if len(args) > 1 else 6379,
+        int(args[2]) if len(args) > 2 else 15))
@@ -0,0 +1,123 @@
+"""
+Call overhead of the @validate decorator (see anthill.common.validate), the previous implementation
+(that inspected the method on every call) versus the current one (that resolves the validators once):
+
+    python -m anthill.common.tests.benchmark_validate
+
+Both are applied to the same methods, and are checked to produce the same results.
+"""
+
+from anthill.common.validate import validate, ValidationError, VALIDATORS
+
+import inspect
+import time
+
+
+CALLS = 100000
+ROUNDS = 5
+
+
+def validate_before(**fields):
+    # the previous implementation (validate_kwarg was the same as validate_arg)
+    def wrapper1(method):
+        def wrapper2(*args, **kwargs):
+
+            _args, _varargs, _varkw, _defaults_values, i1, i2, i3 = inspect.getfullargspec(method)
+
+            kwarg_defaults = {
+                key: value
+                for key, value in zip(_args[-len(_defaults_values):], _defaults_values)
+            } if _defaults_values is not None else None
+
+            def _list_args():
+                for argument_value in args:
+                    argument_name = _args.pop(0)
+                    yield (argument_name, argument_value)
+
+            def _list_kwargs():
+                for argument_name, argument_value in kwargs.items():
+                    if kwarg_defaults is None:
+                        yield (argument_name, argument_value, False)
+                    elif argument_name in kwarg_defaults:
+                        default_value = kwarg_defaults[argument_name]
+                        yield (argument_name, argument_value, argument_value == default_value)
+                    else:
+                        yield (argument_name, argument_value, False)
+
+            def validate_arg(field_name, field):
+                validator_name = fields.get(field_name)
+                if not validator_name:
+                    return field
+                if inspect.isclass(validator_name):
+                    if isinstance(field, validator_name):
+                        return field
+                    else:
+                        raise ValidationError("{0} is not a '{1}'".format(field_name, validator_name.__name__))
+                validator = VALIDATORS.get(validator_name)
+                if not validator:
+                    raise ValidationError("No such validator {0}".format(validator_name))
+                return validator(field_name, field)
+
+            return method(*[
+                validate_arg(field_name, field)
+                for field_name, field in _list_args()
+            ], **{
+                field_name: field if _default else validate_arg(field_name, field)
+                for field_name, field, _default in _list_kwargs()
+            })
+
+        return wrapper2
+    return wrapper1
+
+
+def methods(decorator):
+    @decorator(gamespace_id="int", application_name="str", application_version="str", repository_commit="str")
+    def update_commit(self, gamespace_id, application_name, application_version, repository_commit):
+        return gamespace_id, application_name, application_version, repository_commit
+
+    @decorator(url="str", ssh_private_key="str", depth="int")
+    def clone(self, url, ssh_private_key=None, depth=1):
+        return url, ssh_private_key, depth
+
+    return [
+        (update_commit, (None, "1", "app", "1.0", "abcdef"), {}),
+        (clone, (None, "git@host:repo.git"), {"ssh_private_key": "key", "depth": "5"}),
+        (clone, (None,), {"url": "git@host:repo.git", "depth": 1})
+    ]
+
+
+def measure(calls):
+    best = None
+
+    # the best of several rounds, to filter out the noise
+    for round_ in range(ROUNDS):
+        started = time.time()
+
+        for i in range(CALLS // len(calls)):
+            for method, args, kwargs in calls:
+                method(*args, **kwargs)
+
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best / CALLS * 1000000
+
+
+def main():
+    before = methods(validate_before)
+    after = methods(validate)
+    plain = methods(lambda **fields: lambda method: method)
+
+    for (method_before, args, kwargs), (method_after, ignored, ignored_) in zip(before, after):
+        assert method_before(*args, **kwargs) == method_after(*args, **kwargs)
+
+    overhead = measure(plain)
+
+    for name, calls in (("before", before), ("after", after)):
+        per_call = measure(calls)
+        print("{0:<8}{1:>8.2f} us per call, {2:.2f} us of it is the decorator".format(
+            name, per_call, per_call - overhead))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+from tornado.testing import AsyncTestCase, gen_test
+
+from anthill.common import cached, cache_key, invalidate_cache, random_string
+from anthill.common.keyvalue import KeyValueStorage
+
+
+class TestCache(AsyncTestCase):
+    """
+    Runs against a Redis at localhost:6379, skipped if there is none
+    """
+
+    def setUp(self):
+        super(TestCache, self).setUp()
+        self.kv = KeyValueStorage(host="127.0.0.1", port=6379, db=0, max_connections=4)
+        # every key (an item, a namespace, a tag) has it in
+        self.prefix = "test_" + random_string(8)
+        self.calls = {}
+
+        try:
+            self.io_loop.run_sync(self.ping, timeout=1)
+        except Exception:
+            self.kv.connection_pool.close()
+            self.skipTest("No redis at localhost:6379")
+
+    async def ping(self):
+        async with self.kv.acquire() as db:
+            await db.ping()
+
+    def tearDown(self):
+        self.io_loop.run_sync(self.cleanup)
+        self.kv.stop()
+        super(TestCache, self).tearDown()
+
+    async def cleanup(self):
+        async with self.kv.acquire() as db:
+            keys = await db.keys("*" + self.prefix + "*")
+            if keys:
+                await db.delete(*keys)
+
+        self.kv.connection_pool.close()
+        await self.kv.connection_pool.wait_closed()
+
+    def cached_call(self, name, **kwargs):
+        @cached(kv=self.kv, h=self.prefix + ":" + name, json=True, check_is_cached=True, **kwargs)
+        async def call():
+            self.calls[name] = self.calls.get(name, 0) + 1
+            return name
+
+        return call
+
+    @gen_test
+    async def test_plain_key(self):
+        call = self.cached_call("a")
+
+        self.assertEqual(await call(), ("a", False))
+        self.assertEqual(await call(), ("a", True))
+
+        # stored under the very same key as before the namespaces
+        async with self.kv.acquire() as db:
+            self.assertEqual(await cache_key(db, self.prefix + ":a"), self.prefix + ":a")
+            self.assertEqual(await db.get(self.prefix + ":a"), b'"a"')
+
+    @gen_test
+    async def test_namespace(self):
+        a = self.cached_call("a", namespace=self.prefix + "_a")
+        b = self.cached_call("b", namespace=self.prefix + "_b")
+
+        for i in range(2):
+            await a()
+            await b()
+
+        self.assertEqual(self.calls, {"a": 1, "b": 1})
+
+        await invalidate_cache(self.kv, namespace=self.prefix + "_a")
+
+        self.assertEqual(await a(), ("a", False))
+        self.assertEqual(await b(), ("b", True))
+        self.assertEqual(await a(), ("a", True))
+        self.assertEqual(self.calls, {"a": 2, "b": 1})
+
+    @gen_test
+    async def test_tags(self):
+        state = {"name": "x"}
+
+        @cached(kv=self.kv, h=lambda: self.prefix + ":" + state["name"],
+                tags=lambda: [self.prefix + ":" + state["name"], self.prefix + ":all"], json=True, check_is_cached=True)
+        async def call():
+            self.calls[state["name"]] = self.calls.get(state["name"], 0) + 1
+            return state["name"]
+
+        for name in ("x", "y", "x", "y"):
+            state["name"] = name
+            await call()
+
+        self.assertEqual(self.calls, {"x": 1, "y": 1})
+
+        # the tags are resolved per call, so only the items of "x" are marked by its tag
+        await invalidate_cache(self.kv, tags=[self.prefix + ":x"])
+
+        state["name"] = "x"
+        self.assertEqual(await call(), ("x", False))
+        state["name"] = "y"
+        self.assertEqual(await call(), ("y", True))
+
+        # a tag they share
+        await invalidate_cache(self.kv, tags=[self.prefix + ":all"])
+
+        self.assertEqual(await call(), ("y", False))
+        state["name"] = "x"
+        self.assertEqual(await call(), ("x", False))
+        self.assertEqual(self.calls, {"x": 3, "y": 2})
+
+    @gen_test
+    async def test_key(self):
+        async with self.kv.acquire() as db:
+            key = await cache_key(db, "h", namespace=self.prefix, tags=[self.prefix + ":t"])
+            self.assertEqual(key, self.prefix + ":0.0:h")
+
+            await invalidate_cache(self.kv, tags=[self.prefix + ":t"])
+            await invalidate_cache(self.kv, namespace=self.prefix)
+            await invalidate_cache(self.kv, namespace=self.prefix)
+
+            self.assertEqual(await cache_key(db, "h", namespace=self.prefix, tags=[self.prefix + ":t"]),
+                             self.prefix + ":2.1:h")
@@ -0,0 +1,184 @@
+from tornado.testing import AsyncTestCase, gen_test
+from tornado.gen import sleep
+
+from anthill.common.circuit import CircuitBreaker, CircuitBreakers, RejectedError
+
+import asyncio
+
+
+class ServiceError(Exception):
+    pass
+
+
+async def succeed():
+    return "ok"
+
+
+async def fail():
+    raise ServiceError()
+
+
+class TestCircuitBreaker(AsyncTestCase):
+    async def call(self, breaker, call):
+        try:
+            return await breaker.call(call)
+        except ServiceError:
+            return "failed"
+        except RejectedError:
+            return "rejected"
+
+    def expire(self, breaker):
+        # pretend the reset timeout has passed
+        breaker.opened_at -= breaker.reset_timeout
+
+    async def open(self, breaker):
+        for i in range(breaker.min_calls):
+            await self.call(breaker, fail)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    @gen_test
+    async def test_opens(self):
+        breaker = CircuitBreaker("test", failure_rate=0.5, window=10, min_calls=4)
+
+        # not enough calls to judge
+        for i in range(3):
+            self.assertEqual(await self.call(breaker, fail), "failed")
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+        self.assertEqual(await self.call(breaker, succeed), "ok")
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+        self.assertEqual(await self.call(breaker, fail), "failed")
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(await self.call(breaker, succeed), "rejected")
+        self.assertEqual(breaker.gauges()["rejected"], 1)
+
+    @gen_test
+    async def test_window(self):
+        breaker = CircuitBreaker("test", failure_rate=0.5, window=4, min_calls=4)
+
+        for call in [fail, succeed, succeed, succeed, fail, succeed, succeed]:
+            await self.call(breaker, call)
+
+        # the first failure is out of the window already
+        self.assertEqual(breaker.failures, 1)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    @gen_test
+    async def test_half_open(self):
+        breaker = CircuitBreaker("test", min_calls=2, reset_timeout=10, half_open_calls=1)
+        await self.open(breaker)
+
+        self.expire(breaker)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+
+        # a failed trial opens it again
+        self.assertEqual(await self.call(breaker, fail), "failed")
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        self.expire(breaker)
+        self.assertEqual(await self.call(breaker, succeed), "ok")
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.failures, 0)
+
+    @gen_test
+    async def test_half_open_trials(self):
+        breaker = CircuitBreaker("test", min_calls=2, half_open_calls=1)
+        await self.open(breaker)
+        self.expire(breaker)
+
+        release = asyncio.Future()
+
+        async def slow():
+            await release
+            return "ok"
+
+        trial = asyncio.ensure_future(self.call(breaker, slow))
+        await sleep(0)
+
+        # only one trial at a time
+        self.assertEqual(await self.call(breaker, succeed), "rejected")
+
+        release.set_result(None)
+        self.assertEqual(await trial, "ok")
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    @gen_test
+    async def test_cancelled_trial(self):
+        breaker = CircuitBreaker("test", min_calls=2, half_open_calls=1)
+        await self.open(breaker)
+        self.expire(breaker)
+
+        trial = asyncio.ensure_future(breaker.call(lambda: asyncio.Future()))
+        await sleep(0)
+        trial.cancel()
+
+        with self.assertRaises(asyncio.CancelledError):
+            await trial
+
+        # the cancelled trial tells nothing, but frees the slot for another one
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertEqual(breaker.trials, 0)
+        self.assertEqual(breaker.in_flight, 0)
+        self.assertEqual(await self.call(breaker, succeed), "ok")
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    @gen_test
+    async def test_cancelled_closed(self):
+        breaker = CircuitBreaker("test", min_calls=1)
+
+        call = asyncio.ensure_future(breaker.call(lambda: asyncio.Future()))
+        await sleep(0)
+        call.cancel()
+
+        with self.assertRaises(asyncio.CancelledError):
+            await call
+
+        self.assertEqual(len(breaker.outcomes), 0)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    @gen_test
+    async def test_is_failure(self):
+        breaker = CircuitBreaker("test", min_calls=2, is_failure=lambda e: not isinstance(e, ServiceError))
+
+        for i in range(5):
+            await self.call(breaker, fail)
+
+        self.assertEqual(breaker.failures, 0)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    @gen_test
+    async def test_bulkhead(self):
+        breaker = CircuitBreaker("test", max_concurrent=2)
+        release = asyncio.Future()
+
+        async def slow():
+            await release
+            return "ok"
+
+        calls = [asyncio.ensure_future(self.call(breaker, slow)) for i in range(2)]
+        await sleep(0)
+
+        self.assertEqual(breaker.in_flight, 2)
+        self.assertEqual(await self.call(breaker, succeed), "rejected")
+
+        release.set_result(None)
+        self.assertEqual(await asyncio.gather(*calls), ["ok", "ok"])
+        self.assertEqual(breaker.in_flight, 0)
+        self.assertEqual(await self.call(breaker, succeed), "ok")
+
+    @gen_test
+    async def test_breakers(self):
+        breakers = CircuitBreakers(min_calls=2)
+
+        for i in range(2):
+            with self.assertRaises(ServiceError):
+                await breakers.call("a", fail)
+
+        with self.assertRaises(RejectedError):
+            await breakers.call("a", succeed)
+
+        # every service has a breaker of its own
+        self.assertEqual(await breakers.call("b", succeed), "ok")
+        self.assertIs(breakers.get("a"), breakers.get("a"))
+        breakers.stop()
@@ -0,0 +1,166 @@
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.web import Application, RequestHandler
+from tornado.gen import sleep
+
+from anthill.common.httpconn import KeepAliveHTTPClient
+
+import asyncio
+import ssl
+
+
+class HelloHandler(RequestHandler):
+    def get(self):
+        self.application.streams.append(self.request.connection.stream)
+        self.write("hello")
+
+    def post(self):
+        self.write(self.request.body)
+
+
+class SlowHandler(RequestHandler):
+    async def get(self):
+        await sleep(float(self.get_argument("delay")))
+        self.write("slow")
+
+
+class MissingHandler(RequestHandler):
+    def get(self):
+        self.set_status(404)
+        self.write("missing")
+
+
+class BrokenHandler(RequestHandler):
+    async def get(self):
+        # promises more than it sends
+        self.set_header("Content-Length", "100")
+        self.write("broken")
+        await self.flush()
+        self.request.connection.stream.close()
+
+
+class TestKeepAliveHTTPClient(AsyncHTTPTestCase):
+    def get_app(self):
+        app = Application([
+            ("/hello", HelloHandler),
+            ("/slow", SlowHandler),
+            ("/missing", MissingHandler),
+            ("/broken", BrokenHandler)
+        ])
+        app.streams = []
+        return app
+
+    def setUp(self):
+        super(TestKeepAliveHTTPClient, self).setUp()
+        self.client = KeepAliveHTTPClient(force_instance=True, max_connections=1)
+
+    def tearDown(self):
+        self.client.close()
+        super(TestKeepAliveHTTPClient, self).tearDown()
+
+    def statistics(self):
+        return self.client.statistics.get("127.0.0.1:{0}".format(self.get_http_port())).dump()
+
+    async def fetch(self, path, **kwargs):
+        return await self.client.fetch(self.get_url(path), raise_error=False, **kwargs)
+
+    @gen_test
+    async def test_reuse(self):
+        for i in range(3):
+            response = await self.fetch("/hello")
+            self.assertEqual(response.code, 200)
+            self.assertEqual(response.body, b"hello")
+
+        response = await self.fetch("/hello", method="POST", body="data")
+        self.assertEqual(response.body, b"data")
+
+        statistics = self.statistics()
+        self.assertEqual((statistics["requests"], statistics["opened"], statistics["reused"]), (4, 1, 3))
+        self.assertEqual(len(set(self._app.streams)), 1)
+
+    @gen_test
+    async def test_retry_stale(self):
+        await self.fetch("/hello")
+
+        # the other side closes the idle connection, and the client finds that out only once it sends the request
+        self._app.streams[0].close()
+        response = await self.fetch("/hello")
+
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, b"hello")
+
+        statistics = self.statistics()
+        self.assertEqual((statistics["opened"], statistics["reused"], statistics["retried"]), (2, 1, 1))
+
+    @gen_test
+    async def test_no_retry_stale_post(self):
+        await self.fetch("/hello")
+
+        self._app.streams[0].close()
+        response = await self.fetch("/hello", method="POST", body="data")
+
+        # it may have been processed already
+        self.assertEqual(response.code, 599)
+        self.assertEqual(self.statistics()["retried"], 0)
+
+    @gen_test
+    async def test_queue_timeout(self):
+        slow = asyncio.ensure_future(self.fetch("/slow?delay=0.3"))
+        await sleep(0)
+        response = await self.fetch("/hello", request_timeout=0.1)
+
+        self.assertEqual(response.code, 599)
+        self.assertIn("Timeout in request queue", str(response.error))
+        self.assertEqual(self.statistics()["waited"], 1)
+
+        self.assertEqual((await slow).body, b"slow")
+
+        # the connection is still there for the next one
+        self.assertEqual((await self.fetch("/hello")).code, 200)
+        self.assertEqual(self.statistics()["opened"], 1)
+
+    @gen_test
+    async def test_request_timeout(self):
+        response = await self.fetch("/slow?delay=0.3", request_timeout=0.1)
+        self.assertEqual(response.code, 599)
+        self.assertIn("Timeout during request", str(response.error))
+
+        # the connection is left in the middle of the response, so it's not reused
+        await sleep(0.3)
+        self.assertEqual((await self.fetch("/hello")).code, 200)
+        self.assertEqual(self.statistics()["opened"], 2)
+
+    @gen_test
+    async def test_error_code(self):
+        response = await self.fetch("/missing")
+
+        self.assertEqual(response.code, 404)
+        self.assertEqual(response.body, b"missing")
+        self.assertIsNotNone(response.error)
+
+        # an error response is a complete one, the connection is reused
+        self.assertEqual((await self.fetch("/hello")).code, 200)
+        self.assertEqual(self.statistics()["reused"], 1)
+
+    @gen_test
+    async def test_closed_mid_response(self):
+        response = await self.fetch("/broken")
+
+        # the response has started already, so it is not retried
+        self.assertEqual(response.code, 599)
+        self.assertEqual(self.statistics()["retried"], 0)
+
+        self.assertEqual((await self.fetch("/hello")).code, 200)
+        self.assertEqual(self.statistics()["opened"], 2)
+
+    def test_ssl_options(self):
+        request = type("Request", (object, ), {
+            "ssl_options": None, "validate_cert": True, "ca_certs": None, "client_cert": None})()
+
+        context = KeepAliveHTTPClient.__ssl_options__("https", request)
+        self.assertIsInstance(context, ssl.SSLContext)
+        self.assertEqual(context.verify_mode, ssl.CERT_REQUIRED)
+        self.assertIs(KeepAliveHTTPClient.__ssl_options__("https", request), context)
+        self.assertIsNone(KeepAliveHTTPClient.__ssl_options__("http", request))
+
+        request.validate_cert = False
+        self.assertEqual(KeepAliveHTTPClient.__ssl_options__("https", request).verify_mode, ssl.CERT_NONE)
@@ -0,0 +1,184 @@
+from tornado.testing import AsyncTestCase, gen_test
+from tornado.ioloop import IOLoop
+from tornado.gen import sleep
+
+from anthill.common.jsonrpc import JsonRPC, JsonRPCError, JsonRPCTimeout, JsonRPCBatchFuture
+
+import asyncio
+import ujson
+
+
+class MemoryJsonRPC(JsonRPC):
+    """
+    One end of an in-memory connection: whatever is written is received by the other end, in the next iteration
+    """
+
+    def __init__(self):
+        super(MemoryJsonRPC, self).__init__()
+        self.other = None
+        self.written = []
+        self.fail_writes = False
+
+    @staticmethod
+    def connect():
+        a, b = MemoryJsonRPC(), MemoryJsonRPC()
+        a.other, b.other = b, a
+        return a, b
+
+    async def write_data(self, context, data):
+        if self.fail_writes:
+            raise ConnectionError("Connection lost")
+        self.written.append(ujson.loads(data))
+        if self.other is not None:
+            IOLoop.current().spawn_callback(self.other.received, self.other, data)
+
+
+class TestJsonRPC(AsyncTestCase):
+    def connect(self, handlers):
+        """
+        :returns two connected ends, the second one responds with <handlers> (method -> a coroutine function)
+        """
+        client, server = MemoryJsonRPC.connect()
+        self.calls = []
+
+        async def receive(context, method, *args, **kwargs):
+            self.calls.append(method)
+            handler = handlers.get(method)
+            if handler is None:
+                raise JsonRPCError(-32601, "Method not found")
+            return await handler(*args, **kwargs)
+
+        server.set_receive(receive)
+        return client, server
+
+    @staticmethod
+    async def add(a, b):
+        return a + b
+
+    @staticmethod
+    async def slow(delay):
+        await sleep(delay)
+        return delay
+
+    @staticmethod
+    async def failing():
+        raise JsonRPCError(400, "Failed", "data")
+
+    @gen_test
+    async def test_request(self):
+        client, server = self.connect({"add": self.add, "fail": self.failing})
+
+        self.assertEqual(await client.send_request(client, "add", 1, a=1, b=2), 3)
+
+        with self.assertRaises(JsonRPCError) as context:
+            await client.send_request(client, "fail", 1)
+
+        self.assertEqual(context.exception.code, 400)
+        self.assertEqual(context.exception.data, "data")
+        self.assertEqual(client.handlers, {})
+
+    @gen_test
+    async def test_batch(self):
+        client, server = self.connect({"add": self.add, "fail": self.failing, "slow": self.slow})
+
+        futures = await client.send_request_many(client, [
+            ("add", {"a": 1, "b": 2}),
+            ("add", [3, 4]),
+            ("fail", None),
+            ("missing", None),
+            ("slow", {"delay": 0.01})
+        ])
+
+        self.assertEqual(futures[0].result(), 3)
+        self.assertEqual(futures[1].result(), 7)
+        self.assertEqual(futures[2].exception().code, 400)
+        self.assertEqual(futures[3].exception().code, -32601)
+        self.assertEqual(futures[4].result(), 0.01)
+
+        # a single message each way
+        self.assertEqual(len(client.written), 1)
+        self.assertEqual(len(server.written), 1)
+        self.assertEqual(len(server.written[0]), 5)
+
+        await sleep(0)
+        self.assertEqual(client.handlers, {})
+
+    @gen_test
+    async def test_batch_concurrent(self):
+        client, server = self.connect({"slow": self.slow})
+
+        started = IOLoop.current().time()
+        await client.send_request_many(client, [("slow", {"delay": 0.1})] * 5)
+
+        # the requests of a batch are processed concurrently
+        self.assertLess(IOLoop.current().time() - started, 0.3)
+
+    @gen_test
+    async def test_batch_timeout(self):
+        client, server = self.connect({"slow": self.slow, "add": self.add})
+
+        with self.assertRaises(JsonRPCTimeout):
+            await client.send_request_many(client, [("add", [1, 2]), ("slow", {"delay": 0.2})], timeout=0.05)
+
+        await sleep(0)
+        self.assertEqual(client.handlers, {})
+
+        # the late responses are not responded to
+        await sleep(0.2)
+        self.assertEqual(len(client.written), 1)
+
+    @gen_test
+    async def test_batch_write_failed(self):
+        client, server = self.connect({"add": self.add})
+        client.fail_writes = True
+
+        with self.assertRaises(ConnectionError):
+            await client.send_request_many(client, [("add", [1, 2]), ("add", [3, 4])])
+
+        # the requests are not left waiting forever
+        await sleep(0)
+        self.assertEqual(client.handlers, {})
+
+    @gen_test
+    async def test_batch_cancelled(self):
+        futures = [asyncio.Future(), asyncio.Future()]
+        futures[0].set_result(1)
+
+        batch = JsonRPCBatchFuture(1, futures)
+        batch.cancel()
+        await sleep(0)
+
+        self.assertEqual(futures[0].result(), 1)
+        self.assertTrue(futures[1].cancelled())
+
+    @gen_test
+    async def test_batch_invalid(self):
+        client, server = self.connect({"add": self.add})
+
+        # no 'method', but not responses either: errors are responded
+        await server.received(client, ujson.dumps([{"jsonrpc": "2.0", "id": 1}, {"id": 2}]))
+
+        errors = server.written[0]
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(all(error["error"]["code"] == -32600 for error in errors))
+
+        # a batch of responses is not responded to, even if they are unknown
+        server.written = []
+        await server.received(client, ujson.dumps([{"jsonrpc": "2.0", "id": 100, "result": 1}]))
+        self.assertEqual(server.written, [])
+
+    @gen_test
+    async def test_batch_limits(self):
+        client, server = self.connect({"add": self.add})
+
+        await server.received(client, "[]")
+        self.assertEqual(server.written[-1]["error"]["code"], -32600)
+
+        with self.assertRaises(JsonRPCError):
+            await client.send_request_many(client, [("add", [1, 2])] * 1001)
+
+        # nothing is sent for no calls
+        client.written = []
+        self.assertEqual(await client.send_request_many(client, []), [])
+        self.assertEqual(client.written, [])
+        self.assertEqual(client.handlers, {})
@@ -0,0 +1,312 @@
+from tornado.testing import AsyncTestCase, gen_test
+
+from anthill.common import random_string
+from anthill.common.keyvalue import KeyValueStorage, AutoPipelineError, HashRing, ShardedConnection, ShardingError
+
+from aioredis import MultiExecError, WatchVariableError
+
+import asyncio
+
+
+class TestAutoPipeline(AsyncTestCase):
+    """
+    Runs against a Redis at localhost:6379, skipped if there is none
+    """
+
+    def setUp(self):
+        super(TestAutoPipeline, self).setUp()
+        self.kv = KeyValueStorage(host="127.0.0.1", port=6379, db=0, max_connections=4, auto_pipeline=True)
+        self.prefix = "test_" + random_string(8) + ":"
+
+        try:
+            self.io_loop.run_sync(self.ping, timeout=1)
+        except Exception:
+            self.kv.connection_pool.close()
+            self.skipTest("No redis at localhost:6379")
+
+    async def ping(self):
+        async with self.kv.acquire() as db:
+            await db.ping()
+
+    def tearDown(self):
+        self.io_loop.run_sync(self.cleanup)
+        self.kv.stop()
+        super(TestAutoPipeline, self).tearDown()
+
+    async def cleanup(self):
+        async with self.kv.acquire() as db:
+            keys = await db.keys(self.prefix + "*")
+            if keys:
+                await db.delete(*keys)
+
+        self.kv.connection_pool.close()
+        await self.kv.connection_pool.wait_closed()
+
+    @gen_test
+    async def test_batch(self):
+        async with self.kv.acquire() as db:
+            results = await asyncio.gather(*[db.incr(self.prefix + "a") for i in range(10)])
+
+        self.assertEqual(sorted(results), list(range(1, 11)))
+        # all of them were sent on one connection
+        self.assertEqual(self.kv.connection_pool.size, 1)
+
+    @gen_test
+    async def test_watch_rejected(self):
+        async with self.kv.acquire() as db:
+            with self.assertRaises(AutoPipelineError):
+                await db.watch(self.prefix + "a")
+            with self.assertRaises(AutoPipelineError):
+                await db.execute("MULTI")
+            with self.assertRaises(AutoPipelineError):
+                await db.unwatch()
+
+    @gen_test
+    async def test_multi_exec(self):
+        key = self.prefix + "a"
+
+        async def transaction(db):
+            tr = db.multi_exec()
+            tr.incr(key)
+            tr.incr(key)
+            return await tr.execute()
+
+        async with self.kv.acquire() as db:
+            # other commands of the same batch (queued before the transactions are) do not get into them
+            results = await asyncio.gather(db.set(key, 10), transaction(db), db.get(key), transaction(db))
+
+        self.assertEqual(results, [True, [11, 12], b"10", [13, 14]])
+
+    @gen_test
+    async def test_dedicated(self):
+        key = self.prefix + "a"
+
+        async with self.kv.acquire(dedicated=True) as db:
+            await db.watch(key)
+
+            # changed by someone else in the meantime
+            async with self.kv.acquire() as other:
+                await other.set(key, 1)
+
+            tr = db.multi_exec()
+            result = tr.set(key, 100)
+
+            with self.assertRaises(MultiExecError):
+                await tr.execute()
+            with self.assertRaises(WatchVariableError):
+                await result
+
+        async with self.kv.acquire(dedicated=True) as db:
+            await db.watch(key)
+
+            tr = db.multi_exec()
+            tr.set(key, 100)
+            self.assertEqual(await tr.execute(), [True])
+
+
+class TestIdleConnections(AsyncTestCase):
+    """
+    Runs against a Redis at localhost:6379, skipped if there is none
+    """
+
+    def setUp(self):
+        super(TestIdleConnections, self).setUp()
+        self.storages = []
+
+        try:
+            self.kv = self.io_loop.run_sync(lambda: self.create(min_connections=0), timeout=1)
+        except Exception:
+            self.io_loop.run_sync(self.cleanup)
+            self.skipTest("No redis at localhost:6379")
+
+    def tearDown(self):
+        self.io_loop.run_sync(self.cleanup)
+        super(TestIdleConnections, self).tearDown()
+
+    async def cleanup(self):
+        for kv in self.storages:
+            await kv.close()
+
+    async def create(self, min_connections):
+        kv = KeyValueStorage(host="127.0.0.1", port=6379, db=0, max_connections=4,
+                             min_connections=min_connections, idle_timeout=10)
+        self.storages.append(kv)
+        await self.ping(kv)
+        return kv
+
+    @staticmethod
+    async def ping(kv):
+        async with kv.acquire() as db:
+            await db.ping()
+
+    @staticmethod
+    def expire(kv):
+        # pretend the connections were released a minute ago
+        for connection in list(kv.statistics.released_at.keys()):
+            kv.statistics.released_at[connection] -= 60
+
+    async def hold(self, release):
+        async with self.kv.acquire() as db:
+            await db.ping()
+            await release
+
+    @gen_test
+    async def test_reap(self):
+        pool = self.kv.connection_pool
+        release = asyncio.Future()
+
+        holders = [asyncio.ensure_future(self.hold(release)) for i in range(3)]
+        await asyncio.sleep(0.05)
+        release.set_result(None)
+        await asyncio.gather(*holders)
+        self.assertEqual(pool.freesize, 3)
+
+        # nothing is idle for long enough yet
+        await self.kv.reap()
+        self.assertEqual(pool.freesize, 3)
+
+        # two of them have not been used for a while, one was used just now
+        self.expire(self.kv)
+        await self.ping(self.kv)
+
+        await self.kv.reap()
+        self.assertEqual(pool.freesize, 1)
+        self.assertEqual(pool.size, 1)
+
+        # the one left is fine to use
+        await self.ping(self.kv)
+
+    @gen_test
+    async def test_min_connections(self):
+        kv = await self.create(min_connections=1)
+        self.expire(kv)
+
+        await kv.reap()
+        self.assertEqual(kv.connection_pool.freesize, 1)
+
+    @gen_test
+    async def test_close(self):
+        await self.kv.close()
+
+        self.assertFalse(self.kv.reap_callback.is_running())
+        self.assertTrue(self.kv.connection_pool.closed)
+
+
+class NodeExecutor(object):
+    """
+    Stands for the connection pool of a node, remembers the commands executed on it
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.commands = []
+
+    async def execute(self, command, *args, **kwargs):
+        self.commands.append((command, ) + args)
+        return self.node
+
+
+class TestSharding(AsyncTestCase):
+    NODES = ["a:6379", "b:6379", "c:6379"]
+
+    def setUp(self):
+        super(TestSharding, self).setUp()
+        self.ring = HashRing(TestSharding.NODES)
+        self.executors = {node: NodeExecutor(node) for node in TestSharding.NODES}
+        self.connection = ShardedConnection(self.ring, self.executors)
+
+    def keys_on_different_nodes(self):
+        first = self.ring.get_node("key0")
+        for i in range(1, 100):
+            key = "key{0}".format(i)
+            if self.ring.get_node(key) != first:
+                return "key0", key
+        self.fail("All of the keys are on the same node")
+
+    def test_hash_tag(self):
+        self.assertEqual(HashRing.hash_tag("{user:1}:profile"), "user:1")
+        self.assertEqual(HashRing.hash_tag(b"a{b}c"), b"b")
+        # an empty tag does not count
+        self.assertEqual(HashRing.hash_tag("{}:a"), "{}:a")
+        self.assertEqual(HashRing.hash_tag("a}{"), "a}{")
+
+        for i in range(50):
+            tag = "{{user:{0}}}".format(i)
+            self.assertEqual(self.ring.get_node(tag + ":profile"), self.ring.get_node(tag + ":inventory"))
+            self.assertEqual(self.ring.get_node(tag + ":profile"), self.ring.get_node("user:{0}".format(i)))
+
+    @gen_test
+    async def test_route(self):
+        key = "{user:1}:a"
+        node = self.ring.get_node(key)
+
+        self.assertEqual(await self.connection.execute("GET", key), node)
+        self.assertEqual(await self.connection.execute(b"mget", key, "{user:1}:b"), node)
+        self.assertEqual(self.executors[node].commands, [("GET", key), (b"mget", key, "{user:1}:b")])
+
+    def test_different_nodes(self):
+        a, b = self.keys_on_different_nodes()
+
+        for command, args in [
+                ("MGET", (a, b)),
+                ("EVAL", ("return 1", 2, a, b)),
+                ("EVALSHA", ("sha", 2, a, b)),
+                ("MSET", (a, 1, b, 2)),
+                ("RENAME", (a, b)),
+                ("RPOPLPUSH", (a, b)),
+                ("BRPOPLPUSH", (a, b, 0)),
+                ("SMOVE", (a, b, "member")),
+                ("SUNIONSTORE", (a, a, b)),
+                ("ZUNIONSTORE", (a, 2, a, b)),
+                ("ZINTERSTORE", (a, 1, b)),
+                ("BLPOP", (a, b, 0)),
+                ("BITOP", ("AND", a, a, b)),
+                ("PFMERGE", (a, b)),
+                ("SORT", (a, "BY", "nosort", "STORE", b)),
+                ("XREAD", ("COUNT", 1, "STREAMS", a, b, 0, 0))]:
+
+            with self.assertRaises(ShardingError, msg=command):
+                self.connection.execute(command, *args)
+
+    def test_keys(self):
+        a, b = self.keys_on_different_nodes()
+
+        # the arguments that are not keys are not taken for keys
+        node = self.ring.get_node(a)
+        self.assertEqual(self.connection.get_node("EVAL", ("return 1", 1, a, b)), node)
+        self.assertEqual(self.connection.get_node("BLPOP", (a, 5)), node)
+        self.assertEqual(self.connection.get_node("ZUNIONSTORE", (a, 1, a, "WEIGHTS", b)), node)
+        self.assertEqual(self.connection.get_node("SORT", (a, "BY", b)), node)
+        self.assertEqual(self.connection.get_node("XREAD", ("STREAMS", a, b)), node)
+
+        with self.assertRaises(ShardingError):
+            self.connection.execute("EVAL", "return 1", 0)
+
+    def test_unsupported(self):
+        for command in ("MULTI", "WATCH", "KEYS", "SCAN"):
+            with self.assertRaises(ShardingError):
+                self.connection.execute(command, "a")
+
+    @gen_test
+    async def test_broadcast(self):
+        self.assertEqual(await self.connection.execute("PING"), TestSharding.NODES[0])
+        await self.connection.execute("SCRIPT", "LOAD", "return 1")
+
+        for node, executor in self.executors.items():
+            self.assertEqual(executor.commands, [("PING", ), ("SCRIPT", "LOAD", "return 1")])
+
+    def test_add_node(self):
+        keys = ["key{0}".format(i) for i in range(10000)]
+        before = {key: self.ring.get_node(key) for key in keys}
+
+        ring = HashRing(TestSharding.NODES + ["d:6379"])
+        moved = [key for key in keys if ring.get_node(key) != before[key]]
+
+        # only the keys of the new node move, about a quarter of them
+        self.assertTrue(all(ring.get_node(key) == "d:6379" for key in moved))
+        self.assertGreater(len(moved), 1500)
+        self.assertLess(len(moved), 3500)
+
+        # and the order the nodes are listed in does not matter
+        reordered = HashRing(reversed(TestSharding.NODES))
+        self.assertTrue(all(reordered.get_node(key) == before[key] for key in keys))
@@ -0,0 +1,150 @@
+from tornado.testing import AsyncTestCase, gen_test
+from tornado.gen import sleep
+
+from anthill.common.latency import LatencyTracker, LatencyWindow
+
+
+class CallError(Exception):
+    pass
+
+
+class TestLatency(AsyncTestCase):
+    def tracker(self, latency=0.01, samples=100, **kwargs):
+        tracker = LatencyTracker(min_samples=50, **kwargs)
+        for i in range(samples):
+            tracker.record("service", "method", latency)
+        return tracker
+
+    def calls(self, *behaviours):
+        """
+        :returns a function to call, that sleeps and then returns (or raises) according to the next behaviour,
+            and a list of the timeouts it was called with
+        """
+        behaviours = list(behaviours)
+        timeouts = []
+
+        async def call(timeout):
+            delay, result = behaviours.pop(0)
+            timeouts.append(timeout)
+            await sleep(delay)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        return call, timeouts
+
+    def test_percentile(self):
+        window = LatencyWindow(size=100, refresh=10)
+        self.assertIsNone(window.percentile(50))
+
+        for i in range(1, 101):
+            window.add(i)
+
+        self.assertEqual(window.percentile(50), 50)
+        self.assertEqual(window.percentile(99), 99)
+        self.assertEqual(window.percentile(100), 100)
+
+        # the sorted copy is refreshed only after <refresh> more samples
+        for i in range(9):
+            window.add(1000)
+        self.assertEqual(window.percentile(100), 100)
+        window.add(1000)
+        self.assertEqual(window.percentile(100), 1000)
+
+    def test_timeout(self):
+        tracker = self.tracker(latency=0.2, samples=49, min_timeout=0.5)
+
+        # not enough samples yet
+        self.assertEqual(tracker.timeout("service", "method", 10), 10)
+        self.assertIsNone(tracker.hedge_delay("service", "method", 10))
+
+        tracker.record("service", "method", 0.3)
+        self.assertAlmostEqual(tracker.timeout("service", "method", 10), 0.6)
+        self.assertAlmostEqual(tracker.hedge_delay("service", "method", 10), 0.2)
+
+        # never more than the default, nor less than the minimum
+        self.assertEqual(tracker.timeout("service", "method", 0.4), 0.4)
+        self.assertEqual(self.tracker(latency=0.01).timeout("service", "method", 10), 0.5)
+
+        # a delay as long as the timeout is pointless
+        self.assertIsNone(tracker.hedge_delay("service", "method", 0.2))
+
+    def test_max_calls(self):
+        tracker = LatencyTracker(max_calls=2)
+        tracker.record("service", "a", 1)
+        tracker.record("service", "b", 1)
+        tracker.record("service", "a", 1)
+        tracker.record("service", "c", 1)
+
+        # the least recently used one is dropped
+        self.assertEqual(list(tracker.windows.keys()), [("service", "a"), ("service", "c")])
+
+    @gen_test
+    async def test_no_hedge(self):
+        tracker = self.tracker()
+        call, timeouts = self.calls((0.05, "first"))
+
+        # not idempotent
+        self.assertEqual(await tracker.call("service", "method", call, 1, hedge=False), "first")
+        self.assertEqual(timeouts, [1])
+        self.assertEqual(tracker.window("service", "method").hedged, 0)
+
+    @gen_test
+    async def test_hedge_win(self):
+        tracker = self.tracker()
+        call, timeouts = self.calls((0.2, "first"), (0, "second"))
+
+        self.assertEqual(await tracker.call("service", "method", call, 1, hedge=True), "second")
+
+        window = tracker.window("service", "method")
+        self.assertEqual((window.hedged, window.hedge_wins), (1, 1))
+        # the duplicate gets what's left of the timeout
+        self.assertEqual(timeouts[0], 1)
+        self.assertAlmostEqual(timeouts[1], 0.99)
+
+        # the other one is left to finish on its own
+        await sleep(0.2)
+
+    @gen_test
+    async def test_hedge_lose(self):
+        tracker = self.tracker()
+        call, timeouts = self.calls((0.05, "first"), (0.2, "second"))
+
+        self.assertEqual(await tracker.call("service", "method", call, 1, hedge=True), "first")
+
+        window = tracker.window("service", "method")
+        self.assertEqual((window.hedged, window.hedge_wins), (1, 0))
+
+        await sleep(0.2)
+
+    @gen_test
+    async def test_hedge_first_fails(self):
+        tracker = self.tracker()
+        call, timeouts = self.calls((0.05, CallError("first")), (0.1, "second"))
+
+        # a failure is not a response to take, the duplicate is still waited for
+        self.assertEqual(await tracker.call("service", "method", call, 1, hedge=True), "second")
+
+    @gen_test
+    async def test_hedge_both_fail(self):
+        tracker = self.tracker()
+        call, timeouts = self.calls((0.05, CallError("first")), (0, CallError("second")))
+
+        with self.assertRaises(CallError) as context:
+            await tracker.call("service", "method", call, 1, hedge=True)
+
+        # the error of the first one
+        self.assertEqual(str(context.exception), "first")
+
+    @gen_test
+    async def test_timed_out(self):
+        tracker = LatencyTracker(min_samples=1)
+        call, timeouts = self.calls((0.06, CallError("timeout")), (0, CallError("failed fast")))
+
+        for i in range(2):
+            with self.assertRaises(CallError):
+                await tracker.call("service", "method", call, 0.05)
+
+        # only the one that took the whole timeout counts in
+        window = tracker.window("service", "method")
+        self.assertEqual(list(window.samples), [0.05])
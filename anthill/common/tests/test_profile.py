@@ -1,6 +1,202 @@
 from tornado.testing import AsyncTestCase, gen_test
+from tornado.gen import multi, sleep
 
-from anthill.common.profile import Profile, ProfileError, PredefinedProfile
+from anthill.common.profile import Profile, ProfileError, PredefinedProfile, UpdatePlan, DatabaseProfile, \
+    DatabaseProfiles, WriteBehindProfiles, NoDataError, ProfileCache, Functions, FuncError, ProfileDryRun, \
+    ProfileDeltas, ProfileDeltasBuffer, KeyValueProfileDeltasBuffer
+from anthill.common.keyvalue import KeyValueStorage
+from anthill.common import profile as profile_module
+from anthill.common import random_string
+
+import ujson
+
+
+class PartialProfile(DatabaseProfile):
+    def __init__(self, value, optimistic=False):
+        super(PartialProfile, self).__init__(None, partial_updates=True, optimistic=optimistic)
+        self.value = value
+        self.written = None
+
+    async def init(self):
+        pass
+
+    async def release(self):
+        pass
+
+    async def get(self):
+        return self.value
+
+    async def insert(self, data):
+        pass
+
+    async def update(self, data):
+        self.written = ("update", data)
+
+    async def update_partial(self, expression, args):
+        self.written = ("update_partial", expression, args)
+
+
+class WholeProfile(PartialProfile):
+    """
+    Constructed with partial_updates=True, but has no update_partial
+    """
+
+    update_partial = DatabaseProfile.update_partial
+
+
+class BrokenPartialProfile(PartialProfile):
+    async def update_partial(self, expression, args):
+        raise NotImplementedError("update_partial")
+
+
+class VersionedProfile(DatabaseProfile):
+    """
+    A row of a table, shared across the instances, with a round trip between reading and writing
+    """
+
+    def __init__(self, row):
+        super(VersionedProfile, self).__init__(None, optimistic=True)
+        self.row = row
+
+    async def init(self):
+        pass
+
+    async def release(self):
+        pass
+
+    async def get(self):
+        return self.row["data"]
+
+    async def get_versioned(self):
+        await sleep(0)
+        return self.row["data"], self.row["version"]
+
+    async def insert(self, data):
+        pass
+
+    async def update(self, data):
+        pass
+
+    async def update_versioned(self, data, version):
+        await sleep(0)
+        if self.row["version"] != version:
+            return False
+        self.row["data"] = data
+        self.row["version"] += 1
+        return True
+
+
+class BatchProfiles(DatabaseProfiles):
+    def __init__(self, rows):
+        super(BatchProfiles, self).__init__(None)
+        self.rows = rows
+        self.written = None
+        self.transactions = 0
+
+    async def init(self):
+        self.transactions += 1
+
+    async def release(self):
+        pass
+
+    async def get_many(self, ids):
+        return {profile_id: self.rows[profile_id] for profile_id in ids if profile_id in self.rows}
+
+    async def write_many(self, profiles):
+        self.written = profiles
+        self.rows.update(profiles)
+
+
+class StoredProfile(Profile):
+    def __init__(self, rows, key):
+        self.rows = rows
+        self.key = key
+
+    async def get(self):
+        if self.key not in self.rows:
+            raise NoDataError()
+        return self.rows[self.key]
+
+    async def insert(self, data):
+        self.rows[self.key] = data
+        self.rows["writes"] = self.rows.get("writes", 0) + 1
+
+    async def update(self, data):
+        self.rows[self.key] = data
+        self.rows["writes"] = self.rows.get("writes", 0) + 1
+
+
+class FlakyProfile(StoredProfile):
+    """
+    Fails to write <failures> updates (not because of the data), after <succeeded> successful ones
+    """
+
+    def __init__(self, rows, key, succeeded, failures):
+        super(FlakyProfile, self).__init__(rows, key)
+        self.succeeded = succeeded
+        self.failures = failures
+
+    async def update(self, data):
+        if self.rows.get("writes", 0) >= self.succeeded and self.failures[0]:
+            self.failures[0] -= 1
+            raise ConnectionError("Connection lost")
+        await super(FlakyProfile, self).update(data)
+
+
+class ReadProfile(VersionedProfile):
+    """
+    A versioned row, the selected paths and the number of documents read are recorded
+    """
+
+    def __init__(self, row, cache=None):
+        super(ReadProfile, self).__init__(row)
+        self.cache = cache
+        self.selected = []
+        self.documents = 0
+
+    async def init_read(self):
+        pass
+
+    async def release_read(self):
+        pass
+
+    async def get_versioned(self):
+        self.documents += 1
+        return await super(ReadProfile, self).get_versioned()
+
+    async def get_version(self):
+        return self.row["version"]
+
+    def cache_key(self):
+        return "row"
+
+
+class PartialReadProfile(ReadProfile):
+    async def get_partial(self, expression, args):
+        self.selected.append((expression, args))
+        # emulate JSON_EXTRACT for simple paths
+        value = self.row["data"]
+        for key in args[0].split(".")[1:]:
+            value = value.get(key.strip('"')) if isinstance(value, dict) else None
+        return None if value is None else ujson.dumps(value)
+
+
+class BrokenReadProfile(ReadProfile):
+    """
+    Implements every optional method, but some of them fail (with NotImplementedError, as a missing one would)
+    """
+
+    def __init__(self, row, cache=None, broken=()):
+        super(BrokenReadProfile, self).__init__(row, cache=cache)
+        self.broken = broken
+
+    async def get_versioned(self):
+        if "get_versioned" in self.broken:
+            raise NotImplementedError("get_versioned")
+        return await super(BrokenReadProfile, self).get_versioned()
+
+    async def get_partial(self, expression, args):
+        raise NotImplementedError("get_partial")
 
 
 class TestProfile(AsyncTestCase):
@@ -227,6 +423,83 @@ class TestProfile(AsyncTestCase):
                 {"@func": "num_child_where", "@test": ">", "@field": "stats", "@cond": 10}}},
             "smaller_or_equal")
 
+    @gen_test
+    async def test_aggregate(self):
+        members = {"a": {"gold": 20, "level": 2}, "b": {"gold": 10, "level": 5},
+                   "c": {"gold": 5.5, "level": 7}, "d": {"level": 9}, "e": {"gold": 10, "level": 5}, "f": 1}
+
+        def aggregate(func, **arguments):
+            arguments["@func"] = func
+            result = arguments.pop("result")
+            # None removes the field
+            return self.check_profile_success(
+                {"members": members}, {"members": arguments}, {} if result is None else {"members": result})
+
+        await aggregate("sum_child_where", **{"@field": "gold", "result": 45.5})
+        await aggregate("sum_child_where", **{
+            "@field": "gold", "@test": ">=", "@where": "level", "@cond": 5, "result": 25.5})
+        await aggregate("min_child_where", **{"@field": "gold", "result": 5.5})
+        await aggregate("max_child_where", **{"@field": "gold", "@test": ">", "@cond": 100, "result": None})
+        await aggregate("count_child_where", **{"@field": "level", "@test": "==", "@cond": 5, "result": 2})
+        await aggregate("top_child_where", **{"@field": "gold", "@count": 2, "result": ["a", "b"]})
+        await aggregate("top_child_where", **{"@field": "level", "result": ["d", "c", "b", "e", "a"]})
+
+        await self.check_profile_error(
+            {"members": members}, {"members": {"@func": "top_child_where", "@field": "gold", "@count": 0}},
+            "@count should be a positive number")
+
+        # the resolved predicates behave exactly like the functions themselves
+        values = [None, 0, 1, 5, 10, 10.5, True, "5", [5], {"a": 5}]
+        for func_name in ("==", "!=", ">", ">=", "<", "<=", "exists", "not_exists"):
+            for condition in (None, 0, 5, 10.5):
+                arguments = {"@cond": condition}
+                test = Functions.child_predicate(func_name, "f", arguments)
+                f = Functions.FUNCTIONS[func_name].__func__
+
+                for value in values:
+                    try:
+                        f("f", value, arguments)
+                    except FuncError:
+                        expected = False
+                    except TypeError:
+                        continue
+                    else:
+                        expected = True
+                    self.assertEqual(test(value), expected, (func_name, condition, value))
+
+    def test_aggregate_generic(self):
+        # the resolved predicates, with and without numpy, give what testing every child
+        #   with the function itself does (see benchmark_aggregate.py)
+        members = {str(i): {"score": (i * 7919) % 100, "level": i % 10} for i in range(200)}
+        arguments = {"@field": "score", "@test": ">=", "@where": "level", "@cond": 5, "@count": 10}
+        f = Functions.FUNCTIONS[">="]
+
+        def check(child):
+            try:
+                f.__func__("level", child.get("level"), arguments)
+            except FuncError:
+                return False
+            else:
+                return True
+
+        passed = [(key, child["score"]) for key, child in members.items() if check(child)]
+        expected = sum(value for key, value in passed), [
+            key for key, value in sorted(passed, key=lambda item: item[1], reverse=True)[:10]]
+
+        def resolved():
+            ignored, total = Functions.func_sum_child_where(None, members, arguments)
+            ignored, top = Functions.func_top_child_where(None, members, arguments)
+            return total, top
+
+        self.assertEqual(resolved(), expected)
+
+        numpy = profile_module.numpy
+        profile_module.numpy = None
+        try:
+            self.assertEqual(resolved(), expected)
+        finally:
+            profile_module.numpy = numpy
+
     @gen_test
     async def test_array_append(self):
         await self.check_profile_success(
@@ -269,3 +542,450 @@ class TestProfile(AsyncTestCase):
             {"root": {
                 "a": 4
             }})
+
+    @gen_test
+    async def test_plan_shared(self):
+        a = {"root": {"a": {"@func": "<", "@cond": 50, "@value": {"@func": "++", "@value": 1}}, "b": 1}}
+        b = {"root": {"a": {"@func": "<", "@cond": 20, "@value": {"@func": "++", "@value": 7}}, "b": 2}}
+        c = {"root": {"a": {"@func": "--", "@value": 1}, "b": {"c": 3}}}
+
+        self.assertIs(UpdatePlan.get(a), UpdatePlan.get(b))
+        self.assertIsNot(UpdatePlan.get(a), UpdatePlan.get(a, merge=False))
+
+        # same keys, but a different structure below
+        self.assertIs(UpdatePlan.get(a), UpdatePlan.get(c))
+
+        await self.check_profile_success(
+            {"root": {"a": 5}},
+            b,
+            {"root": {"a": 5, "b": 2}})
+        await self.check_profile_success(
+            {"root": {"a": 5}},
+            c,
+            {"root": {"a": 4, "b": {"c": 3}}})
+        await self.check_profile_error(
+            {"root": {"a": 5}},
+            {"root": {"a": {"@func": "unknown"}}},
+            "No such function")
+
+    @gen_test
+    async def test_object_replace(self):
+        await self.check_profile_success(
+            {"root": {"a": 5}, "b": 6},
+            {"root": {"c": 7}, "b": None},
+            {"root": {"c": 7}},
+            merge=False)
+        await self.check_profile_success(
+            {"root": {"a": 5}, "b": 6},
+            {"root": {"c": 7}, "b": None},
+            {"root": {"a": 5, "c": 7}})
+
+    def test_plan_interpreted(self):
+        # a compiled plan does the same as the fields interpreted one by one (see benchmark_plan.py)
+        def update(i):
+            return {"stats": {
+                "score": {"@func": "<", "@cond": 50, "@value": {"@func": "++", "@value": i % 5 + 1}},
+                "gold": {"@func": "--/0", "@value": 1},
+                "items": {"@func": "array_append", "@value": i + 1, "@limit": 3, "@shift": True},
+                "last": i
+            }}
+
+        interpreted = {"stats": {"score": 0, "gold": 20}}
+        compiled = {"stats": {"score": 0, "gold": 20}}
+
+        for i in range(20):
+            fields = update(i)
+            for key, value in fields.items():
+                Profile.__set_profile_field__(interpreted, key, value)
+            UpdatePlan.get(fields).apply(compiled, fields)
+
+        self.assertEqual(interpreted, compiled)
+        self.assertEqual(compiled["stats"]["gold"], 0)
+
+    @gen_test
+    async def test_changes(self):
+        old = {"a": {"b": 1, "x": {"y": 1}}, "c": 2, "l": [1]}
+        changes = []
+
+        merged = Profile.merge_data(old, {
+            "a": {"b": {"@func": "++", "@value": 1}},
+            "c": None,
+            "d": {"e": 1},
+            "l": {"@func": "array_append", "@value": 2},
+            "missing": None
+        }, path=None, changes=changes)
+
+        self.assertEqual(merged, {"a": {"b": 2, "x": {"y": 1}}, "d": {"e": 1}, "l": [1, 2]})
+        self.assertEqual(changes, [(("a", "b"), 2), (("c",), None), (("d",), {"e": 1}), (("l",), [1, 2])])
+
+        # the old profile is left as is, untouched objects are shared
+        self.assertEqual(old, {"a": {"b": 1, "x": {"y": 1}}, "c": 2, "l": [1]})
+        self.assertIs(merged["a"]["x"], old["a"]["x"])
+
+    @gen_test
+    async def test_changes_path(self):
+        changes = []
+        Profile.merge_data({"a": {"b": {"c": 1}}}, {"c": 2}, path=["a", "b"], changes=changes)
+        self.assertEqual(changes, [(("a", "b", "c"), 2)])
+
+        changes = []
+        Profile.merge_data({"a": {}}, {"c": 2}, path=["a", "b", "d"], changes=changes)
+        self.assertEqual(changes, [(("a", "b"), {"d": {"c": 2}})])
+
+        changes = []
+        profile = PredefinedProfile({"a": 1})
+        await profile.set_data({"a": None, "b": {"@func": "exists", "@else": 3}}, path=None, changes=changes)
+        self.assertEqual(changes, [(("a",), None), (("b",), 3)])
+
+    @gen_test
+    async def test_partial_update(self):
+        profile = PartialProfile({"a": {"b": 1}, "c": 2, "d": "x"})
+        await profile.set_data({"a": {"b": {"@func": "++", "@value": 1}}, "c": None, "d": None, "e": [1]}, path=None)
+
+        self.assertEqual(profile.written, (
+            "update_partial",
+            "JSON_SET(JSON_REMOVE(JSON_SET(`profile_object`, %s, CAST(%s AS JSON)), %s, %s), %s, CAST(%s AS JSON))",
+            ['$."a"."b"', '2', '$."c"', '$."d"', '$."e"', '[1]']))
+
+        profile = PartialProfile({"a": 1})
+        profile.MAX_PARTIAL_CHANGES = 1
+        await profile.set_data({"a": 2, "b": 3}, path=None)
+        self.assertEqual(profile.written, ("update", {"a": 2, "b": 3}))
+
+        profile = PartialProfile({"a": 1})
+        await profile.set_data({"a": {"@func": "exists"}}, path=None)
+        self.assertIsNone(profile.written)
+
+        profile = WholeProfile({"a": 1})
+        await profile.set_data({"a": 2}, path=None)
+        self.assertEqual(profile.written, ("update", {"a": 2}))
+
+        # not taken for a missing update_partial
+        with self.assertRaises(NotImplementedError):
+            await BrokenPartialProfile({"a": 1}).set_data({"a": 2}, path=None)
+
+        self.assertEqual(DatabaseProfile.json_path(["a", 'b"c']), '$."a"."b\\"c"')
+
+    @gen_test
+    async def test_optimistic(self):
+        row = {"data": {"a": 0}, "version": 1}
+        profiles = [VersionedProfile(row) for i in range(10)]
+
+        await multi([
+            profile.set_data({"a": {"@func": "++", "@value": 1}}, path=None)
+            for profile in profiles
+        ])
+
+        self.assertEqual(row["data"], {"a": 10})
+        self.assertEqual(row["version"], 11)
+        self.assertGreater(sum(profile.conflicts for profile in profiles), 0)
+
+        changes = []
+        result = await profiles[0].set_data({"b": 1}, path=None, changes=changes)
+        self.assertEqual(result, {"a": 10, "b": 1})
+        self.assertEqual(changes, [(("b",), 1)])
+
+        # the whole document is written with update_versioned
+        with self.assertRaises(ProfileError):
+            PartialProfile({"a": 1}, optimistic=True)
+
+    @gen_test
+    async def test_batch(self):
+        profiles = BatchProfiles({1: {"gold": 10}, 2: {"gold": 0}, 3: {"gold": 5, "x": 1}})
+
+        results = await profiles.set_data_all([1, 2, 4], {"gold": {"@func": "--/0", "@value": 5}})
+
+        self.assertEqual(results[1], {"gold": 5})
+        self.assertIsInstance(results[2], ProfileError)
+        self.assertIsInstance(results[4], ProfileError)
+        self.assertEqual(profiles.written, {1: {"gold": 5}})
+
+        results = await profiles.set_data_all([4], {"gold": 1})
+        self.assertEqual(results, {4: {"gold": 1}})
+        self.assertEqual(profiles.written, {4: {"gold": 1}})
+
+        results = await profiles.set_data_many({
+            1: {"gold": {"@func": "++", "@value": 1}},
+            3: {"x": {"@func": "exists"}}
+        })
+
+        self.assertEqual(results, {1: {"gold": 6}, 3: {"gold": 5, "x": 1}})
+        # profile 3 has not changed
+        self.assertEqual(profiles.written, {1: {"gold": 6}})
+
+        with self.assertRaises(ProfileError):
+            await profiles.set_data_all([1, 2], {"gold": {"@func": "--/0", "@value": 6}}, atomic=True)
+        self.assertEqual(profiles.rows[1], {"gold": 6})
+
+        # nothing to update, nothing is selected either
+        transactions = profiles.transactions
+        self.assertEqual(await profiles.set_data_many({}), {})
+        self.assertEqual(await profiles.set_data_all([], {"gold": 1}), {})
+        self.assertEqual(profiles.transactions, transactions)
+
+    @gen_test
+    async def test_array_extend(self):
+        await self.check_profile_success(
+            {"a": ["test1", "test2", "test3"]},
+            {"a": {"@func": "array_extend", "@values": [5, 6], "@limit": 3, "@shift": True}},
+            {"a": ["test3", 5, 6]})
+        await self.check_profile_error(
+            {"a": ["test1"]},
+            {"a": {"@func": "array_extend", "@values": [5, 6], "@limit": 2}},
+            "limit_exceeded")
+
+    @gen_test
+    async def test_write_behind(self):
+        rows = {"a": {"stats": {"kills": 5}}}
+        profiles = WriteBehindProfiles(lambda key: StoredProfile(rows, key), flush_period=0, max_pending=100)
+
+        for i in range(10):
+            result = await profiles.set_data("a", {"stats": {
+                "kills": {"@func": "++", "@value": 2},
+                "deaths": {"@func": "--", "@value": 1},
+                "log": {"@func": "array_append", "@value": i + 1, "@limit": 3, "@shift": True}
+            }}, path=None)
+            self.assertIsNone(result)
+
+        # nothing is written yet, but the reads see the pending deltas
+        self.assertEqual(rows, {"a": {"stats": {"kills": 5}}})
+        self.assertEqual(await profiles.get_data("a", ["stats", "kills"]), 25)
+
+        await profiles.flush()
+
+        self.assertEqual(rows["a"], {"stats": {"kills": 25, "deaths": -10, "log": [8, 9, 10]}})
+        self.assertEqual(rows["writes"], 1)
+
+        # not coalesced: the pending deltas are written first
+        await profiles.set_data("a", {"stats": {"kills": {"@func": "++", "@value": 1}}}, path=None)
+        result = await profiles.set_data("a", {"stats": {"kills": {"@func": ">", "@cond": 25}}}, path=None)
+        self.assertEqual(result["stats"]["kills"], 26)
+        self.assertEqual(rows["writes"], 3)
+
+        self.assertIsNone(await profiles.set_data("b", {"x": {"@func": "++", "@value": 1}}, path=["y"]))
+        self.assertIsNone(await profiles.set_data("b", {"z": {"@func": "++", "@value": 1}}, path=None))
+        await profiles.flush_key("b")
+        self.assertEqual(rows["b"], {"y": {"x": 1}, "z": 1})
+        self.assertEqual(rows["writes"], 4)
+
+    @gen_test
+    async def test_write_behind_bad_path(self):
+        rows = {"a": {"name": "x", "kills": 5}}
+        profiles = WriteBehindProfiles(lambda key: StoredProfile(rows, key), flush_period=0)
+
+        await profiles.set_data("a", {"kills": {"@func": "++", "@value": 1}}, path=None)
+        await profiles.set_data("a", {"name": {"@func": "++", "@value": 1}}, path=None)
+        await profiles.set_data("a", {"log": {"@func": "array_append", "@value": 1}}, path=None)
+        await profiles.flush()
+
+        # only the path to blame is dropped
+        self.assertEqual(rows["a"], {"name": "x", "kills": 6, "log": [1]})
+        self.assertEqual(await profiles.buffer.keys(), [])
+
+    @gen_test
+    async def test_write_behind_requeue(self):
+        rows = {"a": {"stats": {"kills": 5}}}
+        failures = [1]
+        profiles = WriteBehindProfiles(lambda key: FlakyProfile(rows, key, 1, failures), flush_period=0)
+
+        # these cannot be written in a single update
+        await profiles.set_data("a", {"stats": {"kills": {"@func": "++", "@value": 1}}}, path=None)
+        await profiles.set_data("a", {"log": {"@func": "array_append", "@value": 1, "@limit": 5, "@shift": True}})
+        await profiles.set_data("a", {"log": {"@func": "array_append", "@value": 2, "@limit": 3, "@shift": True}})
+
+        await profiles.flush()
+        self.assertEqual(rows["a"], {"stats": {"kills": 6}, "log": [1]})
+        self.assertEqual(rows["writes"], 1)
+
+        # only the deltas that are not written are put back
+        pending = await profiles.buffer.peek("a")
+        self.assertEqual(pending.increments, {})
+        self.assertEqual(pending.appends, {("log",): [[[2], 3, True]]})
+        self.assertEqual(pending.updates, 3)
+
+        await profiles.flush()
+        self.assertEqual(rows["a"], {"stats": {"kills": 6}, "log": [1, 2]})
+        self.assertEqual(await profiles.buffer.keys(), [])
+
+    @gen_test
+    async def test_write_behind_limits(self):
+        rows = {"a": {"log": [1, 2, 3, 4]}}
+        profiles = WriteBehindProfiles(lambda key: StoredProfile(rows, key), flush_period=0)
+
+        for value, limit in [(5, 5), (6, 5), (7, 2), (8, 4)]:
+            await profiles.set_data("a", {"log": {
+                "@func": "array_append", "@value": value, "@limit": limit, "@shift": True}}, path=None)
+
+        deltas = await profiles.buffer.peek("a")
+        self.assertEqual(deltas.appends, {("log",): [[[5, 6], 5, True], [[7], 2, True], [[8], 4, True]]})
+        self.assertEqual(len(deltas.build()), 3)
+
+        # same as applying them one by one
+        await profiles.flush()
+        self.assertEqual(rows["a"], {"log": [6, 7, 8]})
+
+    @gen_test
+    async def test_read(self):
+        row = {"data": {"a": {"b": [1, 2], "c": "x"}}, "version": 1}
+
+        path = ["a", "b"]
+        profile = PartialReadProfile(row)
+        self.assertEqual(await profile.read(path), [1, 2])
+        self.assertEqual(await profile.read(["a", "d"]), None)
+        self.assertEqual(path, ["a", "b"])
+        self.assertEqual(profile.selected[0], ('JSON_EXTRACT(`profile_object`, %s)', ['$."a"."b"']))
+        self.assertEqual(profile.documents, 0)
+
+        # the whole document, path is not altered either
+        self.assertEqual(await profile.read(None), row["data"])
+        self.assertEqual(await PredefinedProfile(row["data"]).get_data(path), [1, 2])
+        self.assertEqual(path, ["a", "b"])
+
+        cache = ProfileCache()
+        profile = PartialReadProfile(row, cache=cache)
+        self.assertEqual(await profile.read(["a", "c"]), "x")
+        self.assertEqual(await profile.read(["a", "b"]), [1, 2])
+        self.assertEqual(profile.documents, 1)
+        self.assertEqual(profile.selected, [])
+
+        # a new version is read again
+        await profile.set_data({"a": {"c": "y"}}, path=None)
+        self.assertEqual(await profile.read(["a", "c"]), "y")
+        self.assertEqual(profile.documents, 3)
+
+        # no get_partial, the whole document is read
+        profile = ReadProfile(row)
+        self.assertEqual(await profile.read(["a", "c"]), "y")
+        self.assertEqual(profile.documents, 1)
+
+    @gen_test
+    async def test_read_errors(self):
+        row = {"data": {"a": 1}, "version": 1}
+
+        # the errors of the implemented methods are not taken for missing methods
+        with self.assertRaises(NotImplementedError):
+            await BrokenReadProfile(row).read(["a"])
+
+        profile = BrokenReadProfile(row, cache=ProfileCache(), broken=("get_versioned", ))
+        with self.assertRaises(NotImplementedError):
+            await profile.read(["a"])
+        with self.assertRaises(NotImplementedError):
+            await profile.read(None)
+
+    @gen_test(timeout=30)
+    async def test_dry_run(self):
+        documents = [(i, {"gold": i}) for i in range(100)] + [(100, None), (101, '{"gold": 1000}'), (102, "{")]
+        update = {"gold": {"@func": "--/0", "@value": 50}}
+
+        for processes in (0, 2):
+            dry_run = ProfileDryRun(update, changes=True, processes=processes, chunk_size=7)
+
+            try:
+                results = [item async for item in dry_run.evaluate(documents)]
+            finally:
+                dry_run.stop()
+
+            self.assertEqual([key for key, result in results], [key for key, data in documents])
+            results = dict(results)
+
+            self.assertEqual(results[60], [(("gold",), 10)])
+            self.assertIsInstance(results[10], ProfileError)
+            self.assertIsInstance(results[100], ProfileError)
+            self.assertEqual(results[101], [(("gold",), 950)])
+            self.assertIn("Failed to evaluate", results[102].message)
+            self.assertEqual(sum(1 for result in results.values() if isinstance(result, ProfileError)), 52)
+
+        # nothing is changed
+        self.assertEqual(documents[60], (60, {"gold": 60}))
+
+        dry_run = ProfileDryRun(update, path=["stats"], processes=0)
+        self.assertEqual(await dry_run.evaluate_all([(1, {"stats": {"gold": 70}})]), {1: {"gold": 20}})
+
+
+class TestKeyValueProfileDeltasBuffer(AsyncTestCase):
+    """
+    Runs against a Redis at localhost:6379, skipped if there is none
+    """
+
+    def setUp(self):
+        super(TestKeyValueProfileDeltasBuffer, self).setUp()
+        self.kv = KeyValueStorage(host="127.0.0.1", port=6379, db=0, max_connections=4)
+        self.prefix = "test_" + random_string(8) + ":"
+        self.buffer = KeyValueProfileDeltasBuffer(self.kv, prefix=self.prefix, buckets=4)
+
+        try:
+            self.io_loop.run_sync(self.ping, timeout=1)
+        except Exception:
+            self.io_loop.run_sync(self.kv.close)
+            self.skipTest("No redis at localhost:6379")
+
+    async def ping(self):
+        async with self.kv.acquire() as db:
+            await db.ping()
+
+    def tearDown(self):
+        self.io_loop.run_sync(self.cleanup)
+        super(TestKeyValueProfileDeltasBuffer, self).tearDown()
+
+    async def cleanup(self):
+        async with self.kv.acquire() as db:
+            keys = await db.keys(self.prefix + "*")
+            if keys:
+                await db.delete(*keys)
+
+        await self.kv.close()
+
+    @staticmethod
+    def deltas(increments=(), appends=(), updates=1):
+        deltas = ProfileDeltas()
+        for path, value in increments:
+            deltas.increment(path, value)
+        for path, value, limit, shift in appends:
+            deltas.append(path, value, limit, shift)
+        deltas.updates = updates
+        return deltas
+
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            ProfileDeltasBuffer()
+
+    @gen_test
+    async def test_add(self):
+        self.assertEqual(await self.buffer.add(1, self.deltas(
+            increments=[(("gold", ), 5), (("stats", "time"), 0.5)],
+            appends=[(("log", ), {"a": 1}, 3, True)])), 1)
+
+        self.assertEqual(await self.buffer.add(1, self.deltas(
+            increments=[(("gold", ), -2), (("stats", "time"), 0.25)],
+            appends=[(("log", ), "b", 3, True), (("log", ), "c", None, False)],
+            updates=2)), 3)
+
+        await self.buffer.add("other", self.deltas(increments=[(("gold", ), 1)]))
+        self.assertEqual(sorted(await self.buffer.keys()), ["1", "other"])
+
+        deltas = await self.buffer.peek(1)
+        self.assertEqual(deltas.updates, 3)
+        self.assertEqual(deltas.increments, {("gold", ): 3, ("stats", "time"): 0.75})
+        self.assertIsInstance(deltas.increments[("gold", )], int)
+        # consecutive appends with the same limit are merged, in order
+        self.assertEqual(deltas.appends, {("log", ): [[[{"a": 1}, "b"], 3, True], [["c"], None, False]]})
+
+        # peek leaves them as is
+        self.assertEqual((await self.buffer.take(1)).increments, deltas.increments)
+        self.assertIsNone(await self.buffer.take(1))
+        self.assertIsNone(await self.buffer.peek(1))
+        self.assertEqual(await self.buffer.keys(), ["other"])
+
+    @gen_test
+    async def test_keys(self):
+        for i in range(20):
+            await self.buffer.add(i, self.deltas(increments=[(("a", ), 1)]))
+
+        # every key of the Profile object shares the hash tag of its bucket with the set of keys
+        async with self.kv.acquire() as db:
+            keys = await db.keys(self.prefix + "*")
+
+        tags = {key.decode().split("}")[0] + "}" for key in keys}
+        self.assertEqual(len(tags), 4)
+        self.assertEqual(len(keys), 20 * 2 + 4)
+        self.assertEqual(sorted(await self.buffer.keys(), key=int), [str(i) for i in range(20)])
@@ -0,0 +1,393 @@
+from tornado.testing import AsyncTestCase, gen_test
+
+from anthill.common import random_string
+from anthill.common.keyvalue import KeyValueStorage
+from anthill.common import monitoring
+from anthill.common.ratelimit import HeavyHitters, RateLimit, RateLimitEngine, RateLimitExceeded, \
+    RateLimitTelemetry, BucketsRateLimitEngine, SlidingWindowRateLimitEngine
+
+from collections import Counter
+import random
+
+
+class MemoryKeyValue(object):
+    """
+    Stands for a key/value storage, for the engines that do not touch it
+    """
+
+    sharded = None
+
+    def acquire(self):
+        return self
+
+    async def __aenter__(self):
+        return None
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+
+class MemoryRateLimitEngine(RateLimitEngine):
+    """
+    A plain counter of the actions used, that never resets; counts the calls to the storage it would make
+    """
+
+    CAN_RESERVE = True
+
+    def __init__(self, sharded=False):
+        super(MemoryRateLimitEngine, self).__init__(sharded)
+        self.used = Counter()
+        self.calls = 0
+
+    async def reserve(self, db, action, key, max_requests, requests_in_time, amount):
+        self.calls += 1
+        granted = min(amount, max_requests - self.used[(action, key)])
+
+        if granted <= 0:
+            return 0, 5
+
+        self.used[(action, key)] += granted
+        return granted, None
+
+    async def limit(self, db, action, key, max_requests, requests_in_time):
+        granted, retry_after = await self.reserve(db, action, key, max_requests, requests_in_time, 1)
+
+        if not granted:
+            raise RateLimitExceeded(retry_after)
+
+    async def rollback(self, db, action, key, state):
+        self.used[(action, key)] -= 1
+
+
+class TestRateLimit(AsyncTestCase):
+    def create(self, actions, engine=None, **kwargs):
+        limit = RateLimit({}, kv=MemoryKeyValue(), **kwargs)
+        engine = engine or MemoryRateLimitEngine()
+
+        for action, (max_requests, requests_in_time) in actions.items():
+            limit.actions[action] = (max_requests, requests_in_time, engine)
+
+        return limit, engine
+
+    async def admitted(self, limit, action, key):
+        try:
+            await limit.limit(action, key)
+        except RateLimitExceeded:
+            return False
+        return True
+
+    def test_actions(self):
+        limit = RateLimit({
+            "a": "10,60",
+            "b": "5,30,window",
+            "c": "5",
+            "d": "5,30,nope",
+            "e": "x,30"
+        }, kv=MemoryKeyValue(), engine="token_bucket")
+
+        self.assertEqual(sorted(limit.actions.keys()), ["a", "b"])
+        self.assertEqual(limit.actions["a"][:2], (10, 60))
+        self.assertIs(limit.actions["a"][2], limit.engines["token_bucket"])
+        self.assertIs(limit.actions["b"][2], limit.engines["window"])
+
+        with self.assertRaises(KeyError):
+            RateLimit({}, kv=MemoryKeyValue(), engine="nope")
+
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            RateLimitEngine()
+
+        # optional capabilities fail clearly
+        with self.assertRaises(NotImplementedError):
+            BucketsRateLimitEngine().entry("a", "b", 1, 1, 0)
+
+        self.assertFalse(BucketsRateLimitEngine.CAN_RESERVE)
+        self.assertTrue(SlidingWindowRateLimitEngine.CAN_RESERVE)
+
+    def test_buckets_keys(self):
+        # the original format is kept, unless the storage is sharded
+        self.assertEqual(BucketsRateLimitEngine().keys("login", "5"), [
+            "rate:login:5:8", "rate:login:5:4", "rate:login:5:2", "rate:login:5:1"])
+        self.assertEqual(BucketsRateLimitEngine(sharded=True).keys("login", "5"), [
+            "rate:{login:5}:8", "rate:{login:5}:4", "rate:{login:5}:2", "rate:{login:5}:1"])
+
+    def test_window_retry_after(self):
+        window, weight = SlidingWindowRateLimitEngine.window(125.0, 10)
+        self.assertEqual(window, 12)
+        self.assertAlmostEqual(weight, 0.5)
+
+        # the current window is full: it has to become the previous one (in 5 seconds), and lose some weight
+        self.assertAlmostEqual(SlidingWindowRateLimitEngine.retry_after(10, 10, 0.5, 10, 0), 5.0)
+        self.assertAlmostEqual(SlidingWindowRateLimitEngine.retry_after(10, 10, 0.5, 20, 0), 10.0)
+        # the previous window has to lose enough weight to free one action
+        self.assertAlmostEqual(SlidingWindowRateLimitEngine.retry_after(10, 10, 0.5, 5, 10), 0.0)
+        self.assertAlmostEqual(SlidingWindowRateLimitEngine.retry_after(10, 10, 0.8, 5, 10), 3.0)
+
+    @gen_test
+    async def test_limit(self):
+        limit, engine = self.create({"a": (2, 60)})
+
+        self.assertTrue(await self.admitted(limit, "a", "k"))
+        lock = await limit.limit("a", "k")
+        self.assertFalse(await self.admitted(limit, "a", "k"))
+
+        await lock.rollback()
+        # only once
+        await lock.rollback()
+        self.assertEqual(engine.used[("a", "k")], 1)
+
+        self.assertTrue(await self.admitted(limit, "a", "k"))
+        self.assertTrue(await self.admitted(limit, "a", "other"))
+        # not limited
+        self.assertTrue(await self.admitted(limit, "b", "k"))
+
+    @gen_test
+    async def test_local_deny(self):
+        limit, engine = self.create({"a": (1, 60)}, local_deny=True)
+
+        self.assertTrue(await self.admitted(limit, "a", "k"))
+        self.assertFalse(await self.admitted(limit, "a", "k"))
+        calls = engine.calls
+
+        with self.assertRaises(RateLimitExceeded) as context:
+            await limit.limit("a", "k")
+
+        self.assertEqual(engine.calls, calls)
+        self.assertLessEqual(context.exception.retry_after, 5)
+
+    @gen_test
+    async def test_lease(self):
+        limit, engine = self.create({"a": (10, 60)}, lease=0.3)
+
+        locks = [await limit.limit("a", "k") for i in range(3)]
+
+        # three actions are reserved at once, and spent locally
+        self.assertEqual(engine.calls, 1)
+        self.assertEqual(engine.used[("a", "k")], 3)
+
+        await locks[0].rollback()
+        await limit.limit("a", "k")
+        self.assertEqual(engine.calls, 1)
+
+        results = [await self.admitted(limit, "a", "k") for i in range(10)]
+        self.assertEqual(results.count(True), 7)
+        self.assertEqual(engine.used[("a", "k")], 10)
+
+    @gen_test
+    async def test_lease_buckets(self):
+        # the buckets engine cannot reserve, so no leases are taken
+        limit, engine = self.create({"a": (10, 60)}, lease=0.3)
+        engine.CAN_RESERVE = False
+
+        for i in range(3):
+            await limit.limit("a", "k")
+
+        self.assertEqual(engine.calls, 3)
+
+    @gen_test
+    async def test_limit_many(self):
+        limit, engine = self.create({"a": (1, 60), "b": (1, 60)})
+
+        self.assertTrue(await self.admitted(limit, "b", "k"))
+
+        with self.assertRaises(RateLimitExceeded):
+            await limit.limit_many([("a", "k"), ("b", "k"), ("c", "k")])
+
+        # none of them is used up
+        self.assertEqual(engine.used[("a", "k")], 0)
+
+        locks = await limit.limit_many([("a", "k"), ("b", "other")])
+        self.assertEqual(engine.used[("a", "k")], 1)
+        await locks.rollback()
+        self.assertEqual(engine.used[("a", "k")], 0)
+        self.assertEqual(engine.used[("b", "other")], 0)
+
+
+class TestRateLimitEngines(AsyncTestCase):
+    """
+    Runs the engines against a Redis at localhost:6379, skipped if there is none
+    """
+
+    def setUp(self):
+        super(TestRateLimitEngines, self).setUp()
+        self.kv = KeyValueStorage(host="127.0.0.1", port=6379, db=0, max_connections=4)
+        self.action = "test_" + random_string(8)
+
+        try:
+            self.io_loop.run_sync(self.ping, timeout=1)
+        except Exception:
+            self.kv.connection_pool.close()
+            self.skipTest("No redis at localhost:6379")
+
+    async def ping(self):
+        async with self.kv.acquire() as db:
+            await db.ping()
+
+    def tearDown(self):
+        self.io_loop.run_sync(self.cleanup)
+        self.kv.stop()
+        super(TestRateLimitEngines, self).tearDown()
+
+    async def cleanup(self):
+        async with self.kv.acquire() as db:
+            keys = await db.keys("rate*" + self.action + "*")
+            if keys:
+                await db.delete(*keys)
+
+        self.kv.connection_pool.close()
+        await self.kv.connection_pool.wait_closed()
+
+    async def check_engine(self, engine):
+        limit = RateLimit({self.action: "5,60," + engine}, kv=self.kv)
+
+        results = []
+        for i in range(8):
+            try:
+                results.append(await limit.limit(self.action, "k"))
+            except RateLimitExceeded:
+                results.append(None)
+
+        self.assertEqual([result is not None for result in results], [True] * 5 + [False] * 3)
+
+        await results[0].rollback()
+        locks = await limit.limit_many([(self.action, "k"), (self.action, "other")])
+        self.assertEqual(len(locks.locks), 2)
+
+        with self.assertRaises(RateLimitExceeded):
+            await limit.limit(self.action, "k")
+
+    @gen_test
+    async def test_buckets(self):
+        await self.check_engine("buckets")
+
+        async with self.kv.acquire() as db:
+            self.assertEqual(await db.get("rate:" + self.action + ":k:1"), b"0")
+
+    @gen_test
+    async def test_window(self):
+        await self.check_engine("window")
+
+    @gen_test
+    async def test_token_bucket(self):
+        await self.check_engine("token_bucket")
+
+    async def check_rollback_expired(self, engine, pattern):
+        limit = RateLimit({self.action: "5,60," + engine}, kv=self.kv)
+
+        lock = await limit.limit(self.action, "k")
+        await limit.limit(self.action, "k")
+
+        async with self.kv.acquire() as db:
+            keys = await db.keys(pattern + self.action + "*")
+            self.assertEqual(len(keys), 1)
+            self.assertGreater(await db.ttl(keys[0]), 0)
+
+            # a rollback that comes after the key has expired does not bring it back
+            await db.delete(*keys)
+            await lock.rollback()
+            self.assertEqual(await db.exists(*keys), 0)
+
+        # but a one in time does roll back
+        lock = await limit.limit(self.action, "k")
+        await lock.rollback()
+
+        async with self.kv.acquire() as db:
+            keys = await db.keys(pattern + self.action + "*")
+            self.assertGreater(await db.ttl(keys[0]), 0)
+
+        return keys[0]
+
+    @gen_test
+    async def test_window_rollback_expired(self):
+        key = await self.check_rollback_expired("window", "rate_w:*")
+
+        async with self.kv.acquire() as db:
+            self.assertEqual(await db.get(key), b"0")
+
+    @gen_test
+    async def test_token_bucket_rollback_expired(self):
+        key = await self.check_rollback_expired("token_bucket", "rate_t:*")
+
+        async with self.kv.acquire() as db:
+            self.assertAlmostEqual(float(await db.hget(key, "t")), 5, places=2)
+
+
+class TestHeavyHitters(AsyncTestCase):
+    def test_exact(self):
+        sketch = HeavyHitters(10)
+
+        for key, amount in [("a", 1), ("b", 3), ("a", 1), ("c", 1)]:
+            sketch.add(key, amount)
+
+        self.assertEqual(sketch.top(2), [("b", 3, 0), ("a", 2, 0)])
+        self.assertEqual(sketch.total, 6)
+        self.assertEqual(len(sketch), 3)
+
+    def test_replace_least(self):
+        sketch = HeavyHitters(2)
+
+        sketch.add("a", 5)
+        sketch.add("b", 2)
+        sketch.add("a", 1)
+        # "b" is the least counted one, "c" inherits its count as the error
+        sketch.add("c")
+
+        self.assertEqual(sketch.top(2), [("a", 6, 0), ("c", 3, 2)])
+
+        # the heap entry of "a" is behind its counter, it should not be taken for the least one
+        sketch.add("d")
+        self.assertEqual(sketch.top(2), [("a", 6, 0), ("d", 4, 3)])
+
+    def test_guarantees(self):
+        rng = random.Random(1)
+        sketch = HeavyHitters(50)
+        counts = Counter()
+
+        for i in range(20000):
+            # a few hot keys in a long tail
+            key = "hot{0}".format(rng.randrange(5)) if rng.random() < 0.3 else "key{0}".format(rng.randrange(5000))
+            sketch.add(key)
+            counts[key] += 1
+
+        self.assertEqual(len(sketch), 50)
+        self.assertEqual(len(sketch.heap), 50)
+
+        top = sketch.top(50)
+        tracked = {key for key, count, error in top}
+
+        for key, count in counts.items():
+            if count > sketch.total / sketch.capacity:
+                self.assertIn(key, tracked)
+
+        for key, count, error in top:
+            self.assertLessEqual(count - error, counts[key])
+            self.assertGreaterEqual(count, counts[key])
+
+        self.assertEqual({key for key, count, error in top[:5]}, {"hot{0}".format(i) for i in range(5)})
+
+
+class TestRateLimitTelemetry(AsyncTestCase):
+    def test_report(self):
+        telemetry = RateLimitTelemetry(capacity=10, report_period=0, report_top=2)
+
+        for key, verdict in [("a", "rejected")] * 5 + [("b", "rejected")] * 3 + [("c", "rejected"), ("d", "admitted")]:
+            telemetry.add("login", key, verdict)
+
+        reported = []
+        monitor_action = monitoring.monitor_action
+        monitoring.monitor_action = lambda name, values, **tags: reported.append((name, values, tags))
+        try:
+            telemetry.__report__()
+        finally:
+            monitoring.monitor_action = monitor_action
+
+        # the keys are never the tags
+        self.assertEqual(reported, [
+            ("ratelimit.verdicts", {"admitted": 1, "rejected": 9}, {"action": "login"}),
+            ("ratelimit.offenders", {"keys": 3, "top_count": 5, "top_share": 8.0 / 9},
+             {"action": "login", "verdict": "rejected"})
+        ])
+
+        # but they are kept for the admin view
+        self.assertEqual(telemetry.reported["login"]["rejected"]["top"], [("a", 5, 0), ("b", 3, 0)])
+        self.assertEqual(telemetry.top(2), {})
@@ -0,0 +1,286 @@
+from tornado.testing import AsyncTestCase
+from tornado.web import HTTPError
+
+from anthill.common.validate import validate, validate_value, set_json_limits, ValidationError, \
+    Schema, Field, SchemaError
+from anthill.common.handler import AnthillRequestHandler
+from anthill.common import validate as validate_module
+
+import ujson
+
+
+class TestJsonLimits(AsyncTestCase):
+    def setUp(self):
+        super(TestJsonLimits, self).setUp()
+        self.limits = (validate_module.JSON_MAX_SIZE, validate_module.JSON_MAX_DEPTH,
+                       validate_module.JSON_MAX_ELEMENTS, validate_module.JSON_MAX_STRING)
+
+    def tearDown(self):
+        max_size, max_depth, max_elements, max_string = self.limits
+        set_json_limits(max_size=max_size, max_depth=max_depth, max_elements=max_elements, max_string=max_string)
+        super(TestJsonLimits, self).tearDown()
+
+    def check_rejected(self, value, validator, message):
+        with self.assertRaises(ValidationError) as context:
+            validate_value(value, validator)
+        self.assertIn(message, context.exception.message)
+
+    def test_size(self):
+        set_json_limits(max_size=20)
+
+        self.assertEqual(validate_value('{"a": "0123456789"}', "load_json"), {"a": "0123456789"})
+        self.check_rejected('{"a": "01234567890123"}', "load_json", "is too large")
+        self.check_rejected({"a": "01234567890123"}, "json_dict", "is too large")
+
+        # before it's even decoded
+        self.check_rejected("{" * 21, "load_json", "is too large")
+
+    def test_depth(self):
+        set_json_limits(max_depth=3)
+
+        self.assertEqual(validate_value('{"a": [{"b": 1}]}', "load_json"), {"a": [{"b": 1}]})
+        self.check_rejected('{"a": [{"b": [1]}]}', "load_json", "is nested too deep")
+        self.check_rejected({"a": [{"b": [1]}]}, "json_dict", "is nested too deep")
+        self.check_rejected([[[[]]]], "json_list", "is nested too deep")
+
+        # brackets inside of strings are not nesting
+        self.assertEqual(validate_value('{"a": "[[[[{{{{"}', "load_json"), {"a": "[[[[{{{{"})
+        self.assertEqual(validate_value({"a": '"[[[['}, "json_dict"), {"a": '"[[[['})
+
+    def test_elements(self):
+        set_json_limits(max_elements=5)
+
+        self.assertEqual(validate_value("[1, 2, [3]]", "load_json"), [1, 2, [3]])
+        self.check_rejected("[1, 2, [3, 4, 5]]", "load_json", "has too many elements")
+        self.check_rejected({"a": 1, "b": {"c": 2, "d": 3, "e": 4}}, "json_dict", "has too many elements")
+        self.check_rejected('{"a": 1, "b": 2, "c": 3, "d": 4, "e": 5, "f": 6}', "load_json_dict_of_ints",
+                            "has too many elements")
+
+        # commas inside of strings are not separators
+        self.assertEqual(validate_value('["a,b,c,d,e,f"]', "load_json"), ["a,b,c,d,e,f"])
+
+    def test_string(self):
+        set_json_limits(max_string=5)
+
+        self.assertEqual(validate_value({"abcde": ["abcde"]}, "json_dict"), {"abcde": ["abcde"]})
+        self.check_rejected('{"a": ["abcdef"]}', "load_json", "has a string too long")
+        self.check_rejected('{"abcdef": 1}', "load_json", "has a string too long")
+        self.check_rejected({"a": {"abcdef": 1}}, "json_dict", "has a string too long")
+        self.check_rejected({"a": "abcdef"}, "json_dict_of_strings", "has a string too long")
+        self.check_rejected(["abcdef"], "json_list_of_strings", "has a string too long")
+
+        # escaped quotes are counted in properly
+        self.check_rejected('["a\\"bcdef"]', "load_json", "has a string too long")
+
+    def test_not_str_keys(self):
+        set_json_limits(max_string=5, max_depth=2)
+
+        # ujson converts the keys, they are not strings to check
+        value = {1: {2: "abc"}, 3.5: None, None: [1]}
+        self.assertIs(validate_value(value, "json_dict"), value)
+        self.check_rejected({1: {2: "abcdef"}}, "json_dict", "has a string too long")
+        self.check_rejected({1: {2: [1]}}, "json_dict", "is nested too deep")
+
+    def test_defaults(self):
+        value = {"a": [{"b": "c" * 1000}] * 100}
+        self.assertEqual(validate_value(ujson.dumps(value), "load_json_dict"), value)
+        self.assertIs(validate_value(value, "json_dict"), value)
+
+
+class ArgumentsHandler(object):
+    """
+    Stands for a request handler, with the request arguments given
+    """
+
+    get_schema_arguments = AnthillRequestHandler.get_schema_arguments
+
+    def __init__(self, schema, **arguments):
+        self.schema = schema
+        self.arguments = arguments
+
+    def get_argument(self, name, default):
+        return self.arguments.get(name, default)
+
+
+class TestSchema(AsyncTestCase):
+    def test_validate(self):
+        schema = Schema(
+            name="str_name",
+            amount=Field("int", default=1),
+            payload=Field("load_json_dict", default=None, argument="data"),
+            raw=Field(None, default="x"),
+            date=Field(dict, default=None))
+
+        self.assertEqual(schema.validate({"name": "a", "amount": "5", "data": '{"b": 1}', "raw": [1]}), {
+            "name": "a", "amount": 5, "payload": {"b": 1}, "raw": [1], "date": None})
+
+        # missing (or None) ones get their defaults
+        self.assertEqual(schema.validate({"name": "a", "amount": None}), {
+            "name": "a", "amount": 1, "payload": None, "raw": "x", "date": None})
+
+        # the argument name, not the field name, is looked up
+        self.assertIsNone(schema.validate({"name": "a", "payload": '{"b": 1}'})["payload"])
+
+    def test_errors(self):
+        schema = Schema(name="str_name", amount="int", data=Field("load_json_dict", argument="payload"),
+                        value=Field(dict, default=None))
+
+        with self.assertRaises(SchemaError) as context:
+            schema.validate({"name": "a b", "payload": "[", "value": 5})
+
+        # every violation is reported at once, by the argument name
+        errors = context.exception.errors
+        self.assertEqual(sorted(errors.keys()), ["amount", "name", "payload", "value"])
+        self.assertEqual(errors["amount"], "Field amount is required")
+        self.assertEqual(errors["payload"], "Field payload is not a valid JSON object")
+        self.assertIn("Field amount is required", context.exception.message)
+        self.assertIsInstance(context.exception, ValidationError)
+
+    def test_no_such_validator(self):
+        # fails only once such argument is actually passed
+        schema = Schema(a=Field("nope", default=None))
+        self.assertEqual(schema.validate({}), {"a": None})
+
+        with self.assertRaises(SchemaError) as context:
+            schema.validate({"a": 1})
+        self.assertEqual(context.exception.errors["a"], "No such validator nope")
+
+    def test_monitored(self):
+        schema = Schema(a="int", b=Field("str", default=None)).monitored("test", report_period=3600)
+        schema.validate({"a": "1"})
+        schema.validate({"a": "2", "b": "c"})
+
+        # only the values actually validated are timed
+        self.assertEqual(schema.timings["a"][0], 2)
+        self.assertEqual(schema.timings["b"][0], 1)
+
+    def test_handler(self):
+        schema = Schema(name="str_name", amount=Field("int", default=1))
+
+        handler = ArgumentsHandler(schema, name="a", amount="2", other="b")
+        self.assertEqual(handler.get_schema_arguments(), {"name": "a", "amount": 2})
+
+        with self.assertRaises(HTTPError) as context:
+            ArgumentsHandler(schema, amount="b").get_schema_arguments()
+
+        self.assertEqual(context.exception.status_code, 400)
+        self.assertIn("Field name is required", context.exception.log_message)
+        self.assertIn("Field amount is not a valid number", context.exception.log_message)
+
+    def test_handler_no_schema(self):
+        with self.assertRaises(NotImplementedError) as context:
+            ArgumentsHandler(None).get_schema_arguments()
+
+        self.assertIn("declares no schema", str(context.exception))
+
+
+class TestValidateDecorator(AsyncTestCase):
+    @staticmethod
+    @validate(a="int", b="str_name", c="json_dict", d=dict, e="nope")
+    def method(a, b="default", c=None, d=None, e=None, **kwargs):
+        return a, b, c, d, e, kwargs
+
+    def test_positional(self):
+        self.assertEqual(self.method("1", "x", {"k": 1}), (1, "x", {"k": 1}, None, None, {}))
+
+        with self.assertRaises(ValidationError):
+            self.method("a")
+        with self.assertRaises(ValidationError):
+            self.method(1, "not a name")
+
+    def test_keyword(self):
+        self.assertEqual(self.method(a="1", b="x", d={}), (1, "x", None, {}, None, {}))
+
+        # the default values are not validated
+        self.assertEqual(self.method(1, b="default", c=None), (1, "default", None, None, None, {}))
+
+        # neither the arguments without a validator
+        self.assertEqual(self.method(1, other="a b"), (1, "default", None, None, None, {"other": "a b"}))
+
+        with self.assertRaises(ValidationError) as context:
+            self.method(1, d=[])
+        self.assertEqual(context.exception.message, "d is not a 'dict'")
+
+    def test_no_such_validator(self):
+        self.assertEqual(self.method(1)[0], 1)
+
+        with self.assertRaises(ValidationError) as context:
+            self.method(1, e=5)
+        self.assertEqual(context.exception.message, "No such validator nope")
+
+    def test_compiled_once(self):
+        resolved = []
+        resolve = validate_module._resolve_validator
+
+        def counting(validator_name):
+            resolved.append(validator_name)
+            return resolve(validator_name)
+
+        validate_module._resolve_validator = counting
+        try:
+            @validate(a="int")
+            def method(a):
+                return a
+
+            for i in range(5):
+                method(str(i))
+        finally:
+            validate_module._resolve_validator = resolve
+
+        self.assertEqual(resolved, ["int"])
+
+
+class TestTypedJson(AsyncTestCase):
+    def test_loads(self):
+        self.assertEqual(validate_value('{"a": [1]}', "load_json"), {"a": [1]})
+        self.assertEqual(validate_value(b'[1, 2]', "load_json"), [1, 2])
+
+        with self.assertRaises(ValidationError) as context:
+            validate_value("{", "load_json")
+        self.assertEqual(context.exception.message, "Field value is not a valid JSON object")
+
+        with self.assertRaises(ValidationError):
+            validate_value(None, "load_json")
+        with self.assertRaises(ValidationError):
+            validate_value("[1]", "load_json_dict")
+
+    def test_dict_of_ints(self):
+        self.assertEqual(validate_value('{"a": 1, "b": "2"}', "load_json_dict_of_ints"), {"a": 1, "b": 2})
+
+        with self.assertRaises(ValidationError) as context:
+            validate_value('{"a": 1, "b": "c"}', "load_json_dict_of_ints")
+        self.assertEqual(context.exception.message, "Field value.b is not a valid number")
+
+        with self.assertRaises(ValidationError):
+            validate_value('[1]', "load_json_dict_of_ints")
+
+    def test_dict_of_copy(self):
+        value = {"a": 1, "b": "2"}
+        result = validate_value(value, "json_dict_of_ints")
+
+        # the value passed is never changed
+        self.assertEqual(result, {"a": 1, "b": 2})
+        self.assertEqual(value, {"a": 1, "b": "2"})
+
+        value = {"a": "b", "c": 5}
+        self.assertEqual(validate_value(value, "json_dict_of_primitives"), value)
+        self.assertEqual(validate_value({"a": "2"}, "json_dict_of_strings"), {"a": "2"})
+
+        with self.assertRaises(ValidationError):
+            validate_value({"a": "b c"}, "json_dict_of_primitives")
+        with self.assertRaises(ValidationError):
+            validate_value({"a": 1}, "json_dict_of_strings")
+
+    def test_dict_of_keys(self):
+        with self.assertRaises(ValidationError) as context:
+            validate_value({1: 1}, "json_dict_of_ints")
+        self.assertEqual(context.exception.message, "Field 1 is not a valid string")
+
+    def test_list_of(self):
+        self.assertEqual(validate_value([1, "2"], "json_list_of_ints"), [1, 2])
+        self.assertEqual(validate_value(["a", "b"], "json_list_of_str_name"), ["a", "b"])
+
+        with self.assertRaises(ValidationError):
+            validate_value(["a b"], "json_list_of_str_name")
+        with self.assertRaises(ValidationError):
+            validate_value({"a": 1}, "json_list_of_ints")
@@ -2,6 +2,7 @@
 import ujson
 import inspect
 import re
+import time
 from datetime import datetime
 
 
@@ -13,79 +14,127 @@ class ValidationError(Exception):
         return self.message
 
 
+class SchemaError(ValidationError):
+    def __init__(self, errors):
+        super(SchemaError, self).__init__("; ".join(errors.values()))
+        # a dict argument name -> a message
+        self.errors = errors
+
+
 _str_name_pattern = re.compile("^([A-Za-z0-9_.-]+)+$")
 _str_tags_pattern = re.compile("^([A-Za-z0-9_.,-]+)+$")
 
+# limits of JSON accepted by load_json* and json_* validators, see set_json_limits
+JSON_MAX_SIZE = 1048576
+JSON_MAX_DEPTH = 32
+JSON_MAX_ELEMENTS = 100000
+JSON_MAX_STRING = 65536
+
+
+def set_json_limits(max_size=None, max_depth=None, max_elements=None, max_string=None):
+    """
+    Configures the limits of JSON accepted by load_json* and json_* validators. Anything above the limits
+        is rejected with ValidationError, and counted in the monitoring as "validate.json_limit" rate,
+        with the name of the limit exceeded.
+
+    :param max_size: Maximum length of a JSON string, checked before the string is decoded
+    :param max_depth: Maximum depth of nesting of objects and lists
+    :param max_elements: Maximum number of values, including nested ones
+    :param max_string: Maximum length of a string value or a key
+    """
+
+    global JSON_MAX_SIZE, JSON_MAX_DEPTH, JSON_MAX_ELEMENTS, JSON_MAX_STRING
+
+    if max_size is not None:
+        JSON_MAX_SIZE = max_size
+    if max_depth is not None:
+        JSON_MAX_DEPTH = max_depth
+    if max_elements is not None:
+        JSON_MAX_ELEMENTS = max_elements
+    if max_string is not None:
+        JSON_MAX_STRING = max_string
+
 
 def validate(**fields):
     def wrapper1(method):
-        def wrapper2(*args, **kwargs):
+        # the validators are resolved once, when the method is decorated
+        positional, keyword = _compile_validators(method, fields)
 
-            _args, _varargs, _varkw, _defaults_values, i1, i2, i3 = inspect.getfullargspec(method)
-
-            # this nasty trick makes a dict from tail of _args with _defaults_values as values
-            kwarg_defaults = {
-                key: value
-                for key, value in zip(_args[-len(_defaults_values):], _defaults_values)
-            } if _defaults_values is not None else None
-
-            # this generator will return tuples (name, value) of *args
-            def _list_args():
-                for argument_value in args:
-                    argument_name = _args.pop(0)
-                    yield (argument_name, argument_value)
-
-            # this generator will return tuples (name, value) of **kwargs with their default values, if omitted
-            def _list_kwargs():
-                for argument_name, argument_value in kwargs.items():
-                    if kwarg_defaults is None:
-                        yield (argument_name, argument_value, False)
-                    elif argument_name in kwarg_defaults:
-                        default_value = kwarg_defaults[argument_name]
-                        yield (argument_name, argument_value, argument_value == default_value)
-                    else:
-                        yield (argument_name, argument_value, False)
-
-            def validate_arg(field_name, field):
-                validator_name = fields.get(field_name)
-                if not validator_name:
-                    return field
-                if inspect.isclass(validator_name):
-                    if isinstance(field, validator_name):
-                        return field
-                    else:
-                        raise ValidationError("{0} is not a '{1}'".format(field_name, validator_name.__name__))
-                validator = VALIDATORS.get(validator_name)
-                if not validator:
-                    raise ValidationError("No such validator {0}".format(validator_name))
-                return validator(field_name, field)
-
-            def validate_kwarg(field_name, value):
-                validator_name = fields.get(field_name)
-                if not validator_name:
-                    return value
-                if inspect.isclass(validator_name):
-                    if isinstance(value, validator_name):
-                        return value
-                    else:
-                        raise ValidationError("{0} is not a '{1}'".format(field_name, validator_name.__name__))
-                validator = VALIDATORS.get(validator_name)
-                if not validator:
-                    raise ValidationError("No such validator {0}".format(validator_name))
-                return validator(field_name, value)
-
-            return method(*[
-                validate_arg(field_name, field)
-                for field_name, field in _list_args()
-            ], **{
-                field_name: field if _default else validate_kwarg(field_name, field)
-                for field_name, field, _default in _list_kwargs()
-            })
+        def wrapper2(*args, **kwargs):
+            if positional and args:
+                args = list(args)
+                count = len(args)
+                for index, field_name, validator in positional:
+                    if index >= count:
+                        break
+                    args[index] = validator(field_name, args[index])
+
+            if kwargs:
+                for field_name, value in kwargs.items():
+                    entry = keyword.get(field_name)
+                    if entry is None:
+                        continue
+                    validator, has_default, default_value = entry
+                    if has_default and value == default_value:
+                        continue
+                    kwargs[field_name] = validator(field_name, value)
+
+            return method(*args, **kwargs)
 
         return wrapper2
     return wrapper1
 
 
+# returns a list of (index, name, validator) for positional arguments,
+#   and a dict name -> (validator, has a default value, the default value) for keyword arguments
+def _compile_validators(method, fields):
+    _args, _varargs, _varkw, _defaults_values, i1, i2, i3 = inspect.getfullargspec(method)
+
+    # a dict from tail of _args with _defaults_values as values
+    kwarg_defaults = {
+        key: value
+        for key, value in zip(_args[-len(_defaults_values):], _defaults_values)
+    } if _defaults_values else {}
+
+    positional = []
+    keyword = {}
+
+    for field_name, validator_name in fields.items():
+        validator = _resolve_validator(validator_name)
+        if validator is None:
+            continue
+
+        if field_name in _args:
+            positional.append((_args.index(field_name), field_name, validator))
+
+        keyword[field_name] = (validator, field_name in kwarg_defaults, kwarg_defaults.get(field_name))
+
+    positional.sort(key=lambda entry: entry[0])
+    return positional, keyword
+
+
+def _resolve_validator(validator_name):
+    if not validator_name:
+        return None
+
+    if inspect.isclass(validator_name):
+        def _instance_of(field_name, field):
+            if isinstance(field, validator_name):
+                return field
+            raise ValidationError("{0} is not a '{1}'".format(field_name, validator_name.__name__))
+        return _instance_of
+
+    validator = VALIDATORS.get(validator_name)
+
+    if not validator:
+        # fails only once such argument is actually passed
+        def _no_such_validator(field_name, field):
+            raise ValidationError("No such validator {0}".format(validator_name))
+        return _no_such_validator
+
+    return validator
+
+
 def validate_value(value, validator_name):
     if not validator_name:
         return value
@@ -100,26 +149,336 @@ def validate_value(value, validator_name):
     return validator('value', value)
 
 
+_required = object()
+
+
+class Field(object):
+    """
+    A field of a Schema.
+
+    :param validator: A validator name (see VALIDATORS), a class, or None to take the value as is
+    :param default: A value to use if the field is missing, if not set, the field is required
+    :param argument: A name of the request argument, the name of the field by default
+    """
+
+    def __init__(self, validator, default=_required, argument=None):
+        self.validator = validator
+        self.default = default
+        self.argument = argument
+
+
+class Schema(object):
+    """
+    Declares the arguments of a request handler. The validators are resolved once, when the schema is created
+        (along with the handler class), and all of the fields are validated in a single pass, reporting every
+        violation at once (see SchemaError):
+
+    class ItemHandler(AuthenticatedHandler):
+        schema = Schema(
+            name="str_name",
+            amount=Field("int", default=1),
+            payload=Field("load_json_dict", default=None)).monitored("item")
+
+        async def post(self):
+            arguments = self.get_schema_arguments()
+            ...
+
+    A field given as a validator name (or a class) is required.
+    """
+
+    def __init__(self, **fields):
+        # a tuple of (field name, argument name, a validator or None, a default value)
+        self.fields = tuple(
+            (name, field.argument or name, _resolve_validator(field.validator), field.default)
+            for name, field in (
+                (name, field if isinstance(field, Field) else Field(field))
+                for name, field in fields.items()
+            )
+        )
+        self.arguments = tuple(argument for name, argument, validator, default in self.fields)
+        self.monitor = None
+        self.report_period = None
+        self.timings = None
+        self.started = None
+
+    def monitored(self, name, report_period=60):
+        """
+        Enables timing of the fields: every <report_period> seconds, an average time spent on every field
+            (in milliseconds) is reported to the monitoring as "validate.schema" action, tagged with schema=<name>.
+
+        :returns the schema itself
+        """
+        self.monitor = name
+        self.report_period = report_period
+        self.timings = {}
+        self.started = time.time()
+        return self
+
+    def validate(self, values):
+        """
+        :param values: A dict argument name -> a raw value, a missing value is either absent or None
+        :returns a dict field name -> a validated value
+        :raises SchemaError with every violation found
+        """
+        result = {}
+        errors = None
+        timings = self.timings
+
+        for name, argument, validator, default in self.fields:
+            value = values.get(argument)
+
+            if value is None:
+                if default is _required:
+                    if errors is None:
+                        errors = {}
+                    errors[argument] = "Field {0} is required".format(argument)
+                else:
+                    result[name] = default
+                continue
+
+            if validator is None:
+                result[name] = value
+                continue
+
+            if timings is not None:
+                started = time.perf_counter()
+
+            try:
+                result[name] = validator(argument, value)
+            except ValidationError as e:
+                if errors is None:
+                    errors = {}
+                errors[argument] = e.message
+
+            if timings is not None:
+                timing = timings.get(name)
+                if timing is None:
+                    timing = [0, 0.0]
+                    timings[name] = timing
+                timing[0] += 1
+                timing[1] += time.perf_counter() - started
+
+        if timings is not None and time.time() - self.started >= self.report_period:
+            self.__report__()
+
+        if errors:
+            raise SchemaError(errors)
+
+        return result
+
+    def validate_handler(self, handler):
+        """
+        Validates the arguments of a request (both query and body, see RequestHandler.get_argument)
+        """
+        get_argument = handler.get_argument
+        return self.validate({
+            argument: get_argument(argument, None)
+            for argument in self.arguments
+        })
+
+    def __report__(self):
+        from . import monitoring
+
+        timings, self.timings = self.timings, {}
+        self.started = time.time()
+
+        if timings:
+            monitoring.monitor_action("validate.schema", {
+                name: total * 1000 / count
+                for name, (count, total) in timings.items()
+            }, schema=self.monitor)
+
+
 def _json(field_name, field):
-    try:
-        ujson.dumps(field)
-    except TypeError:
-        raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
+    _dumps(field_name, field)
     return field
 
 
-def _load_json(field_name, field):
+def _reject(field_name, limit, message):
+    from . import monitoring
+    monitoring.monitor_rate("validate", "json_limit", limit=limit)
+    raise ValidationError("Field {0} {1}".format(field_name, message))
+
+
+# decodes a JSON string, the size is checked before anything is decoded
+def _loads(field_name, field, check_limits=True):
+    if isinstance(field, (str, bytes)) and len(field) > JSON_MAX_SIZE:
+        _reject(field_name, "size", "is too large")
+
     try:
-        return ujson.loads(field)
+        value = ujson.loads(field)
     except (TypeError, ValueError):
         raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
 
+    if check_limits:
+        _check_limits(field_name, field, value)
 
-def _load_json_dict(field_name, field):
+    return value
+
+
+# serializes a JSON object, to make sure it is one
+def _dumps(field_name, field, message="is not a valid JSON object"):
     try:
-        field = ujson.loads(field)
-    except (TypeError, ValueError):
-        raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
+        encoded = ujson.dumps(field)
+    except (TypeError, ValueError, OverflowError):
+        raise ValidationError("Field {0} {1}".format(field_name, message))
+
+    if len(encoded) > JSON_MAX_SIZE:
+        _reject(field_name, "size", "is too large")
+
+    _check_limits(field_name, encoded, field)
+
+
+# checks the limits of <value>, decoded from (or encoded into) <encoded>; the encoded string tells cheaply
+#   which limits cannot be exceeded, and if any can, the value is walked once, until the first violation
+def _check_limits(field_name, encoded, value):
+    if not isinstance(value, (dict, list)):
+        if isinstance(value, str) and len(value) > JSON_MAX_STRING:
+            _reject(field_name, "string", "has a string too long")
+        return
+
+    if isinstance(encoded, bytes):
+        brackets = encoded.count(b"{") + encoded.count(b"[")
+        commas = encoded.count(b",")
+    else:
+        brackets = encoded.count("{") + encoded.count("[")
+        commas = encoded.count(",")
+
+    # there cannot be deeper nesting than the number of brackets, more elements than separators,
+    #   or a longer string than the whole JSON
+    check_depth = brackets > JSON_MAX_DEPTH
+    check_elements = brackets + commas + 1 > JSON_MAX_ELEMENTS
+    check_strings = len(encoded) > JSON_MAX_STRING
+
+    if (check_depth or check_strings) and isinstance(encoded, str):
+        check_depth, check_strings = _scan_limits(encoded, check_depth, check_strings)
+
+    if check_depth or check_elements or check_strings:
+        _walk_limits(field_name, value, check_depth, check_elements, check_strings)
+
+
+# brackets of both kinds become the same (they are properly nested anyway), quotes are kept, everything else
+#   is removed
+_structure_table = bytes.maketrans(b"{}", b"[]")
+_structure_delete = bytes(code for code in range(256) if code not in b'[]{}"')
+
+
+# tells by the JSON string itself (at C speed, unlike walking the value) that the depth and the strings are within
+#   the limits; returns the flags of the limits that still need to be checked by walking the value
+def _scan_limits(encoded, check_depth, check_strings):
+    # with no escaped quotes, every odd part between quotes is a string
+    if not encoded.isascii() or '\\"' in encoded:
+        return check_depth, check_strings
+
+    if check_strings:
+        strings = encoded.split('"')[1::2]
+        check_strings = bool(strings) and max(map(len, strings)) > JSON_MAX_STRING
+
+    if check_depth:
+        # if no string has brackets in it, all of the quotes are left in pairs
+        structure = encoded.encode("ascii").translate(_structure_table, _structure_delete).replace(b'""', b"")
+
+        if b'"' not in structure:
+            # every pass removes the innermost level
+            for level in range(JSON_MAX_DEPTH):
+                if not structure:
+                    break
+                structure = structure.replace(b"[]", b"")
+
+            check_depth = bool(structure)
+
+    return check_depth, check_strings
+
+
+def _walk_limits(field_name, field, check_depth, check_elements, check_strings):
+    max_depth = JSON_MAX_DEPTH if check_depth else None
+    max_elements = JSON_MAX_ELEMENTS if check_elements else None
+    max_string = JSON_MAX_STRING if check_strings else None
+
+    pending = [(field, 1)]
+    elements = 1
+
+    while pending:
+        value, depth = pending.pop()
+
+        if max_depth is not None and depth > max_depth:
+            _reject(field_name, "depth", "is nested too deep")
+
+        if isinstance(value, dict):
+            if max_string is not None:
+                for key in value:
+                    # a dict passed to json_* validators may have keys of other types, ujson converts them
+                    if isinstance(key, str) and len(key) > max_string:
+                        _reject(field_name, "string", "has a string too long")
+            children = value.values()
+        else:
+            children = value
+
+        if max_elements is not None:
+            elements += len(value)
+            if elements > max_elements:
+                _reject(field_name, "elements", "has too many elements")
+
+        for child in children:
+            if isinstance(child, (dict, list)):
+                pending.append((child, depth + 1))
+            elif max_string is not None and isinstance(child, str) and len(child) > max_string:
+                _reject(field_name, "string", "has a string too long")
+
+
+# validates every value of a dict in a single pass, failing on the first bad one; values of <value_class>
+#   are taken as is, the dict is copied only if some value is converted
+def _dict_of(field_name, field, validator, value_class, copy):
+    if len(field) > JSON_MAX_ELEMENTS:
+        _reject(field_name, "elements", "has too many elements")
+
+    max_string = JSON_MAX_STRING
+    result = field.copy() if copy else field
+
+    for name, value in field.items():
+        if name.__class__ is not str:
+            _str(name, name)
+        if len(name) > max_string or (value.__class__ is str and len(value) > max_string):
+            _reject(field_name, "string", "has a string too long")
+        if value.__class__ is value_class:
+            continue
+        converted = validator(field_name + "." + name, value)
+        if converted is not value:
+            if result is field:
+                result = field.copy()
+            result[name] = converted
+
+    return result
+
+
+# same as _dict_of, but for a list
+def _list_of(field_name, field, validator, value_class, copy):
+    if len(field) > JSON_MAX_ELEMENTS:
+        _reject(field_name, "elements", "has too many elements")
+
+    max_string = JSON_MAX_STRING
+    result = list(field) if copy else field
+
+    for index, value in enumerate(field):
+        if value.__class__ is str and len(value) > max_string:
+            _reject(field_name, "string", "has a string too long")
+        if value.__class__ is value_class:
+            continue
+        converted = validator(field_name, value)
+        if converted is not value:
+            if result is field:
+                result = list(field)
+            result[index] = converted
+
+    return result
+
+
+def _load_json(field_name, field):
+    return _loads(field_name, field)
+
+
+def _load_json_dict(field_name, field):
+    field = _loads(field_name, field)
 
     if not isinstance(field, dict):
         raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
@@ -128,44 +487,28 @@ def _load_json_dict(field_name, field):
 
 
 def _load_json_dict_of_ints(field_name, field):
-    try:
-        field = ujson.loads(field)
-    except (TypeError, ValueError):
-        raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
+    field = _loads(field_name, field, check_limits=False)
 
     if not isinstance(field, dict):
         raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
 
-    return {
-        _str(name, name): _int(field_name + "." + name, value)
-        for name, value in field.items()
-    }
+    return _dict_of(field_name, field, _int, int, False)
 
 
 def _load_json_dict_of_primitives(field_name, field):
-    try:
-        field = ujson.loads(field)
-    except (TypeError, ValueError):
-        raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
+    field = _loads(field_name, field, check_limits=False)
 
     if not isinstance(field, dict):
         raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
 
-    return {
-        _str(name, name): _primitive(field_name + "." + name, value)
-        for name, value in field.items()
-    }
+    return _dict_of(field_name, field, _primitive, int, False)
 
 
 def _json_dict(field_name, field):
     if not isinstance(field, dict):
         raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
 
-    try:
-        ujson.dumps(field)
-    except TypeError:
-        raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
-
+    _dumps(field_name, field)
     return field
 
 
@@ -173,64 +516,34 @@ def _json_list(field_name, field):
     if not isinstance(field, list):
         raise ValidationError("Field {0} is not a valid JSON list".format(field_name))
 
-    try:
-        ujson.dumps(field)
-    except TypeError:
-        raise ValidationError("Field {0} is not a valid JSON list".format(field_name))
-
+    _dumps(field_name, field, "is not a valid JSON list")
     return field
 
 
+# no ujson.dumps check is needed, a dict of ints is always a valid JSON object
 def _json_dict_of_ints(field_name, field):
-    try:
-        ujson.dumps(field)
-    except (TypeError, ValueError):
-        raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
-
     if not isinstance(field, dict):
         raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
 
-    return {
-        _str(name, name): _int(field_name + "." + name, value)
-        for name, value in field.items()
-    }
+    return _dict_of(field_name, field, _int, int, True)
 
 
 def _json_dict_of_strings(field_name, field):
-    try:
-        ujson.dumps(field)
-    except (TypeError, ValueError):
-        raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
-
     if not isinstance(field, dict):
         raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
 
-    return {
-        _str(name, name): _str(field_name + "." + name, value)
-        for name, value in field.items()
-    }
+    return _dict_of(field_name, field, _str, str, True)
 
 
 def _json_dict_of_primitives(field_name, field):
-    try:
-        ujson.dumps(field)
-    except (TypeError, ValueError):
-        raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
-
     if not isinstance(field, dict):
         raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
 
-    return {
-        _str(name, name): _primitive(field_name + "." + name, value)
-        for name, value in field.items()
-    }
+    return _dict_of(field_name, field, _primitive, int, True)
 
 
 def _json_dict_of_dicts(field_name, field):
-    try:
-        ujson.dumps(field)
-    except (TypeError, ValueError):
-        raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
+    _dumps(field_name, field)
 
     if not isinstance(field, dict):
         raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
@@ -248,48 +561,24 @@ def _json_dict_of_dicts(field_name, field):
 
 
 def _json_list_of_strings(field_name, field):
-    try:
-        ujson.dumps(field)
-    except (TypeError, ValueError):
-        raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
-
     if not isinstance(field, list):
         raise ValidationError("Field {0} is not a valid JSON list".format(field_name))
 
-    return [
-        _str(field_name, child)
-        for child in field
-    ]
+    return _list_of(field_name, field, _str, str, True)
 
 
 def _json_list_of_str_name(field_name, field):
-    try:
-        ujson.dumps(field)
-    except (TypeError, ValueError):
-        raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
-
     if not isinstance(field, list):
         raise ValidationError("Field {0} is not a valid JSON list".format(field_name))
 
-    return [
-        _str_name(field_name, child)
-        for child in field
-    ]
+    return _list_of(field_name, field, _str_name, None, True)
 
 
 def _json_list_of_ints(field_name, field):
-    try:
-        ujson.dumps(field)
-    except (TypeError, ValueError):
-        raise ValidationError("Field {0} is not a valid JSON object".format(field_name))
-
     if not isinstance(field, list):
         raise ValidationError("Field {0} is not a valid JSON list".format(field_name))
 
-    return [
-        _int(field_name, child)
-        for child in field
-    ]
+    return _list_of(field_name, field, _int, int, True)
 
 
 def _int(field_name, field):